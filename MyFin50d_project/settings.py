@@ -11,6 +11,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 #from homepage_app.helpers.logging import configure_logging
 #import importlib.util
@@ -288,9 +289,131 @@ TEMPLATES = [
 
 
 # Added to manage how long the portfolio object is kept before being refreshed.
-CACHES = {
-    'default': {
+# CACHE_BACKEND selects:
+#   locmem (default): per-process memory, only correct with a single worker (e.g. runserver, tests)
+#   sqlite: a SQLite file shared by the processes on this host (utils/cache.py), at CACHE_LOCATION
+#   redis: a Redis (or Redis-compatible) server at the CACHE_LOCATION URL, shared across hosts; needs the redis package
+# With several gunicorn workers the cache must be shared by all of them, or a trade handled by one worker leaves the
+# others serving the old portfolio: Dockerfile.django sets sqlite, and production refuses locmem.
+# The shared backends use a serializer tuned for portfolio snapshots (brokerage/helpers/portfolio_serializer.py).
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+if PROJECT_ENV == 'production' and CACHE_BACKEND == 'locmem':
+    raise ImproperlyConfigured('CACHE_BACKEND must be sqlite or redis in production, where gunicorn runs several workers')
+CACHE_SERIALIZER = 'brokerage.helpers.portfolio_serializer.PortfolioSerializer'
+CACHE_BACKENDS = {
+    'sqlite': {
+        'BACKEND': 'utils.cache.SQLiteCache',
+        'LOCATION': os.getenv('CACHE_LOCATION', BASE_DIR / 'cache.sqlite3'),
+        'OPTIONS': {
+            'serializer': CACHE_SERIALIZER,
+            'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 100000)),
+        },
+    },
+    'redis': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_LOCATION', 'redis://127.0.0.1:6379/0'),
+        'OPTIONS': {
+            'serializer': CACHE_SERIALIZER,
+        },
+    },
+    'locmem': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
-}
\ No newline at end of file
+    },
+}
+CACHES = {
+    'default': CACHE_BACKENDS[CACHE_BACKEND],
+}
+
+# Added to share FMP quotes across users (see brokerage/helpers/quote_cache.py). Quotes are reused until they are
+# QUOTE_CACHE_TIMEOUT seconds old and symbols unknown to FMP are remembered for QUOTE_CACHE_NEGATIVE_TIMEOUT seconds.
+# Expired quotes are kept for QUOTE_CACHE_STALE_TIMEOUT seconds as a fallback for when FMP is unavailable.
+QUOTE_CACHE_TIMEOUT = int(os.getenv('QUOTE_CACHE_TIMEOUT', 60))
+QUOTE_CACHE_NEGATIVE_TIMEOUT = int(os.getenv('QUOTE_CACHE_NEGATIVE_TIMEOUT', 900))
+QUOTE_CACHE_STALE_TIMEOUT = int(os.getenv('QUOTE_CACHE_STALE_TIMEOUT', 86400))
+
+# Added to coalesce concurrent FMP requests for the same symbols (see brokerage/helpers/single_flight.py). Callers wait
+# up to SINGLE_FLIGHT_TIMEOUT seconds for an in-flight request, re-checking the cache every SINGLE_FLIGHT_POLL_INTERVAL.
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 10))
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', 0.05))
+
+# Added to configure the pooled FMP client (see brokerage/helpers/fmp_client.py). Timeouts are in seconds and are kept
+# well below gunicorn's worker timeout, so a slow FMP response cannot hold a worker hostage.
+FMP_CONNECT_TIMEOUT = float(os.getenv('FMP_CONNECT_TIMEOUT', 3.05))
+FMP_READ_TIMEOUT = float(os.getenv('FMP_READ_TIMEOUT', 5))
+FMP_LISTINGS_READ_TIMEOUT = float(os.getenv('FMP_LISTINGS_READ_TIMEOUT', 30))
+FMP_MAX_RETRIES = int(os.getenv('FMP_MAX_RETRIES', 2))
+FMP_BACKOFF_BASE = float(os.getenv('FMP_BACKOFF_BASE', 0.25))
+FMP_BACKOFF_MAX = float(os.getenv('FMP_BACKOFF_MAX', 2))
+FMP_POOL_MAXSIZE = int(os.getenv('FMP_POOL_MAXSIZE', 10))
+FMP_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('FMP_CIRCUIT_FAILURE_THRESHOLD', 5))
+FMP_CIRCUIT_RESET_TIMEOUT = float(os.getenv('FMP_CIRCUIT_RESET_TIMEOUT', 30))
+
+# Added to serve symbol autocomplete from an in-memory index of Listing (see brokerage/helpers/listing_index.py). Each
+# worker checks for new listings every LISTING_INDEX_CHECK_INTERVAL seconds. Set LISTING_INDEX_ENABLED=False to query
+# the database instead, e.g. where memory is tight.
+LISTING_INDEX_ENABLED = os.getenv('LISTING_INDEX_ENABLED', 'True') == 'True'
+LISTING_INDEX_CHECK_INTERVAL = float(os.getenv('LISTING_INDEX_CHECK_INTERVAL', 5))
+
+# Added to size the bulk writes of the listings refresh (see brokerage/helpers/listings_sync.py), which streams FMP's
+# payload in chunks of LISTINGS_STREAM_CHUNK_SIZE bytes. If more than LISTINGS_MAX_REMOVED_FRACTION of the listings
+# are missing from FMP's payload, the payload is assumed to be truncated and nothing is deleted.
+LISTINGS_BATCH_SIZE = int(os.getenv('LISTINGS_BATCH_SIZE', 1000))
+LISTINGS_UPDATE_BATCH_SIZE = int(os.getenv('LISTINGS_UPDATE_BATCH_SIZE', 100))
+LISTINGS_STREAM_CHUNK_SIZE = int(os.getenv('LISTINGS_STREAM_CHUNK_SIZE', 65536))
+LISTINGS_MAX_REMOVED_FRACTION = float(os.getenv('LISTINGS_MAX_REMOVED_FRACTION', 0.2))
+
+# Added to run background tasks off the request path (see utils/management/commands/run_scheduler.py). Maps each
+# management command to run to the number of seconds between successful runs. A failed task is retried after
+# SCHEDULER_RETRY_INTERVAL seconds, and a task whose process dies releases its lock after TASK_LOCK_TIMEOUT seconds.
+SCHEDULED_TASKS = {
+    'refresh_listings': int(os.getenv('REFRESH_LISTINGS_INTERVAL', 86400)),
+}
+SCHEDULER_POLL_INTERVAL = float(os.getenv('SCHEDULER_POLL_INTERVAL', 60))
+SCHEDULER_RETRY_INTERVAL = int(os.getenv('SCHEDULER_RETRY_INTERVAL', 900))
+TASK_LOCK_TIMEOUT = int(os.getenv('TASK_LOCK_TIMEOUT', 1800))
+
+# Added to keep cached portfolio snapshots until they are invalidated (see brokerage/helpers/portfolio_cache.py), but
+# refresh them at least every PORTFOLIO_SNAPSHOT_TIMEOUT seconds. Snapshots hold no prices, so this can be long.
+PORTFOLIO_SNAPSHOT_TIMEOUT = int(os.getenv('PORTFOLIO_SNAPSHOT_TIMEOUT', 86400))
+
+# Added so that concurrent requests for the same user build their portfolio snapshot only once: others wait up to
+# PORTFOLIO_BUILD_WAIT seconds for it, and a build lock lapses after PORTFOLIO_BUILD_LOCK_TIMEOUT seconds
+PORTFOLIO_BUILD_WAIT = float(os.getenv('PORTFOLIO_BUILD_WAIT', 10))
+PORTFOLIO_BUILD_LOCK_TIMEOUT = int(os.getenv('PORTFOLIO_BUILD_LOCK_TIMEOUT', 30))
+
+# Added so that a portfolio snapshot past PORTFOLIO_SNAPSHOT_TIMEOUT is served stale for up to
+# PORTFOLIO_SNAPSHOT_STALE_TIMEOUT more seconds while one request rebuilds it. PORTFOLIO_EARLY_REFRESH_BETA scales how
+# early before expiry snapshots may be refreshed (0 turns early refresh off).
+PORTFOLIO_SNAPSHOT_STALE_TIMEOUT = int(os.getenv('PORTFOLIO_SNAPSHOT_STALE_TIMEOUT', 3600))
+PORTFOLIO_EARLY_REFRESH_BETA = float(os.getenv('PORTFOLIO_EARLY_REFRESH_BETA', 1.0))
+
+# Added to value large portfolios with NumPy (see brokerage/helpers/valuation_engine.py): snapshots with at least
+# PORTFOLIO_VECTORIZE_MIN_LOTS open lots are valued in one pass over arrays, to the same result as the lot-by-lot
+# Decimal loop. Set PORTFOLIO_VALUATION_ENGINE=decimal to always value lot by lot; without NumPy installed, that is
+# what happens anyway.
+PORTFOLIO_VALUATION_ENGINE = os.getenv('PORTFOLIO_VALUATION_ENGINE', 'auto')
+PORTFOLIO_VECTORIZE_MIN_LOTS = int(os.getenv('PORTFOLIO_VECTORIZE_MIN_LOTS', 200))
+
+# Added to revalue all users' portfolios in one job (see brokerage/helpers/bulk_valuation.py): users are read and
+# valued PORTFOLIO_REVALUE_BATCH_SIZE at a time, across PORTFOLIO_REVALUE_PROCESSES processes, and quotes are
+# requested PORTFOLIO_REVALUE_QUOTE_BATCH_SIZE symbols at a time
+PORTFOLIO_REVALUE_BATCH_SIZE = int(os.getenv('PORTFOLIO_REVALUE_BATCH_SIZE', 200))
+PORTFOLIO_REVALUE_PROCESSES = int(os.getenv('PORTFOLIO_REVALUE_PROCESSES', 1))
+PORTFOLIO_REVALUE_QUOTE_BATCH_SIZE = int(os.getenv('PORTFOLIO_REVALUE_QUOTE_BATCH_SIZE', 100))
+
+# Added to paginate /history (see brokerage/helpers/transaction_history.py): transactions shown per page
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 50))
+
+# Added to stream /history/export (see brokerage/helpers/transaction_history.py): transactions read from the DB, and
+# written to the response, per chunk
+HISTORY_EXPORT_CHUNK_SIZE = int(os.getenv('HISTORY_EXPORT_CHUNK_SIZE', 2000))
+
+# Added to import trade files in bulk (see brokerage/helpers/trade_import.py): trades written per DB transaction, and
+# the cash that users created by an import start with
+TRADE_IMPORT_CHUNK_SIZE = int(os.getenv('TRADE_IMPORT_CHUNK_SIZE', 5000))
+TRADE_IMPORT_USER_CASH = os.getenv('TRADE_IMPORT_USER_CASH', '10000000.00')
+
+# Added so the app can be pointed at an FMP stand-in (see brokerage/benchmarks/fmp_stub.py and the fmp_stub command)
+# for benchmarks and load tests, e.g. FMP_BASE_URL=http://127.0.0.1:8089/api/v3
+FMP_BASE_URL = os.getenv('FMP_BASE_URL', 'https://financialmodelingprep.com/api/v3')
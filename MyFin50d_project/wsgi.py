@@ -15,3 +15,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MyFin50d_project.settings')
 
 
 application = get_wsgi_application()
+
+# Added to build the symbol autocomplete index as each worker starts (see brokerage/helpers/listing_index.py)
+from django.conf import settings
+if settings.LISTING_INDEX_ENABLED:
+    from brokerage.helpers.listing_index import warm_listing_index
+    warm_listing_index()
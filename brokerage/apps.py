@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BrokerageConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "brokerage"
+
+    # Added to connect the portfolio cache invalidation signals
+    def ready(self):
+        from . import signals
@@ -0,0 +1,7 @@
+from .baselines import *
+from .fixtures import *
+from .fmp_stub import *
+from .loadtest import *
+from .memory import *
+from .microbenchmarks import *
+from .timing import *
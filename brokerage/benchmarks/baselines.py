@@ -0,0 +1,48 @@
+import json
+import platform
+import sys
+import time
+__all__ = ['compare_to_baseline', 'load_baseline', 'save_baseline']
+
+
+# Benchmark results are kept as JSON baselines, so a later run (e.g. after an engine change) can be compared with them:
+#   {"meta": {...where and when it ran...}, "results": {name: summarize_timings() of that benchmark, ...}}
+
+
+# Writes results (name -> summarize_timings()) to path as a baseline, with a note of the machine it was measured on
+def save_baseline(path, results, **meta):
+    baseline = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            **meta,
+        },
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+# Compares results with a baseline's, by metric (e.g. 'min_ms'). Returns (name, baseline value, current value, ratio,
+# regressed) for every result also in the baseline with that metric, where regressed means slower than the baseline
+# by more than tolerance (0.25 = 25%), or short_tolerance for timings under short_ms in the baseline. Timings under
+# min_ms are too noisy to compare, and never count as regressions.
+# A benchmark of a few milliseconds can take half as long again from one process to the next on a busy machine, even
+# by its fastest run (min_ms, which is otherwise the least noisy metric to compare), hence the looser tolerance.
+def compare_to_baseline(baseline, results, metric='p50_ms', tolerance=0.25, min_ms=0.05, short_ms=10.0, short_tolerance=1.0):
+    comparisons = []
+    for name, result in results.items():
+        expected = baseline['results'].get(name)
+        if expected is None or metric not in expected:
+            continue
+        before, after = expected[metric], result[metric]
+        ratio = after / before if before else float('inf') if after else 1.0
+        regressed = after > min_ms and ratio > 1 + (short_tolerance if before < short_ms else tolerance)
+        comparisons.append((name, before, after, ratio, regressed))
+    return comparisons
@@ -0,0 +1,180 @@
+from collections import deque
+from contextlib import contextmanager
+from decimal import Decimal, ROUND_HALF_UP
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+import logging
+from ..helpers.lot_fills import fill_sale
+from ..helpers.process_portfolio import OpenLotData, PortfolioSnapshot, PositionData
+from ..helpers.realized_gains import add_sale
+from ..helpers.valuation_engine import build_lot_columns
+from ..models import OpenLot, Position, Transaction
+import random
+from users.models import UserProfile
+__all__ = ['BENCHMARK_SYMBOLS', 'benchmark_database', 'create_synthetic_user', 'random_snapshot', 'seed_trade_history']
+
+logger = logging.getLogger('django')
+
+# Symbols used for synthetic trade histories, with a starting price for each
+BENCHMARK_SYMBOLS = {
+    'AAPL': Decimal('170.00'), 'MSFT': Decimal('410.00'), 'GOOG': Decimal('140.00'), 'AMZN': Decimal('180.00'),
+    'NVDA': Decimal('880.00'), 'META': Decimal('500.00'), 'TSLA': Decimal('175.00'), 'JPM': Decimal('195.00'),
+    'V': Decimal('280.00'), 'WMT': Decimal('60.00'), 'KO': Decimal('60.00'), 'DIS': Decimal('110.00'),
+}
+
+
+# Runs the enclosed block against a throwaway copy of the database (in memory for SQLite), so benchmarks never
+# touch real data. The copy is migrated first, so it has the same tables and indexes as production. DEBUG is turned
+# off for the duration, as logging every SQL statement would dominate the timings.
+@contextmanager
+def benchmark_database(verbosity=0):
+    old_name = connection.settings_dict['NAME']
+    with override_settings(DEBUG=False):
+        connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+        try:
+            yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+# Creates a user + profile to hang synthetic trades on
+def create_synthetic_user(username, accounting_method='FIFO', cash=Decimal('10000000.00'), tax_loss_offsets='On'):
+    user = User.objects.create(username=username, email=f'{username}@example.com')
+    UserProfile.objects.create(
+        user=user,
+        cash=cash,
+        cash_initial=cash,
+        accounting_method=accounting_method,
+        tax_loss_offsets=tax_loss_offsets,
+        confirmed=True,
+    )
+    return User.objects.select_related('userprofile').get(pk=user.pk)
+
+
+# Generates a realistic trade history of n_transactions for user and writes it with bulk inserts. Trades are spread
+# over the last 'days' days (so lots are a mix of short- and long-term) and sales are filled from open lots in the
+# user's FIFO/LIFO order by fill_sale() (as process_sell fills them), against a one-year cutoff from now.
+# Transaction, OpenLot and Position rows are all written, so the portfolio code sees a consistent history.
+def seed_trade_history(user, n_transactions, symbols=None, sell_ratio=0.3, days=730, seed=0, batch_size=5000):
+    rng = random.Random(seed)
+    symbols = symbols or list(BENCHMARK_SYMBOLS)
+    prices = {symbol: BENCHMARK_SYMBOLS.get(symbol, Decimal('100.00')) for symbol in symbols}
+    user_profile = user.userprofile
+    lifo = user_profile.accounting_method == 'LIFO'
+    tax_rate_STCG = Decimal(user_profile.tax_rate_STCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    tax_rate_LTCG = Decimal(user_profile.tax_rate_LTCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    now = timezone.now()
+    cutoff_date = now - timezone.timedelta(days=365)
+    start = now - timezone.timedelta(days=days)
+    step = timezone.timedelta(days=days) / max(n_transactions, 1)
+
+    transactions = []
+    open_lots = {symbol: deque() for symbol in symbols} # symbol -> list of BOT Transaction objects with shares left
+    shares_held = dict.fromkeys(symbols, 0)
+    cash = Decimal(user_profile.cash)
+
+    for i in range(n_transactions):
+        symbol = rng.choice(symbols)
+        timestamp = start + step * i
+        # Random walk of +/- 2% per trade, floored at $1
+        prices[symbol] = max(Decimal('1.00'), (prices[symbol] * Decimal(str(1 + rng.uniform(-0.02, 0.02)))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+        price = prices[symbol]
+
+        if shares_held[symbol] and rng.random() < sell_ratio:
+            shares = rng.randint(1, shares_held[symbol])
+            shares_held[symbol] -= shares
+            lots = open_lots[symbol]
+            STCG, LTCG, STCG_tax, LTCG_tax, closed_lots, _, _ = fill_sale(
+                reversed(lots) if lifo else lots, shares, price, cutoff_date, tax_rate_STCG, tax_rate_LTCG
+            )
+            for _ in closed_lots:
+                lots.pop() if lifo else lots.popleft()
+            total = (shares * price).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+            cash += total
+            transactions.append(Transaction(
+                user=user, timestamp=timestamp, type='SLD', symbol=symbol, transaction_shares=shares,
+                transaction_value_per_share=price, transaction_value_total=total,
+                STCG=STCG.quantize(Decimal('0.01')), LTCG=LTCG.quantize(Decimal('0.01')),
+                STCG_tax=STCG_tax.quantize(Decimal('0.01')), LTCG_tax=LTCG_tax.quantize(Decimal('0.01')),
+            ))
+        else:
+            shares = rng.randint(1, 20)
+            shares_held[symbol] += shares
+            total = shares * price
+            cash -= total
+            txn = Transaction(
+                user=user, timestamp=timestamp, type='BOT', symbol=symbol, transaction_shares=shares,
+                transaction_value_per_share=price, transaction_value_total=total, shares_outstanding=shares,
+            )
+            transactions.append(txn)
+            open_lots[symbol].append(txn)
+
+    with transaction.atomic():
+        Transaction.objects.bulk_create(transactions, batch_size=batch_size)
+        OpenLot.objects.bulk_create([
+            OpenLot(
+                user=user, transaction=lot, symbol=lot.symbol, timestamp=lot.timestamp,
+                shares_outstanding=lot.shares_outstanding, transaction_value_per_share=lot.transaction_value_per_share,
+            )
+            for lots in open_lots.values() for lot in lots
+        ], batch_size=batch_size)
+
+        positions = {}
+        for txn in transactions:
+            position = positions.setdefault(txn.symbol, Position(user=user, symbol=txn.symbol))
+            if txn.type == 'BOT':
+                position.transaction_shares += txn.transaction_shares
+            else:
+                add_sale(position, txn, tax_rate_STCG, tax_rate_LTCG)
+        for lots in open_lots.values():
+            for lot in lots:
+                positions[lot.symbol].shares_outstanding += lot.shares_outstanding
+        Position.objects.bulk_create(positions.values(), batch_size=batch_size)
+
+        user_profile.cash = cash
+        user_profile.save(update_fields=['cash'])
+
+    logger.debug(f'running seed_trade_history() ... seeded { len(transactions) } transactions for user { user.pk }')
+    return prices
+
+
+# A PortfolioSnapshot of n_lots random open lots spread over n_symbols positions, with quotes for them, built in
+# memory for comparing and timing the valuation engines. Prices have 0 to 6 decimal places, lots are short- and
+# long-term (including some bought exactly at the one-year cutoff, and a microsecond either side) and a few are empty;
+# tax rates and tax loss offsets vary.
+def random_snapshot(rng, now, n_lots, n_symbols):
+    symbols = [f'SYM{ index }' for index in range(n_symbols)]
+    cutoff_date = now - timezone.timedelta(days=365)
+    open_lots = []
+    for _ in range(n_lots):
+        if rng.random() < 0.05:
+            timestamp = cutoff_date + timezone.timedelta(microseconds=rng.choice([-1, 0, 1]))
+        else:
+            timestamp = now - timezone.timedelta(seconds=rng.randint(0, 3 * 365 * 86400))
+        shares = 0 if rng.random() < 0.02 else rng.randint(1, 5000)
+        open_lots.append(OpenLotData(rng.choice(symbols), shares, Decimal(rng.randint(1, 500000)) / 100, timestamp))
+
+    positions = []
+    for symbol in symbols:
+        shares = sum(lot.shares_outstanding for lot in open_lots if lot.symbol == symbol)
+        positions.append(PositionData(symbol, shares + rng.randint(0, 1000), shares))
+
+    # Quotes arrive as floats, with anything from 0 to 6 decimal places; some symbols have none
+    quotes = {}
+    for symbol in symbols:
+        if rng.random() < 0.95:
+            quotes[symbol] = {'symbol': symbol, 'price': round(rng.uniform(0.5, 5000), rng.randint(0, 6))}
+
+    snapshot = PortfolioSnapshot(
+        positions=positions,
+        open_lots=open_lots,
+        cash=Decimal('10000.00'),
+        cash_initial=Decimal('10000.00'),
+        tax_rate_STCG=Decimal(rng.randint(0, 60)) / 100,
+        tax_rate_LTCG=Decimal(rng.randint(0, 40)) / 100,
+        tax_offset_coefficient=rng.choice([0, 1]),
+    )
+    snapshot.lot_columns = build_lot_columns(snapshot.positions, snapshot.open_lots)
+    return snapshot, quotes
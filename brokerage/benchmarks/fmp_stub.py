@@ -0,0 +1,274 @@
+from collections import Counter
+from dataclasses import dataclass
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import random
+import requests
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+from .fixtures import BENCHMARK_SYMBOLS
+__all__ = ['FMPFaults', 'FMPStubServer', 'RecordedFMPData', 'RecordingFMPData', 'SyntheticFMPData', 'start_fmp_stub', 'synthetic_symbols']
+
+logger = logging.getLogger('django')
+
+
+# A local stand-in for the parts of the FMP API the app uses, so that benchmarks and load tests run without network
+# access or an API key. Point the app at it with FMP_BASE_URL=http://127.0.0.1:<port>/api/v3. It serves
+#   /profile/<symbols>, /quote/<symbols>   one item per known symbol, [] for unknown ones (as FMP does)
+#   /available-traded/list                 every known symbol
+# from one of three sources:
+#   SyntheticFMPData   deterministic made-up companies, for BENCHMARK_SYMBOLS plus any number of generated symbols
+#   RecordedFMPData    items recorded from FMP earlier, served for any combination of the recorded symbols
+#   RecordingFMPData   passes requests on to FMP and records the items it returns, for replay later
+# Latency, errors and hung requests can be injected (see FMPFaults), to see how the app copes with a slow or failing
+# FMP. The apikey parameter is accepted and ignored.
+
+FMP_API_PATH = '/api/v3/'
+FMP_UPSTREAM_URL = 'https://financialmodelingprep.com/api/v3'
+
+# Files of a recording, in its directory: symbol -> item for profiles and quotes, and the listings as FMP sent them
+RECORDING_FILES = {'profile': 'profile.json', 'quote': 'quote.json', 'listings': 'available-traded-list.json'}
+
+
+# Returns BENCHMARK_SYMBOLS followed by 'extra' generated three- and four-letter symbols, the same ones every time
+def synthetic_symbols(extra=0, seed=0):
+    rng = random.Random(f'symbols:{ seed }')
+    symbols = dict.fromkeys(BENCHMARK_SYMBOLS)
+    while len(symbols) < len(BENCHMARK_SYMBOLS) + extra:
+        symbols[''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(rng.choice([3, 4])))] = None
+    return list(symbols)
+
+
+# Made-up but consistently shaped company data. Each symbol's company (name, sector, price, ...) is derived from the
+# symbol and seed alone, so every run of a benchmark sees the same market. With volatility > 0, each response moves
+# prices randomly by up to that fraction either way of the symbol's base price.
+class SyntheticFMPData:
+    SECTORS = ['Technology', 'Healthcare', 'Financial Services', 'Consumer Cyclical', 'Energy', 'Industrials', 'Utilities']
+
+    def __init__(self, symbols, seed=0, volatility=0.0):
+        self.symbols = list(symbols)
+        self.seed = seed
+        self.volatility = volatility
+        self.companies = {symbol: self._company(symbol) for symbol in self.symbols}
+
+    def _company(self, symbol):
+        rng = random.Random(f'company:{ self.seed }:{ symbol }')
+        price = BENCHMARK_SYMBOLS.get(symbol) or Decimal(rng.randint(500, 50000)) / 100
+        shares_outstanding = rng.randint(10, 5000) * 1_000_000
+        return {
+            'symbol': symbol,
+            'companyName': f'{ symbol.title() } { rng.choice(["Inc.", "Corp.", "Holdings", "Group", "Ltd."]) }',
+            'sector': rng.choice(self.SECTORS),
+            'price': float(price),
+            'shares_outstanding': shares_outstanding,
+            'beta': round(rng.uniform(0.3, 2.2), 3),
+            'volAvg': rng.randint(100_000, 90_000_000),
+            'employees': rng.randint(50, 300_000),
+            'exchange': rng.choice([('NASDAQ Global Select', 'NASDAQ'), ('New York Stock Exchange', 'NYSE')]),
+        }
+
+    def _price(self, company, rng):
+        if not self.volatility:
+            return company['price']
+        return round(company['price'] * (1 + rng.uniform(-self.volatility, self.volatility)), 2)
+
+    def fetch(self, kind, symbols, rng):
+        if kind == 'listings':
+            return 200, [
+                {'symbol': c['symbol'], 'name': c['companyName'], 'price': c['price'], 'exchange': c['exchange'][0],
+                 'exchangeShortName': c['exchange'][1], 'type': 'stock'}
+                for c in self.companies.values()
+            ]
+        items = []
+        for symbol in symbols:
+            company = self.companies.get(symbol)
+            if company is not None:
+                items.append(self._profile(company, rng) if kind == 'profile' else self._quote(company, rng))
+        return 200, items
+
+    def _profile(self, c, rng):
+        price = self._price(c, rng)
+        changes = round(price - c['price'] * 0.99, 2)
+        return {
+            'symbol': c['symbol'], 'price': price, 'beta': c['beta'], 'volAvg': c['volAvg'],
+            'mktCap': int(price * c['shares_outstanding']), 'lastDiv': 0, 'range': f'{ c["price"] * 0.7:.2f}-{ c["price"] * 1.3:.2f}',
+            'changes': changes, 'companyName': c['companyName'], 'currency': 'USD', 'cik': None, 'isin': None, 'cusip': None,
+            'exchange': c['exchange'][0], 'exchangeShortName': c['exchange'][1], 'industry': c['sector'],
+            'website': f'https://www.{ c["symbol"].lower() }.example.com', 'description': f'{ c["companyName"] } is a synthetic company for benchmarks.',
+            'ceo': 'Jane Doe', 'sector': c['sector'], 'country': 'US', 'fullTimeEmployees': str(c['employees']), 'phone': None,
+            'address': None, 'city': None, 'state': None, 'zip': None, 'dcfDiff': None, 'dcf': None,
+            'image': f'https://financialmodelingprep.com/image-stock/{ c["symbol"] }.png', 'ipoDate': '2000-01-03',
+            'defaultImage': False, 'isEtf': False, 'isActivelyTrading': True, 'isAdr': False, 'isFund': False,
+        }
+
+    def _quote(self, c, rng):
+        price = self._price(c, rng)
+        previous_close = round(c['price'] * 0.99, 2)
+        return {
+            'symbol': c['symbol'], 'name': c['companyName'], 'price': price,
+            'changesPercentage': round((price / previous_close - 1) * 100, 4), 'change': round(price - previous_close, 2),
+            'dayLow': round(min(price, previous_close) * 0.99, 2), 'dayHigh': round(max(price, previous_close) * 1.01, 2),
+            'yearHigh': round(c['price'] * 1.3, 2), 'yearLow': round(c['price'] * 0.7, 2),
+            'marketCap': int(price * c['shares_outstanding']), 'priceAvg50': c['price'], 'priceAvg200': c['price'],
+            'exchange': c['exchange'][1], 'volume': c['volAvg'], 'avgVolume': c['volAvg'], 'open': previous_close,
+            'previousClose': previous_close, 'eps': None, 'pe': None, 'earningsAnnouncement': None,
+            'sharesOutstanding': c['shares_outstanding'], 'timestamp': int(time.time()),
+        }
+
+
+# Serves the items in a recording made by RecordingFMPData. Quotes and profiles are recorded per symbol, so a request
+# for any mix of recorded symbols is answered, whether or not that exact request was recorded.
+class RecordedFMPData:
+    def __init__(self, directory):
+        self.directory = directory
+        self.items = {}
+        for kind, filename in RECORDING_FILES.items():
+            path = os.path.join(directory, filename)
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as file:
+                    self.items[kind] = json.load(file)
+        if not self.items:
+            raise FileNotFoundError(f'No FMP recording in { directory }')
+
+    def fetch(self, kind, symbols, rng):
+        if kind not in self.items:
+            return 404, {'Error Message': f'Nothing recorded for { kind }'}
+        if kind == 'listings':
+            return 200, self.items[kind]
+        return 200, [self.items[kind][symbol] for symbol in symbols if symbol in self.items[kind]]
+
+
+# Passes requests on to FMP (with FMP_API_KEY) and records the items in successful responses to directory, adding to
+# whatever was recorded there before. Each kind's file is rewritten as new items arrive, so a recording can be stopped
+# at any point.
+class RecordingFMPData:
+    def __init__(self, directory, api_key, upstream=FMP_UPSTREAM_URL, timeout=30):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.api_key = api_key
+        self.upstream = upstream.rstrip('/')
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        try:
+            self.items = RecordedFMPData(directory).items
+        except FileNotFoundError:
+            self.items = {}
+
+    def fetch(self, kind, symbols, rng):
+        path = 'available-traded/list' if kind == 'listings' else f'{ kind }/{ ",".join(symbols) }'
+        try:
+            response = requests.get(f'{ self.upstream }/{ path }', params={'apikey': self.api_key}, timeout=self.timeout)
+            payload = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f'running RecordingFMPData.fetch() ... request for: { path } failed with: { e }')
+            return 502, {'Error Message': f'Upstream request failed: { e }'}
+        if response.status_code == 200 and isinstance(payload, list):
+            self._record(kind, payload)
+        return response.status_code, payload
+
+    def _record(self, kind, payload):
+        with self.lock:
+            if kind == 'listings':
+                self.items[kind] = payload
+            else:
+                self.items.setdefault(kind, {}).update((item['symbol'], item) for item in payload if 'symbol' in item)
+            path = os.path.join(self.directory, RECORDING_FILES[kind])
+            with open(f'{ path }.tmp', 'w', encoding='utf-8') as file:
+                json.dump(self.items[kind], file)
+            os.replace(f'{ path }.tmp', path)
+
+
+# Faults to inject into the stub's responses. Every response is delayed by latency_ms plus up to jitter_ms; then a
+# fraction error_rate of requests fail with one of error_statuses (those fmp_get() retries), and a fraction hang_rate
+# are held for hang_seconds (past the app's read timeout) before being answered.
+@dataclass(slots=True)
+class FMPFaults:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_statuses: tuple = (429, 500, 502, 503)
+    hang_rate: float = 0.0
+    hang_seconds: float = 10.0
+
+
+class _FMPStubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as FMP, so the app's pooled session reuses its connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        path = unquote(urlsplit(self.path).path)
+        if path.startswith(FMP_API_PATH):
+            path = path[len(FMP_API_PATH):]
+        kind, _, symbols = path.strip('/').partition('/')
+        if path.strip('/') == 'available-traded/list':
+            kind, symbols = 'listings', []
+        elif kind in ('profile', 'quote') and symbols:
+            symbols = [symbol for symbol in symbols.upper().split(',') if symbol]
+        else:
+            return self._respond('unknown', 404, {'Error Message': f'The stub does not serve { path }'})
+
+        faults = server.faults
+        delay = faults.latency_ms + server.rng.uniform(0, faults.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if faults.hang_rate and server.rng.random() < faults.hang_rate:
+            time.sleep(faults.hang_seconds)
+        if faults.error_rate and server.rng.random() < faults.error_rate:
+            return self._respond(kind, server.rng.choice(faults.error_statuses), {'Error Message': 'Injected error'})
+
+        status, payload = server.source.fetch(kind, symbols, server.rng)
+        self._respond(kind, status, payload)
+
+    def _respond(self, kind, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.server.count(kind, status)
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        # The client gave up on a slow response
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        logger.debug(f'running FMP stub ... { self.address_string() } { format % args }')
+
+
+# The stub's HTTP server. Requests are handled in threads, so slow (or hung) responses do not hold up the others.
+# counts tallies responses by (kind, status).
+class FMPStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, source, faults=None, seed=0):
+        super().__init__(address, _FMPStubHandler)
+        self.source = source
+        self.faults = faults or FMPFaults()
+        self.rng = random.Random(seed)
+        self.counts = Counter()
+        self._counts_lock = threading.Lock()
+
+    def count(self, kind, status):
+        with self._counts_lock:
+            self.counts[(kind, status)] += 1
+
+    # The FMP_BASE_URL that points the app at this server
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{ host }:{ port }{ FMP_API_PATH.rstrip("/") }'
+
+
+# Starts a stub serving source (by default, SyntheticFMPData for BENCHMARK_SYMBOLS) in a background thread, e.g. for
+# the duration of a load test, and returns the server. Port 0 picks a free port; call shutdown() to stop it.
+def start_fmp_stub(source=None, faults=None, host='127.0.0.1', port=0, seed=0):
+    server = FMPStubServer((host, port), source or SyntheticFMPData(synthetic_symbols(seed=seed), seed=seed), faults, seed)
+    threading.Thread(target=server.serve_forever, name='fmp-stub', daemon=True).start()
+    logger.debug(f'running start_fmp_stub() ... serving at { server.base_url }')
+    return server
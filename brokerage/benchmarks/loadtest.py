@@ -0,0 +1,157 @@
+from collections import Counter
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from django.test import Client
+from django.urls import reverse
+import logging
+import os
+import random
+import time
+from ..models import Position
+from .fixtures import BENCHMARK_SYMBOLS, create_synthetic_user, seed_trade_history
+from .timing import summarize_timings
+__all__ = ['DEFAULT_LOADTEST_MIX', 'LOADTEST_ROUTES', 'LoadTestResult', 'run_load_test', 'seed_load_test_users']
+
+logger = logging.getLogger('django')
+
+
+# An end-to-end load test of the brokerage views: virtual users, each a logged-in test client, make a scripted mix of
+# requests (see LOADTEST_ROUTES) through the full middleware and view stack, and every request is timed. The script is
+# drawn from a seeded random stream, so a run with the same seed makes the same requests in the same order. Requests
+# are made one at a time in this process, so the timings are what one worker takes to serve each request.
+
+
+# A virtual user, with its own random stream for the choices its requests make
+class _Session:
+    def __init__(self, user, seed):
+        self.user = user
+        self.rng = random.Random(seed)
+        # Errors come back as 500 responses, to be counted, rather than as exceptions
+        self.client = Client(raise_request_exception=False)
+        self.client.force_login(user)
+        self.symbols = list(BENCHMARK_SYMBOLS)
+
+    # A symbol the user holds shares of, and how many, or None
+    def holding(self):
+        holdings = list(Position.objects.filter(user=self.user, shares_outstanding__gt=0).values_list('symbol', 'shares_outstanding'))
+        return self.rng.choice(holdings) if holdings else None
+
+
+# Each route returns the request a session makes to it, as (method, path, data), or None if it has nothing to send
+# (e.g. a sale with no shares held)
+def _sell(session):
+    holding = session.holding()
+    if holding is None:
+        return None
+    symbol, shares = holding
+    return 'post', reverse('brokerage:sell'), {'transaction_type': 'SLD', 'symbol': symbol, 'shares': session.rng.randint(1, min(shares, 20))}
+
+
+def _check_shares(session):
+    if session.rng.random() < 0.5 and (holding := session.holding()):
+        return 'post', reverse('brokerage:check_valid_shares'), {'transaction_type': 'SLD', 'symbol': holding[0], 'shares': session.rng.randint(1, holding[1])}
+    return 'post', reverse('brokerage:check_valid_shares'), {'transaction_type': 'BOT', 'symbol': session.rng.choice(session.symbols), 'shares': session.rng.randint(1, 50)}
+
+
+LOADTEST_ROUTES = {
+    'index': lambda session: ('get', reverse('brokerage:index'), None),
+    'index_detail': lambda session: ('get', reverse('brokerage:index_detail'), None),
+    'buy_form': lambda session: ('get', reverse('brokerage:buy'), None),
+    'buy': lambda session: ('post', reverse('brokerage:buy'), {'transaction_type': 'BOT', 'symbol': session.rng.choice(session.symbols), 'shares': session.rng.randint(1, 20)}),
+    'sell_form': lambda session: ('get', reverse('brokerage:sell'), None),
+    'sell': _sell,
+    'history': lambda session: ('get', reverse('brokerage:history'), None),
+    'quote': lambda session: ('get', reverse('brokerage:quote'), {'symbol': session.rng.choice(session.symbols)}),
+    # As the autocomplete sends them, keystroke by keystroke
+    'check_symbol': lambda session: ('post', reverse('brokerage:check_valid_symbol'), {'symbol': session.rng.choice(session.symbols)[:session.rng.randint(1, 4)]}),
+    'check_shares': _check_shares,
+}
+
+# Relative weights of the routes: mostly reads, as on the live site
+DEFAULT_LOADTEST_MIX = {
+    'index': 20, 'index_detail': 8, 'buy_form': 4, 'buy': 6, 'sell_form': 4, 'sell': 5,
+    'history': 10, 'quote': 12, 'check_symbol': 20, 'check_shares': 11,
+}
+
+
+# The outcome of a load test: each route's request durations (in seconds) and response status codes, and the server
+# errors (5xx) of the untimed warmup requests
+@dataclass(slots=True)
+class LoadTestResult:
+    durations: dict = field(default_factory=dict)
+    statuses: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+    warmup_errors: Counter = field(default_factory=Counter)
+
+    @property
+    def requests(self):
+        return sum(len(durations) for durations in self.durations.values())
+
+    # Route -> summarize_timings() of its requests, plus its throughput and how many of its responses were errors
+    def summary(self):
+        summary = {}
+        for route, durations in self.durations.items():
+            summary[route] = {
+                **summarize_timings(durations),
+                'requests_per_second': len(durations) / sum(durations) if sum(durations) else 0.0,
+                'errors': sum(count for status, count in self.statuses[route].items() if status >= 500),
+            }
+        return summary
+
+    # Route -> number of 5xx responses, timed or not, for the routes that had any
+    def server_errors(self):
+        errors = Counter(self.warmup_errors)
+        for route, statuses in self.statuses.items():
+            errors[route] += sum(count for status, count in statuses.items() if status >= 500)
+        return {route: count for route, count in errors.items() if count}
+
+
+# Creates a synthetic user with a trade history for each of history_sizes (trades per user), alternating FIFO and LIFO
+def seed_load_test_users(history_sizes, seed=0):
+    users = []
+    for index, size in enumerate(history_sizes):
+        user = create_synthetic_user(f'loadtest{ index }', accounting_method='LIFO' if index % 2 else 'FIFO')
+        if size:
+            seed_trade_history(user, size, seed=seed + index)
+        users.append(user)
+    return users
+
+
+# Makes requests (after 'warmup' untimed ones) as the users, picking a user and a route from mix (route -> weight) for
+# each. The app's own print() output is discarded, so the report stays readable.
+def run_load_test(users, requests=1000, mix=None, seed=0, warmup=20):
+    mix = mix or DEFAULT_LOADTEST_MIX
+    unknown = set(mix) - set(LOADTEST_ROUTES)
+    if unknown:
+        raise ValueError(f'Unknown load test routes: { ", ".join(sorted(unknown)) }')
+    rng = random.Random(seed)
+    sessions = [_Session(user, seed=rng.random()) for user in users]
+    routes, weights = list(mix), list(mix.values())
+    result = LoadTestResult(durations={route: [] for route in routes}, statuses={route: Counter() for route in routes})
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        made = 0
+        while made < warmup + requests:
+            session = rng.choice(sessions)
+            route = rng.choices(routes, weights)[0]
+            request = LOADTEST_ROUTES[route](session)
+            if request is None:
+                continue
+            method, path, data = request
+
+            request_start = time.perf_counter()
+            response = getattr(session.client, method)(path, data, secure=True)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            duration = time.perf_counter() - request_start
+
+            if made >= warmup:
+                result.durations[route].append(duration)
+                result.statuses[route][response.status_code] += 1
+            elif response.status_code >= 500:
+                result.warmup_errors[route] += 1
+            made += 1
+    result.elapsed = time.perf_counter() - start
+    logger.debug(f'running run_load_test() ... { result.requests } requests in { result.elapsed:.2f} s')
+    return result
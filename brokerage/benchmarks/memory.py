@@ -0,0 +1,30 @@
+import sys
+__all__ = ['deep_getsizeof']
+
+
+# Returns the memory taken by obj and everything it references, in bytes, counting shared objects (e.g. interned
+# strings, cached Decimals) once. Follows containers, instance __dict__s and __slots__; classes and modules are not
+# counted, as they are shared by every instance.
+def deep_getsizeof(obj):
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type) or type(obj).__name__ == 'module':
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            slots = getattr(cls, '__slots__', ())
+            for name in (slots,) if isinstance(slots, str) else slots:
+                if hasattr(obj, name) and name not in ('__dict__', '__weakref__'):
+                    stack.append(getattr(obj, name))
+    return total
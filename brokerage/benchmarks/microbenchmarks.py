@@ -0,0 +1,84 @@
+from decimal import Decimal
+from django.db import transaction
+from django.utils import timezone
+import random
+from ..helpers.helpers import process_sell
+from ..helpers.process_portfolio import build_portfolio_snapshot, process_user_transactions, value_portfolio
+from ..helpers.trade_import import Trade, import_trades
+from ..templatetags.brokerage_filters import filter_percentage, filter_usd, reformat_number, reformat_number_two_decimals
+from .fixtures import BENCHMARK_SYMBOLS, create_synthetic_user, seed_trade_history
+__all__ = ['filter_benchmarks', 'portfolio_benchmarks', 'sell_benchmarks']
+
+
+# Micro-benchmarks of the hot pure-Python paths, run by the microbench command. Each function sets up its data in the
+# (benchmark) database and yields (name, fn) pairs, where fn() is the call to time, for the names wanted(name) accepts
+# (by default, all); data only they would use is not set up. Names carry their parameters in brackets, e.g.
+# 'process_sell[LIFO,depth=10000,lots=100]', so they stay comparable across runs and baselines.
+# Prices come from FMP (in practice, from the FMP stub and the quote cache), as in the views.
+
+
+# process_user_transactions() over a synthetic history of each size, spread over two years so that open lots and sales
+# are a mix of short- and long-term, and its two halves: reading the snapshot from the DB, and valuing it
+def portfolio_benchmarks(sizes, seed=0, wanted=lambda name: True):
+    for size in sizes:
+        names = [f'{ name }[{ size }]' for name in ['process_user_transactions', 'build_portfolio_snapshot', 'value_portfolio']]
+        if not any(wanted(name) for name in names):
+            continue
+        user = create_synthetic_user(f'micro_portfolio_{ size }')
+        seed_trade_history(user, size, seed=seed)
+        snapshot = build_portfolio_snapshot(user)
+        fns = [lambda user=user: process_user_transactions(user), lambda user=user: build_portfolio_snapshot(user), lambda snapshot=snapshot: value_portfolio(snapshot)]
+        yield from ((name, fn) for name, fn in zip(names, fns) if wanted(name))
+
+
+# process_sell() for a FIFO and a LIFO user, each holding 'depth' open lots of 10 shares of one symbol, bought over the
+# last two years. Each sale fills 'lots' lots (the last one partly), and is rolled back, so every run sells from the
+# same stack.
+def sell_benchmarks(depth, fills, seed=0, wanted=lambda name: True):
+    rng = random.Random(seed)
+    symbol = 'AAPL'
+    now = timezone.now()
+    timestamps = sorted(now - timezone.timedelta(seconds=rng.randint(60, 730 * 86400)) for _ in range(depth))
+    for method in ['FIFO', 'LIFO']:
+        names = {lots: f'process_sell[{ method },depth={ depth },lots={ lots }]' for lots in fills}
+        names = {lots: name for lots, name in names.items() if wanted(name)}
+        if not names:
+            continue
+        user = create_synthetic_user(f'micro_sell_{ method.lower() }', accounting_method=method)
+        import_trades(
+            Trade(line, user.username, timestamp, 'BOT', symbol, 10, BENCHMARK_SYMBOLS[symbol] + rng.randint(-3000, 3000) / Decimal(100))
+            for line, timestamp in enumerate(timestamps, start=1)
+        )
+        for lots, name in names.items():
+            yield name, lambda user=user, shares=10 * lots - 5: _sell_and_roll_back(symbol, shares, user)
+
+
+def _sell_and_roll_back(symbol, shares, user):
+    with transaction.atomic():
+        process_sell(symbol, shares, user)
+        transaction.set_rollback(True)
+
+
+# The brokerage_filters template filters, each applied to 'count' values of the kinds the templates pass them:
+# Decimals, floats and ints, positive, negative and near zero
+def filter_benchmarks(count=1000, seed=0, wanted=lambda name: True):
+    rng = random.Random(seed)
+    values = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:
+            values.append(Decimal(rng.randint(-10**9, 10**9)) / 100)
+        elif kind < 0.8:
+            values.append(rng.uniform(-2, 2))
+        elif kind < 0.9:
+            values.append(rng.randint(-10**6, 10**6))
+        else:
+            values.append(rng.uniform(-0.006, 0.006))
+    for name, fn in [
+        ('filter_reformat_number', reformat_number),
+        ('filter_reformat_number_two_decimals', reformat_number_two_decimals),
+        ('filter_usd', filter_usd),
+        ('filter_percentage', filter_percentage),
+    ]:
+        if wanted(f'brokerage_filters.{ name }[{ count }]'):
+            yield f'brokerage_filters.{ name }[{ count }]', lambda fn=fn: [fn(value) for value in values]
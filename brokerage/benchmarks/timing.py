@@ -0,0 +1,48 @@
+import gc
+import statistics
+import time
+__all__ = ['percentile', 'summarize_timings', 'time_call']
+
+
+# Returns the p-th percentile (0-100) of a list of numbers, interpolating between the closest ranks
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+# Summarizes a list of durations (in seconds) as milliseconds
+def summarize_timings(durations):
+    return {
+        'runs': len(durations),
+        'min_ms': min(durations) * 1000 if durations else 0.0,
+        'mean_ms': statistics.fmean(durations) * 1000 if durations else 0.0,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p95_ms': percentile(durations, 95) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'max_ms': max(durations) * 1000 if durations else 0.0,
+    }
+
+
+# Calls fn() 'warmup' times untimed and then at least 'repeat' times timed, and for at least min_time seconds in all,
+# returning summarize_timings() of the timed runs. min_time makes a fast fn() run often enough for its quickest runs
+# to be the undisturbed ones. As in timeit, the garbage collector is paused while timing.
+def time_call(fn, repeat=20, warmup=2, min_time=0.0):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(durations) < repeat or sum(durations) < min_time:
+            start = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return summarize_timings(durations)
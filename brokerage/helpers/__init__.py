@@ -1,2 +1,4 @@
 from .process_portfolio import *
-from .helpers import * 
\ No newline at end of file
+from .helpers import *
+from .portfolio_cache import *
+from .transaction_history import *
\ No newline at end of file
@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+import logging
+import multiprocessing
+from ..models import OpenLot, Position
+from users.models import UserProfile
+from .helpers import company_data_multiple
+from .process_portfolio import OpenLotData, PositionData, complete_portfolio_snapshot, start_portfolio_snapshot, value_portfolio
+__all__ = ['fetch_portfolio_quotes', 'iter_portfolio_snapshots', 'revalue_all_portfolios']
+
+logger = logging.getLogger('django')
+
+
+# Revalues every user's portfolio in one job (for a leaderboard, an admin overview or an end-of-day snapshot), rather
+# than calling process_user_transactions() once per user with a DB round trip and an FMP call each:
+#   1. profiles, positions (which carry the totals of the users' sales) and open lots are each read in one query,
+#      streamed in user order and merged
+#   2. quotes for the union of all held symbols are fetched once, through the shared quote cache
+#   3. each user's snapshot is valued against those quotes, optionally across a pool of processes
+# The snapshots built here are the same as build_portfolio_snapshot()'s, so the portfolios are identical to what the
+# views show (at the same prices).
+
+
+# Rows (user_id, ...) in user_id order, handed out one user at a time
+class _RowsByUser:
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._next = next(self._rows, None)
+
+    # Returns the rows for user_id, without the user_id, skipping any for users before it (e.g. without a profile)
+    def take(self, user_id):
+        taken = []
+        while self._next is not None and self._next[0] <= user_id:
+            if self._next[0] == user_id:
+                taken.append(self._next[1:])
+            self._next = next(self._rows, None)
+        return taken
+
+
+# Yields (user_id, PortfolioSnapshot) for every user with a profile, or for user_ids only, in user_id order. Reads
+# each table in a single streamed query, so memory use is bounded by one user's history plus the fetch chunks.
+def iter_portfolio_snapshots(user_ids=None, chunk_size=None):
+    chunk_size = chunk_size or settings.PORTFOLIO_REVALUE_BATCH_SIZE
+    profiles = UserProfile.objects.only('user_id', 'cash', 'cash_initial', 'tax_loss_offsets', 'tax_rate_STCG', 'tax_rate_LTCG').order_by('user_id')
+    positions = Position.objects.order_by('user_id', 'symbol').values_list('user_id', *PositionData._fields)
+    open_lots = OpenLot.objects.order_by('user_id', 'pk').values_list('user_id', 'symbol', 'shares_outstanding', 'transaction_value_per_share', 'timestamp')
+    if user_ids is not None:
+        profiles, positions, open_lots = (queryset.filter(user_id__in=user_ids) for queryset in (profiles, positions, open_lots))
+
+    positions = _RowsByUser(positions.iterator(chunk_size=chunk_size))
+    open_lots = _RowsByUser(open_lots.iterator(chunk_size=chunk_size))
+    for user_profile in profiles.iterator(chunk_size=chunk_size):
+        user_id = user_profile.user_id
+        snapshot = start_portfolio_snapshot(user_profile, [PositionData(*row) for row in positions.take(user_id)])
+        user_open_lots = [OpenLotData(*row) for row in open_lots.take(user_id)]
+        # As in build_portfolio_snapshot(), lots and sales only matter while the user holds shares
+        if snapshot.has_open_positions:
+            complete_portfolio_snapshot(snapshot, user_open_lots)
+        yield user_id, snapshot
+
+
+# Returns quotes (symbol -> FMP quote) for every symbol any of the users (or user_ids) has a position in. Symbols are
+# requested PORTFOLIO_REVALUE_QUOTE_BATCH_SIZE at a time, to keep FMP URLs to a sensible length.
+def fetch_portfolio_quotes(user_ids=None):
+    positions = Position.objects.all() if user_ids is None else Position.objects.filter(user_id__in=user_ids)
+    symbols = sorted(set(positions.values_list('symbol', flat=True)))
+    batch_size = settings.PORTFOLIO_REVALUE_QUOTE_BATCH_SIZE
+    quotes = {}
+    for start in range(0, len(symbols), batch_size):
+        quotes.update(company_data_multiple(','.join(symbols[start:start + batch_size])))
+    logger.debug(f'running fetch_portfolio_quotes() ... fetched quotes for { len(quotes) } of { len(symbols) } symbols')
+    return quotes
+
+
+# Set in each pool process by _init_worker()
+_worker_quotes = None
+_worker_now = None
+
+
+def _init_worker(quotes, now):
+    global _worker_quotes, _worker_now
+    _worker_quotes = quotes
+    _worker_now = now
+
+
+def _value_snapshot(item):
+    user_id, snapshot = item
+    return user_id, value_portfolio(snapshot, _worker_quotes, _worker_now)
+
+
+# Yields (user_id, Portfolio) for every user (or user_ids), valued at quotes (by default, fetched once for all of
+# them) as of now. With processes > 1, snapshots are valued in a pool of forked processes, a batch of users at a time,
+# while this process reads the next batch from the DB. The portfolios carry the totals of the users' sales, but not
+# the list of them (see get_portfolio()'s include_sales).
+def revalue_all_portfolios(user_ids=None, quotes=None, now=None, processes=None):
+    processes = processes or settings.PORTFOLIO_REVALUE_PROCESSES
+    now = now or timezone.now()
+    if quotes is None:
+        quotes = fetch_portfolio_quotes(user_ids)
+
+    if processes <= 1:
+        for user_id, snapshot in iter_portfolio_snapshots(user_ids):
+            yield user_id, value_portfolio(snapshot, quotes, now)
+        return
+
+    # Forked processes must not share this process's DB connections; this process reopens its own on the next query
+    connections.close_all()
+    batch_size = settings.PORTFOLIO_REVALUE_BATCH_SIZE
+    with multiprocessing.get_context('fork').Pool(processes, initializer=_init_worker, initargs=(quotes, now)) as pool:
+        pending = None
+        for batch in _batches(iter_portfolio_snapshots(user_ids), batch_size):
+            submitted = pool.map_async(_value_snapshot, batch, chunksize=max(1, len(batch) // processes))
+            if pending is not None:
+                yield from pending.get()
+            pending = submitted
+        if pending is not None:
+            yield from pending.get()
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
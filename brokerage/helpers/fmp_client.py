@@ -0,0 +1,142 @@
+from django.conf import settings
+import logging
+import os
+import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+__all__ = ['CircuitBreaker', 'FMPUnavailable', 'fmp_get', 'fmp_key', 'get_session']
+
+logger = logging.getLogger('django')
+
+
+# Defines key for FMP api
+fmp_key = os.getenv('FMP_API_KEY')
+
+# Responses with these status codes mean FMP is struggling, so the request is retried
+FMP_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Errors that mean the request may well succeed if made again: no connection, no answer in time, or a response cut off
+FMP_RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+# Raised when FMP cannot be reached (after retries) or the circuit breaker is open. Subclasses RequestException so
+# that existing 'except requests.RequestException' handlers keep working.
+class FMPUnavailable(requests.RequestException):
+    pass
+
+
+# Tracks consecutive FMP failures. After FMP_CIRCUIT_FAILURE_THRESHOLD failures in a row the circuit opens and
+# requests fail fast (callers fall back to cached/stale data) for FMP_CIRCUIT_RESET_TIMEOUT seconds. After that a
+# single trial request is let through; if it succeeds the circuit closes again, otherwise it re-opens.
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow_request(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                logger.error(f'running fmp_client ... circuit breaker opened after { self.failures } consecutive failures')
+
+
+breaker = CircuitBreaker(settings.FMP_CIRCUIT_FAILURE_THRESHOLD, settings.FMP_CIRCUIT_RESET_TIMEOUT)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+# Returns this worker's pooled, keep-alive session. The session is rebuilt after a fork (e.g. gunicorn spawning a
+# worker), as connection pools must not be shared between processes.
+def get_session():
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.FMP_POOL_MAXSIZE, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+
+# Seconds to sleep before retry number 'attempt' (0-based): exponential backoff with full jitter
+def _backoff(attempt):
+    return random.uniform(0, min(settings.FMP_BACKOFF_MAX, settings.FMP_BACKOFF_BASE * (2 ** attempt)))
+
+
+# GETs an FMP endpoint, e.g. fmp_get('quote/AAPL,MSFT'). Returns the response for anything FMP actually answered
+# (including 4xx errors, which callers inspect), or raises FMPUnavailable once retries are exhausted, on an error a
+# retry would not fix, or while the circuit breaker is open.
+def fmp_get(path, params=None, timeout=None, stream=False):
+    if not breaker.allow_request():
+        raise FMPUnavailable(f'FMP circuit breaker is open, skipping request for: { path }')
+
+    url = f'{settings.FMP_BASE_URL.rstrip("/")}/{path}'
+    params = {**(params or {}), 'apikey': fmp_key}
+    timeout = timeout or (settings.FMP_CONNECT_TIMEOUT, settings.FMP_READ_TIMEOUT)
+    last_error = None
+    succeeded = False
+
+    try:
+        for attempt in range(settings.FMP_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(_backoff(attempt - 1))
+            try:
+                response = get_session().get(url, params=params, timeout=timeout, stream=stream)
+                if response.status_code not in FMP_RETRY_STATUS_CODES:
+                    succeeded = True
+                    return response
+                last_error = f'status code { response.status_code }'
+                response.close()
+            except FMP_RETRY_EXCEPTIONS as e:
+                last_error = e
+            # Anything else requests raises (too many redirects, an invalid URL, an undecodable body) would fail
+            # the same way again
+            except requests.RequestException as e:
+                last_error = e
+                break
+            logger.debug(f'running fmp_get() ... attempt { attempt + 1 } for: { path } failed with: { last_error }')
+
+        raise FMPUnavailable(f'FMP request for: { path } failed after { attempt + 1 } attempts: { last_error }')
+
+    # Every way out of the loop, including exceptions that are not requests' own, records the outcome. Otherwise a
+    # half-open circuit's trial request would never be released, and the circuit would stay open for good.
+    finally:
+        if succeeded:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
@@ -7,9 +7,18 @@ from django.db.models.functions import Length
 from django.utils import timezone
 import locale
 import logging
-from ..models import Listing, Transaction
+from ..models import Listing, OpenLot, Position, Transaction
+from .fmp_client import FMPUnavailable, fmp_get, fmp_key
+from .json_stream import iter_json_array
+from .listing_index import bump_listing_index_version, get_listing_index
+from .listing_search import LISTING_SEARCH_MIN_LENGTH, listing_search_available, listing_search_ids
+from .listings_sync import sync_listings
+from .lot_fills import fill_sale
 import os
+from .quote_cache import get_cached_quotes, get_stale_quotes, set_cached_quotes
+from .realized_gains import REALIZED_FIELDS, add_sale, refresh_realized_tax
 import requests
+from .single_flight import single_flight
 from users.models import UserProfile
 logger = logging.getLogger('django')
 
@@ -19,20 +28,51 @@ __all__ = ['check_valid_shares', 'check_valid_symbol', 'company_data', 'company_
 # Pull company data via FMP API
 def company_data(symbol):
     logger.debug(f'running get_stock_info(symbol): ... symbol is: { symbol }')
-        
+
+    # Serve the profile from the shared quote cache where possible
+    hits, unknown, misses = get_cached_quotes('profile', [symbol])
+    if hits:
+        return next(iter(hits.values()))
+    if not misses:
+        logger.debug(f'running company_data(symbol): ... symbol: { symbol } is in the negative cache')
+        return None
+    symbol = misses[0]
+
+    # Concurrent requests for the same symbol share one upstream call. The result is passed around as
+    # {symbol: profile}, so a symbol another worker found to be unknown ({}) is a result too, not a reason to keep
+    # waiting and then call FMP again.
+    fetched_data_dict = single_flight(
+        f'profile_{symbol}',
+        lambda: {symbol: _fetch_company_data(symbol)},
+        recheck=lambda: _recheck_cached_quotes('profile', [symbol]),
+    )
+    return fetched_data_dict.get(symbol)
+
+
+# Requests a single company profile from FMP and stores the result in the quote cache
+def _fetch_company_data(symbol):
     try:
-        limit = 1
-        response = requests.get(f'https://financialmodelingprep.com/api/v3/profile/{symbol}?apikey={fmp_key}')       
+        response = fmp_get(f'profile/{symbol}')
         #increment_ping()
         logger.debug(f'running company_data(symbol): ... response is: { response }')
         data = response.json()
         
         # Check if data contains at least one item
         if data and isinstance(data, list):
+            set_cached_quotes('profile', [symbol], {symbol: data[0]})
             return data[0]
+        # An empty list means FMP does not know the symbol, so it goes in the negative cache (error payloads do not)
+        elif response.status_code == 200 and isinstance(data, list):
+            set_cached_quotes('profile', [symbol], {})
+            return None
         else:
             return None
 
+    # FMP is down or the circuit breaker is open: fall back to the last profile we saw, however old
+    except FMPUnavailable as e:
+        logger.error(f'running company_data(symbol): ... FMP unavailable for symbol: { symbol }, serving stale data if cached. Error: { e }')
+        return get_stale_quotes('profile', [symbol]).get(symbol)
+
     except Exception as e:
         logger.debug(f'running company_data(symbol): ... function tried symbol: { symbol } but errored with error: { e }')
         return None
@@ -40,28 +80,55 @@ def company_data(symbol):
 
 def company_data_multiple(symbols):
     logger.debug(f'running get_stock_info(): ... symbols is: { symbols }')
-        
+
+    # Only the symbols missing from the shared quote cache are requested from FMP
+    symbol_data_dict, unknown, misses = get_cached_quotes('quote', symbols)
+    if not misses:
+        return symbol_data_dict
+
+    # Concurrent requests for the same set of symbols share one upstream call
+    fetched_data_dict = single_flight(
+        'quote_' + ','.join(sorted(misses)),
+        lambda: _fetch_company_data_multiple(misses),
+        recheck=lambda: _recheck_cached_quotes('quote', misses),
+    )
+    symbol_data_dict.update(fetched_data_dict or {})
+    return symbol_data_dict
+
+
+# Requests quotes for several symbols from FMP in one call and stores the results in the quote cache
+def _fetch_company_data_multiple(symbols):
+    symbols_string = ','.join(symbols)
     try:
-        limit = 1
-        response = requests.get(f'https://financialmodelingprep.com/api/v3/quote/{symbols}?apikey={fmp_key}')       
+        response = fmp_get(f'quote/{symbols_string}')
         #increment_ping()
         logger.debug(f'running company_data_multiple(): ... response is: { response }')
         data = response.json()
         # Convert list of dictionaries to a dictionary indexed by symbol
-        symbol_data_dict = {item['symbol']: item for item in data}
-        return symbol_data_dict
+        fetched_data_dict = {item['symbol']: item for item in data}
+        # Requested symbols absent from a successful response are unknown to FMP and go in the negative cache
+        if response.status_code == 200:
+            set_cached_quotes('quote', symbols, fetched_data_dict)
+        return fetched_data_dict
     
+    # FMP is down or the circuit breaker is open: fall back to the last quotes we saw, however old
     except requests.RequestException as e:
-        logger.error(f"Failed to fetch data for symbols {symbols_string}: {str(e)}")
-        return {}
+        logger.error(f"Failed to fetch data for symbols {symbols_string}, serving stale data if cached: {str(e)}")
+        return get_stale_quotes('quote', symbols)
         
     except Exception as e:
-        logger.debug(f'running company_data(symbol): ... function tried symbol: { symbol } but errored with error: { e }')
-        return None
+        logger.debug(f'running company_data_multiple(): ... function tried symbols: { symbols_string } but errored with error: { e }')
+        return {}
 
 
-# Defines key for FMP api
-fmp_key = os.getenv('FMP_API_KEY')
+# Used by single_flight() while another worker fetches the same symbols. Returns None until every symbol has
+# landed in the quote cache (as a quote or as unknown), then returns the cached quotes.
+def _recheck_cached_quotes(kind, symbols):
+    hits, unknown, misses = get_cached_quotes(kind, symbols, count=False)
+    if misses:
+        return None
+    return hits
+
 
 # Reformat argument as comma-separated number
 def reformat_number_format(value):
@@ -202,32 +269,11 @@ def check_valid_symbol(symbol):
     print(f'running check_valid_symbol ... symbol is: { symbol }')
 
     try:
-        # Determine the primary filter and ordering of results (limited to 5 items)
-        if len(symbol) < 5: # User input is likely a symbol
-
-            # Emulates 'ilike' using 'icontains' for case-insensitivity and annotates with a relevance score
-            listings = Listing.objects.filter(symbol__icontains=symbol).annotate(
-                relevance=Func(Length('symbol') - len(symbol), function='ABS')
-            ).order_by('relevance', Length('symbol'))[:5]
-
-        else: # User input is likely a company name (limited to 5 items)
-            listings = Listing.objects.filter(
-                Q(name__icontains=symbol) | Q(symbol__icontains=symbol)
-            ).annotate(
-                relevance=Case(
-                    When(name__icontains=symbol, then=Func(Length('name') - len(symbol), function='ABS')),
-                    default=Func(Length('symbol') - len(symbol), function='ABS')
-                )
-            ).order_by('relevance', Length('symbol'), Length('name'))[:5]
-
-        
-        data = [{
-            'symbol': listing.symbol, 
-            'name': listing.name, 
-            'exchange_short': listing.exchange_short
-            }
-            for listing in listings
-        ]
+        # Served from this worker's in-memory listing index (see listing_index.py) unless it is switched off
+        if settings.LISTING_INDEX_ENABLED:
+            data = get_listing_index().search(symbol)
+        else:
+            data = _search_listings_db(symbol)
         print(f'running check_valid_symbol ... data: { data }')
         
         if data:
@@ -241,6 +287,46 @@ def check_valid_symbol(symbol):
         return {'success': False, 'message': f'Error: { e }'}
 
 
+# Looks up the listings matching symbol in the database (limited to 5 items)
+def _search_listings_db(symbol):
+    # Candidate listings come from the full-text search index where possible (see listing_search.py)
+    use_search_index = len(symbol) >= LISTING_SEARCH_MIN_LENGTH and listing_search_available()
+
+    if len(symbol) < 5 and use_search_index: # User input is likely a symbol
+
+        # Annotates the matches with a relevance score
+        listings = Listing.objects.filter(pk__in=listing_search_ids(symbol)).annotate(
+            relevance=Func(Length('symbol') - len(symbol), function='ABS')
+        ).order_by('relevance', Length('symbol'))[:5]
+
+    elif len(symbol) < 5: # Input too short for the search index
+
+        # Every match contains the input, so the relevance score above reduces to the symbol's length. Ordering
+        # by length directly lets the database walk listing_symbol_length_idx and stop at the fifth match.
+        listings = Listing.objects.filter(symbol__icontains=symbol).order_by(Length('symbol'), 'id')[:5]
+
+    else: # User input is likely a company name (limited to 5 items)
+        if use_search_index:
+            matches = Q(pk__in=listing_search_ids(symbol, columns=('symbol', 'name')))
+        else:
+            # Emulates 'ilike' using 'icontains' for case-insensitivity
+            matches = Q(name__icontains=symbol) | Q(symbol__icontains=symbol)
+        listings = Listing.objects.filter(matches).annotate(
+            relevance=Case(
+                When(name__icontains=symbol, then=Func(Length('name') - len(symbol), function='ABS')),
+                default=Func(Length('symbol') - len(symbol), function='ABS')
+            )
+        ).order_by('relevance', Length('symbol'), Length('name'))[:5]
+
+    return [{
+        'symbol': listing.symbol, 
+        'name': listing.name, 
+        'exchange_short': listing.exchange_short
+        }
+        for listing in listings
+    ]
+
+
 # Process the purchase of shares
 def process_buy(symbol, shares, user, check_valid_shares_result):
     logger.debug(f'running brokerage app, process_purchase() ... function started')
@@ -268,6 +354,23 @@ def process_buy(symbol, shares, user, check_valid_shares_result):
                         shares_outstanding = shares,
                         )
         logger.debug(f'running brokerage app, process_purchase() ... new transaction added: { new_transaction }')
+
+        # Register the purchase as an open lot, available to fill future sales
+        OpenLot.objects.create(
+            user = user,
+            transaction = new_transaction,
+            symbol = symbol,
+            timestamp = new_transaction.timestamp,
+            shares_outstanding = shares,
+            transaction_value_per_share = transaction_value_per_share,
+        )
+
+        # Add the purchase to the user's running position in this symbol
+        position, created = Position.objects.select_for_update().get_or_create(user=user, symbol=symbol)
+        Position.objects.filter(pk=position.pk).update(
+            transaction_shares = F('transaction_shares') + shares,
+            shares_outstanding = F('shares_outstanding') + shares,
+        )
         
         # Update the user's cash balance
         user.userprofile.cash -= transaction_value_total
@@ -296,49 +399,42 @@ def process_sell(symbol, shares, user):
     tax_offset_coefficient = 1 if user_profile.tax_loss_offsets == 'On' else 0
     tax_rate_STCG = Decimal(user_profile.tax_rate_STCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
     tax_rate_LTCG = Decimal(user_profile.tax_rate_LTCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-    transactions = Transaction.objects.filter(user=user, symbol=symbol, type='BOT').order_by(
-        '-timestamp' if user_profile.accounting_method == 'LIFO' else 'timestamp'
-    )        
+    lots = OpenLot.objects.select_for_update().filter(user=user, symbol=symbol).order_by(
+        *(('-timestamp', '-pk') if user_profile.accounting_method == 'LIFO' else ('timestamp', 'pk'))
+    )
     print(f'running process_sell() ... user is { user }, shares is: { shares }')
     print(f'running process_sell() ... user is { user }, market_price_per_share is: { market_price_per_share }')
     print(f'running process_sell() ... user is { user }, cutoff_date is: { cutoff_date }')
     print(f'running process_sell() ... user is { user }, tax_offset_coefficient is: { tax_offset_coefficient }')
 
-    # Initialize capital gains variables that will be incremented later
-    STCG = Decimal('0.00')
-    STCG_tax = Decimal('0.00')
-    LTCG = Decimal('0.00')
-    LTCG_tax = Decimal('0.00')
-
-    
     # Start a database transaction
     with transaction.atomic(): # Ensures all changes or none is entered to DB
-        # Loop through each of the user's BOT transactions
-        for txn in transactions:    
-            # If txn has enough shares, fill the order
-            if txn.shares_outstanding > shares_to_fill:
-                txn.shares_outstanding -= shares_to_fill 
-                gain = (shares_to_fill * market_price_per_share) - (shares_to_fill * txn.transaction_value_per_share)
-                if txn.timestamp > cutoff_date:
-                    STCG += gain
-                    STCG_tax += gain * tax_rate_STCG  
-                else:
-                    LTCG += gain
-                    LTCG_tax += gain * tax_rate_LTCG
-                shares_to_fill = 0
-                txn.save()
-                print(f'running process_sell() ... user is { user }, sell order filled with transaction: { transaction }')
-                break
-            else:
-                # If the first BOT transaction wasn't big enough to fill sell order, then decrement shares_to_fill
-                shares_to_fill -= txn.shares_outstanding
-                txn.shares_outstanding = 0
-                txn.save()
+        # Fill the order from the user's open lots for this symbol. Lots are read in small chunks, so only the lots
+        # needed to fill the order are fetched.
+        fill = fill_sale(lots.iterator(chunk_size=20), shares, market_price_per_share, cutoff_date, tax_rate_STCG, tax_rate_LTCG)
+        STCG, LTCG, STCG_tax, LTCG_tax, closed_lots, partial_lot, shares_to_fill = fill
+        print(f'running process_sell() ... user is { user }, sell order filled with lots: { closed_lots + ([partial_lot] if partial_lot else []) }')
 
         # In case there are not enough shares to sell (unlikely due to prior back-end validation)
         if shares_to_fill > 0:
             raise Exception('Not enough shares to sell.')
 
+        # Write the fills: one bulk update of the BOT transactions touched, one delete for the sold-out lots and
+        # one update for the lot that was only partly sold
+        filled_lots = closed_lots + ([partial_lot] if partial_lot else [])
+        Transaction.objects.bulk_update(
+            [Transaction(pk=lot.transaction_id, shares_outstanding=lot.shares_outstanding) for lot in filled_lots],
+            ['shares_outstanding'],
+        )
+        OpenLot.objects.filter(pk__in=[lot.pk for lot in closed_lots]).delete()
+        if partial_lot:
+            partial_lot.save(update_fields=['shares_outstanding'])
+
+        # The user's running position in this symbol. Its realized tax is brought up to the user's current tax rates
+        # (if they changed since it was last worked out) before this sale is added to it.
+        position = Position.objects.select_for_update().get(user=user, symbol=symbol)
+        refresh_realized_tax(user.pk, [position], tax_rate_STCG, tax_rate_LTCG)
+
         # Que up the new transaction to be added to the transactions table (shares_outstanding is omitted because this is a sale)
         new_transaction = Transaction(
                         user = user,
@@ -355,6 +451,11 @@ def process_sell(symbol, shares, user):
         new_transaction.save()
         print(f'running process_sell() ... user is { user }, new_transaction is: { new_transaction } ')
 
+        # Remove the sold shares from the position, and add the sale to its realized totals
+        position.shares_outstanding -= shares
+        add_sale(position, new_transaction, tax_rate_STCG, tax_rate_LTCG)
+        position.save(update_fields=['shares_outstanding', *REALIZED_FIELDS])
+
         # Adjust cash and commit changes to DB
         print(f'running process_sell() ... user is { user }, user_profile.cash before deducting transaction_value_total is: { user_profile.cash } ')        
         user_profile.cash += new_transaction.transaction_value_total
@@ -363,31 +464,31 @@ def process_sell(symbol, shares, user):
     
         
 
-# Update the listings table in the DB
+# Update the listings table in the DB. Returns the counts of inserted, updated and removed rows (see listings_sync.py),
+# or None if the listings could not be fetched.
 def update_listings():
-    url = f'https://financialmodelingprep.com/api/v3/available-traded/list?apikey={fmp_key}'
     try:
-        response = requests.get(url)
+        # The full listings dump is large, so allow a longer read timeout than for quotes, and stream it rather than
+        # loading it into memory in one go
+        response = fmp_get('available-traded/list', timeout=(settings.FMP_CONNECT_TIMEOUT, settings.FMP_LISTINGS_READ_TIMEOUT), stream=True)
     
-        # If the response is not problematic, do the following..
-        if response.status_code == 200:
-            listings_data = response.json()
-            with transaction.atomic():  # ensures that all database operations are either fully completed or fully rolled back if an error occurs.
-                for item in listings_data:
-                    Listing.objects.update_or_create(
-                        symbol=item.get('symbol'),
-                        defaults={
-                            'name': item.get('name'),
-                            'price': item.get('price'),
-                            'exchange': item.get('exchange'),
-                            'exchange_short': item.get('exchangeShortName'),
-                            'listing_type': item.get('type')
-                        }
-                    )
-                logger.error('Updated Listings in DB')
-        # If response from FMP API is problematic
-        else:
-            logger.error('Failed to fetch data from API')
+        with response:
+            # If the response is not problematic, do the following..
+            if response.status_code == 200:
+                # Listings are parsed as they arrive and written in batches of LISTINGS_BATCH_SIZE
+                listings_data = iter_json_array(response.iter_content(chunk_size=settings.LISTINGS_STREAM_CHUNK_SIZE), encoding=response.encoding or 'utf-8')
+                with transaction.atomic():  # ensures that all database operations are either fully completed or fully rolled back if an error occurs.
+                    counts = sync_listings(listings_data)
+                    logger.error(f'Updated Listings in DB: { counts }')
+                # Workers rebuild their autocomplete index from the committed listings
+                bump_listing_index_version()
+                return counts
+            # If response from FMP API is problematic
+            else:
+                logger.error('Failed to fetch data from API')
     # Catch-all if the try above fails
     except requests.RequestException as e:
         logger.error(f'Error fetching data from API: {e}')
+    # The payload was not a JSON array, or was cut off part-way through; the transaction above has been rolled back
+    except ValueError as e:
+        logger.error(f'Error parsing listings from API: {e}')
@@ -0,0 +1,75 @@
+import codecs
+import json
+__all__ = ['iter_json_array']
+
+
+WHITESPACE = ' \t\n\r'
+
+
+# Yields the items of a JSON array one at a time from an iterable of byte chunks (e.g. a streamed response's
+# iter_content()), so that only the unparsed tail of the payload and the current item are ever held in memory.
+# Raises ValueError if the payload is not a JSON array or is cut off part-way through. Anything after the closing
+# bracket is ignored.
+def iter_json_array(chunks, encoding='utf-8'):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    buffer = ''
+    pos = 0
+    state = 'start' # start -> first (first item or ']') -> item -> separator (',' or ']') -> item ... -> end
+    chunks = iter(chunks)
+    exhausted = False
+
+    while state != 'end':
+        # Skip whitespace; top up the buffer whenever it runs dry
+        while pos < len(buffer) and buffer[pos] in WHITESPACE:
+            pos += 1
+        if pos == len(buffer):
+            if exhausted:
+                raise ValueError('JSON array ended unexpectedly')
+            buffer = ''
+            pos = 0
+            try:
+                buffer = text_decoder.decode(next(chunks))
+            except StopIteration:
+                buffer = text_decoder.decode(b'', final=True)
+                exhausted = True
+            continue
+
+        char = buffer[pos]
+        if state == 'start':
+            if char != '[':
+                raise ValueError(f'Expected a JSON array, got: { buffer[pos:pos + 80]!r}')
+            pos += 1
+            state = 'first'
+        elif state == 'separator' or (state == 'first' and char == ']'):
+            if char == ']':
+                state = 'end'
+            elif char == ',':
+                state = 'item'
+            else:
+                raise ValueError(f'Expected "," or "]" in JSON array, got: { buffer[pos:pos + 80]!r}')
+            pos += 1
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                following = end
+                while following < len(buffer) and buffer[following] in WHITESPACE:
+                    following += 1
+            except json.JSONDecodeError:
+                item, end = None, None
+            # An item that fails to parse, or that is not yet followed by ',' or ']' (e.g. a number that may have more
+            # digits to come), is retried once more data has arrived
+            if end is None or (not exhausted and (following == len(buffer) or buffer[following] not in ',]')):
+                if exhausted:
+                    raise ValueError(f'Invalid or truncated JSON array item: { buffer[pos:pos + 80]!r}')
+                buffer = buffer[pos:]
+                pos = 0
+                try:
+                    buffer += text_decoder.decode(next(chunks))
+                except StopIteration:
+                    buffer += text_decoder.decode(b'', final=True)
+                    exhausted = True
+                continue
+            yield item
+            pos = end
+            state = 'separator'
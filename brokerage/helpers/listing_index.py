@@ -0,0 +1,182 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from django.conf import settings
+from django.core.cache import cache
+import heapq
+import logging
+from ..models import Listing
+import sys
+import threading
+import time
+import uuid
+__all__ = ['ListingIndex', 'bump_listing_index_version', 'get_listing_index', 'warm_listing_index']
+
+logger = logging.getLogger('django')
+
+
+# In-process autocomplete index over Listing, so that check_valid_symbol can answer without a database query.
+# Each worker builds its own copy on first use (or at start-up, see wsgi.py) and rebuilds it when update_listings
+# bumps the shared version key, which workers check at most every LISTING_INDEX_CHECK_INTERVAL seconds.
+# Symbols are matched anywhere (as with the icontains query the index replaces), company names at the start of any
+# word (e.g. 'inc' matches 'Apple Inc.' but 'ple' does not). Results are ordered as check_valid_symbol orders them,
+# with ties broken by Listing id.
+LISTING_INDEX_VERSION_KEY = 'listing_index_version'
+
+# Suffix positions are packed next to the listing's position as (listing << 8 | offset), which caps the indexed
+# part of each text at 256 characters (Listing.name is at most 100)
+OFFSET_BITS = 8
+MAX_OFFSET = (1 << OFFSET_BITS) - 1
+
+
+# Sorted suffixes of a list of texts, bucketed by text length. A substring search is a binary search for the range of
+# suffixes starting with the query, and the buckets let callers visit the shortest texts first and stop early.
+# Only the packed (listing, offset) positions are kept once the index is built, not the suffix strings themselves.
+class _SuffixIndex:
+    def __init__(self, texts, word_starts_only=False):
+        self.texts = texts
+        buckets = {}
+        for i, text in enumerate(texts):
+            for offset in range(min(len(text), MAX_OFFSET + 1)):
+                if word_starts_only and offset and text[offset - 1].isalnum():
+                    continue
+                buckets.setdefault(len(text), []).append((text[offset:], i << OFFSET_BITS | offset))
+        self.buckets = {
+            length: array('Q', (position for _, position in sorted(buckets[length])))
+            for length in sorted(buckets)
+        }
+
+    def __len__(self):
+        return sum(len(positions) for positions in self.buckets.values())
+
+    # Yields (text length, set of listing positions) for each bucket with texts containing query, shortest first
+    def matches(self, query):
+        texts = self.texts
+        size = len(query)
+        key = lambda position: texts[position >> OFFSET_BITS][(position & MAX_OFFSET):(position & MAX_OFFSET) + size]
+        for length, positions in self.buckets.items():
+            if length < size:
+                continue
+            lo = bisect_left(positions, query, key=key)
+            hi = bisect_right(positions, query, lo=lo, key=key)
+            if lo < hi:
+                yield length, {position >> OFFSET_BITS for position in positions[lo:hi]}
+
+
+class ListingIndex:
+    # listings is an iterable of (symbol, name, exchange_short) tuples, in Listing id order
+    def __init__(self, listings):
+        self.symbols = []
+        self.names = []
+        self.exchanges = []
+        for symbol, name, exchange_short in listings:
+            self.symbols.append(symbol)
+            self.names.append(name)
+            # Only a handful of distinct exchanges exist, so share one string object per exchange
+            self.exchanges.append(sys.intern(exchange_short) if exchange_short else exchange_short)
+        self.lower_symbols = [(symbol or '').lower() for symbol in self.symbols]
+        self.lower_names = [(name or '').lower() for name in self.names]
+        self.symbol_index = _SuffixIndex(self.lower_symbols)
+        self.name_index = _SuffixIndex(self.lower_names, word_starts_only=True)
+
+    @classmethod
+    def from_db(cls):
+        started = time.monotonic()
+        index = cls(Listing.objects.order_by('id').values_list('symbol', 'name', 'exchange_short').iterator(chunk_size=5000))
+        logger.debug(f'running ListingIndex.from_db() ... indexed { len(index) } listings ({ len(index.symbol_index) } symbol and { len(index.name_index) } name suffixes) in { time.monotonic() - started:.2f}s')
+        return index
+
+    def __len__(self):
+        return len(self.symbols)
+
+    # Returns up to limit listings matching query as [{'symbol': ..., 'name': ..., 'exchange_short': ...}, ...]
+    def search(self, query, limit=5):
+        query = query.lower()
+        if len(query) < 5:
+            positions = self._search_symbols(query, limit)
+        else:
+            positions = self._search_names(query, limit)
+        return [
+            {'symbol': self.symbols[i], 'name': self.names[i], 'exchange_short': self.exchanges[i]}
+            for i in positions
+        ]
+
+    # Input that is likely a symbol: the shortest symbols containing it
+    def _search_symbols(self, query, limit):
+        positions = []
+        for _, matches in self.symbol_index.matches(query):
+            positions.extend(heapq.nsmallest(limit - len(positions), matches))
+            if len(positions) >= limit:
+                break
+        return positions
+
+    # Input that is likely a company name: listings whose name or symbol contains it, ranked by how close the length
+    # of the matching name (or failing that, symbol) is to the input
+    def _search_names(self, query, limit):
+        size = len(query)
+        ranked = {}
+        # Symbols of 5+ characters are rare, so all symbol matches are ranked
+        for _, matches in self.symbol_index.matches(query):
+            for i in matches:
+                matched = self.lower_names[i] if query in self.lower_names[i] else self.lower_symbols[i]
+                ranked[i] = (len(matched) - size, len(self.lower_symbols[i]), len(self.lower_names[i]), i)
+        # Name matches are visited shortest name first, until no remaining name can outrank the current top results
+        for length, matches in self.name_index.matches(query):
+            if len(ranked) >= limit and length - size > heapq.nsmallest(limit, ranked.values())[-1][0]:
+                break
+            for i in matches:
+                ranked[i] = (length - size, len(self.lower_symbols[i]), length, i)
+        return [key[-1] for key in heapq.nsmallest(limit, ranked.values())]
+
+
+_index = None
+_index_version = None
+_checked_at = None
+_build_lock = threading.Lock()
+
+
+# Returns the version of the listings data all workers should be serving, creating one if the cache has none
+def _current_version():
+    version = cache.get(LISTING_INDEX_VERSION_KEY)
+    if version is None:
+        cache.add(LISTING_INDEX_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(LISTING_INDEX_VERSION_KEY)
+    return version
+
+
+# Returns this worker's listing index, (re)building it if it is missing or out of date. While one thread rebuilds,
+# the others keep serving the previous index rather than waiting.
+def get_listing_index():
+    global _index, _index_version, _checked_at
+    now = time.monotonic()
+    if _index is not None and now - _checked_at < settings.LISTING_INDEX_CHECK_INTERVAL:
+        return _index
+
+    version = _current_version()
+    _checked_at = now
+    if _index is not None and version == _index_version:
+        return _index
+
+    if not _build_lock.acquire(blocking=_index is None):
+        return _index
+    try:
+        if _index is None or version != _index_version:
+            _index = ListingIndex.from_db()
+            _index_version = version
+    finally:
+        _build_lock.release()
+    return _index
+
+
+# Tells every worker to rebuild its index. Called by update_listings once its changes are committed.
+def bump_listing_index_version():
+    cache.set(LISTING_INDEX_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+# Builds the index in the background, so that a worker's first autocomplete request does not pay for it
+def warm_listing_index():
+    def warm():
+        try:
+            get_listing_index()
+        except Exception as e:
+            logger.error(f'running warm_listing_index() ... failed to build the listing index: { e }')
+    threading.Thread(target=warm, name='warm_listing_index', daemon=True).start()
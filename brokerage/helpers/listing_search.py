@@ -0,0 +1,36 @@
+from django.db import connection
+from django.db.models.expressions import RawSQL
+import logging
+__all__ = ['LISTING_SEARCH_MIN_LENGTH', 'listing_search_available', 'listing_search_ids']
+
+logger = logging.getLogger('django')
+
+
+# Substring searches over Listing go through the brokerage_listing_search FTS5 trigram index (created by migration
+# 0008 on SQLite), rather than a LIKE '%...%' scan of the whole table. Trigrams need at least 3 characters, so
+# shorter inputs (and databases without the index) are left to the ORM.
+LISTING_SEARCH_TABLE = 'brokerage_listing_search'
+LISTING_SEARCH_MIN_LENGTH = 3
+
+_available = {}
+
+
+# Returns True if the search index exists in the current database. Checked once per database, as the answer only
+# changes when migrations run.
+def listing_search_available():
+    key = (connection.alias, connection.settings_dict['NAME'])
+    if key not in _available:
+        _available[key] = connection.vendor == 'sqlite' and LISTING_SEARCH_TABLE in connection.introspection.table_names()
+        logger.debug(f'running listing_search_available() ... search index available: { _available[key] }')
+    return _available[key]
+
+
+# Returns a subquery of the ids of listings whose columns (any of 'symbol', 'name') contain query, case-insensitively,
+# for use as Listing.objects.filter(pk__in=listing_search_ids(...)). The query is matched as a quoted FTS5 phrase,
+# which for the trigram tokenizer is a plain substring match.
+def listing_search_ids(query, columns=('symbol',)):
+    phrase = '"' + query.replace('"', '""') + '"'
+    return RawSQL(
+        f'SELECT rowid FROM { LISTING_SEARCH_TABLE } WHERE { LISTING_SEARCH_TABLE } MATCH %s',
+        ('{' + ' '.join(columns) + '}: ' + phrase,),
+    )
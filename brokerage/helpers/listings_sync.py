@@ -0,0 +1,112 @@
+from decimal import Decimal
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from itertools import islice
+import logging
+from ..models import Listing
+__all__ = ['ListingsSync', 'sync_listings']
+
+logger = logging.getLogger('django')
+
+
+# Maps Listing fields to the keys of an item in FMP's available-traded/list payload
+LISTING_FIELDS = {
+    'name': 'name',
+    'price': 'price',
+    'exchange': 'exchange',
+    'exchange_short': 'exchangeShortName',
+    'listing_type': 'type',
+}
+
+
+# Brings the Listing table in line with FMP's listings in bulk: the existing listings are loaded once and diffed
+# against the payload by symbol, then the differences are written with chunked bulk_create/bulk_update, and listings
+# missing from the payload are deleted. Items can be fed in batches via apply(), so the payload never needs to be held
+# in memory at once; finish() then removes the delisted rows and returns the row counts.
+# Should run inside a transaction, so a failed refresh leaves the table as it was.
+class ListingsSync:
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.LISTINGS_BATCH_SIZE
+        self.counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'skipped': 0}
+        self.seen = set()
+        self.price_field = Listing._meta.get_field('price')
+        # symbol -> (pk, field values), for every listing in the table
+        self.existing = {
+            row[1]: (row[0], row[2:])
+            for row in Listing.objects.filter(symbol__isnull=False).values_list('pk', 'symbol', *LISTING_FIELDS).iterator(chunk_size=5000)
+        }
+        self.existing_count = len(self.existing)
+
+    # Returns the item's field values in the form they come back from the database, so they can be compared
+    def _values(self, item):
+        values = [item.get(key) for key in LISTING_FIELDS.values()]
+        price = values[1]
+        if price is not None:
+            try:
+                values[1] = self.price_field.to_python(price).quantize(Decimal('0.01'))
+            except ValidationError:
+                values[1] = None
+        return tuple(values)
+
+    # Diffs a batch of FMP listing items against the table and writes the inserts and updates
+    def apply(self, items):
+        # Later items for a symbol win, as they did with update_or_create
+        batch = {}
+        for item in items:
+            symbol = item.get('symbol')
+            if symbol:
+                batch[symbol] = self._values(item)
+            else:
+                self.counts['skipped'] += 1
+
+        to_create = []
+        to_update = {} # changed fields -> listings, so each UPDATE only sets what changed (usually just the price)
+        for symbol, values in batch.items():
+            self.seen.add(symbol)
+            current = self.existing.get(symbol)
+            if current is None:
+                to_create.append(Listing(symbol=symbol, **dict(zip(LISTING_FIELDS, values))))
+            elif current[1] != values:
+                changed = tuple(field for i, field in enumerate(LISTING_FIELDS) if current[1] is None or current[1][i] != values[i])
+                to_update.setdefault(changed, []).append(Listing(pk=current[0], symbol=symbol, **dict(zip(LISTING_FIELDS, values))))
+            else:
+                self.counts['unchanged'] += 1
+
+        if to_create:
+            Listing.objects.bulk_create(to_create, batch_size=self.batch_size)
+        # bulk_update builds a CASE per field over the whole batch, which gets quadratically slower with the batch
+        # size, so updates go in smaller batches than inserts
+        for changed, listings in to_update.items():
+            Listing.objects.bulk_update(listings, changed, batch_size=settings.LISTINGS_UPDATE_BATCH_SIZE)
+            self.counts['updated'] += len(listings)
+        self.counts['inserted'] += len(to_create)
+
+        # Remember the rows just written, so a symbol repeated in a later batch overwrites them. Their values are not
+        # kept, so memory does not grow with the payload; a repeated symbol is simply rewritten in full.
+        for listing in to_create + [listing for listings in to_update.values() for listing in listings]:
+            if listing.pk is not None:
+                self.existing[listing.symbol] = (listing.pk, None)
+
+    # Deletes the listings FMP no longer lists and returns the counts of inserted, updated, unchanged, removed and
+    # skipped (symbol-less) items. As a guard against a truncated payload wiping the table, nothing is deleted if
+    # more than LISTINGS_MAX_REMOVED_FRACTION of the existing listings would go.
+    def finish(self):
+        delisted = [pk for symbol, (pk, _) in self.existing.items() if symbol not in self.seen]
+        if delisted and len(delisted) > settings.LISTINGS_MAX_REMOVED_FRACTION * self.existing_count:
+            logger.error(f'running ListingsSync.finish() ... { len(delisted) } of { self.existing_count } listings are missing from the payload, not deleting them')
+            delisted = []
+        for start in range(0, len(delisted), self.batch_size):
+            Listing.objects.filter(pk__in=delisted[start:start + self.batch_size]).delete()
+        self.counts['removed'] = len(delisted)
+        logger.debug(f'running ListingsSync.finish() ... counts: { self.counts }')
+        return self.counts
+
+
+# Syncs the Listing table with a complete set of FMP listing items and returns the row counts (see ListingsSync).
+# items can be any iterable, e.g. a generator parsing a streamed response; it is consumed batch_size items at a time.
+def sync_listings(items, batch_size=None):
+    sync = ListingsSync(batch_size=batch_size)
+    items = iter(items)
+    while batch := list(islice(items, sync.batch_size)):
+        sync.apply(batch)
+    return sync.finish()
@@ -0,0 +1,55 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_EVEN
+__all__ = ['fill_sale', 'SaleFill']
+
+
+# The outcome of filling a sale from open lots (see fill_sale())
+SaleFill = namedtuple('SaleFill', ['STCG', 'LTCG', 'STCG_tax', 'LTCG_tax', 'closed_lots', 'partial_lot', 'shares_unfilled'])
+
+
+# Fills a sale of shares at price_per_share from lots, which must come in the order the user's accounting method sells
+# them: oldest first for FIFO, newest first for LIFO. Lots are anything with shares_outstanding,
+# transaction_value_per_share and timestamp (OpenLot rows, or the lots of a trade replay held in memory); they are only
+# read as far as needed to fill the sale, and their shares_outstanding is reduced in place, for the caller to save.
+# Gains on lots bought after cutoff_date (one year before the sale) are short-term, the rest long-term. Taxes are
+# rounded to the cent as the DB stores them (half to even, as Django does), so the Position totals added up from the
+# returned values match the saved sale (see realized_gains.py). Used by process_sell and by import_trades, so a
+# replayed sale is filled exactly as a live one.
+# The gain of every lot the sale fills is counted. process_sell used to count only the gain on the lot a sale left
+# partly filled, dropping those on lots it sold out. SLD rows written then keep the figures they were recorded with:
+# which lots a sale consumed depends on the accounting method and the sales before it, and the taxes on the tax rates,
+# as they were at the time, and neither is recorded, so the rows cannot be reliably reworked.
+def fill_sale(lots, shares, price_per_share, cutoff_date, tax_rate_STCG, tax_rate_LTCG):
+    shares_to_fill = shares
+
+    # Initialize capital gains variables that will be incremented later
+    STCG = Decimal('0.00')
+    STCG_tax = Decimal('0.00')
+    LTCG = Decimal('0.00')
+    LTCG_tax = Decimal('0.00')
+    closed_lots = []
+    partial_lot = None
+
+    for lot in lots:
+        # Take as many shares as the lot has, or as the order still needs
+        filled = min(lot.shares_outstanding, shares_to_fill)
+        gain = (filled * price_per_share) - (filled * lot.transaction_value_per_share)
+        if lot.timestamp > cutoff_date:
+            STCG += gain
+            STCG_tax += gain * tax_rate_STCG
+        else:
+            LTCG += gain
+            LTCG_tax += gain * tax_rate_LTCG
+        lot.shares_outstanding -= filled
+        shares_to_fill -= filled
+
+        # A lot with shares left over is the last one the order needs
+        if lot.shares_outstanding:
+            partial_lot = lot
+        else:
+            closed_lots.append(lot)
+        if shares_to_fill == 0:
+            break
+
+    cent = Decimal('0.01')
+    return SaleFill(STCG, LTCG, STCG_tax.quantize(cent, rounding=ROUND_HALF_EVEN), LTCG_tax.quantize(cent, rounding=ROUND_HALF_EVEN), closed_lots, partial_lot, shares_to_fill)
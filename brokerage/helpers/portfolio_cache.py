@@ -0,0 +1,125 @@
+from django.conf import settings
+from django.core.cache import cache
+import logging
+import math
+import random
+import time
+__all__ = ['get_or_set_portfolio_snapshot', 'invalidate_portfolio']
+
+logger = logging.getLogger('django')
+
+
+# Only the price-independent portfolio snapshot is cached (see build_portfolio_snapshot); it is valued at current
+# prices on every request, so a price change never invalidates anything here. Cached snapshots are keyed by a per-user
+# version number, bumped whenever the user's transactions or profile change (see brokerage/signals.py). A bump makes
+# every key built from the old version unreachable, so views never need to refresh or delete cached snapshots
+# themselves; superseded entries simply age out.
+# Within a version, a snapshot is fresh for PORTFOLIO_SNAPSHOT_TIMEOUT seconds and then kept, stale, for another
+# PORTFOLIO_SNAPSHOT_STALE_TIMEOUT seconds. A stale snapshot is rebuilt by one request while the others carry on
+# serving it (stale-while-revalidate).
+def _user_version_key(user_id):
+    return f'portfolio_version_{user_id}'
+
+
+# Returns the current value of a version key. A missing (new or evicted) version starts from the current time in
+# nanoseconds, so it can never restart at a number that an older cached snapshot was stored under.
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The version was never set or has been evicted; starting afresh also moves it past every older version
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+# Snapshots pickle as bare field tuples, so the key also names their layout: bump it when PortfolioSnapshot's fields
+# change, so snapshots cached by the previous release are never read back into the new class
+SNAPSHOT_LAYOUT = 2
+
+
+def _snapshot_cache_key(user_id):
+    return f'portfolio_snapshot_v{ SNAPSHOT_LAYOUT }_{user_id}_{ _get_version(_user_version_key(user_id)) }'
+
+
+# How often a request waiting on another request's snapshot build checks whether it has finished
+PORTFOLIO_BUILD_POLL_INTERVAL = 0.05
+
+
+# Returns True if a cached entry should be rebuilt now. Rather than all expiring at once, entries are refreshed early
+# with a probability that rises as expiry nears, and faster for snapshots that were slow to build (the "XFetch"
+# early-expiration scheme), so a refresh usually happens before anyone can see the entry as stale.
+def _needs_refresh(entry):
+    early = entry['build_time'] * settings.PORTFOLIO_EARLY_REFRESH_BETA * -math.log(1.0 - random.random())
+    return time.time() + early >= entry['expires_at']
+
+
+# Builds the snapshot and caches it, along with when it goes stale and how long it took to build
+def _build_and_set(user, build, cache_key):
+    started = time.monotonic()
+    snapshot = build(user)
+    cache.set(cache_key, {
+        'snapshot': snapshot,
+        'expires_at': time.time() + settings.PORTFOLIO_SNAPSHOT_TIMEOUT,
+        'build_time': time.monotonic() - started,
+    }, timeout=settings.PORTFOLIO_SNAPSHOT_TIMEOUT + settings.PORTFOLIO_SNAPSHOT_STALE_TIMEOUT)
+    return snapshot
+
+
+# Returns the user's cached portfolio snapshot, building it with build(user) and caching it if there is no up-to-date
+# one. The key is fixed before building, so a snapshot built from data that changes mid-build is stored under the
+# superseded version and never served.
+# Only one request builds a given snapshot at a time, under a build lock that expires after
+# PORTFOLIO_BUILD_LOCK_TIMEOUT seconds so a crashed builder cannot hold it forever. While a stale snapshot is being
+# rebuilt, other requests are served the stale one. With nothing cached (a new version, or after eviction), they wait
+# up to PORTFOLIO_BUILD_WAIT seconds for the build to finish, and only build it themselves if it has still not
+# appeared (e.g. the builder died).
+def get_or_set_portfolio_snapshot(user, build):
+    cache_key = _snapshot_cache_key(user.pk)
+    lock_key = f'{cache_key}_lock'
+    entry = cache.get(cache_key)
+
+    if entry is not None:
+        if not _needs_refresh(entry):
+            return entry['snapshot']
+        if not cache.add(lock_key, True, timeout=settings.PORTFOLIO_BUILD_LOCK_TIMEOUT):
+            # Someone else is already rebuilding it
+            return entry['snapshot']
+        logger.debug(f'running get_or_set_portfolio_snapshot() ... refreshing stale snapshot: { cache_key }')
+        try:
+            return _build_and_set(user, build, cache_key)
+        finally:
+            cache.delete(lock_key)
+
+    deadline = time.monotonic() + settings.PORTFOLIO_BUILD_WAIT
+    locked = cache.add(lock_key, True, timeout=settings.PORTFOLIO_BUILD_LOCK_TIMEOUT)
+    while not locked and time.monotonic() < deadline:
+        time.sleep(PORTFOLIO_BUILD_POLL_INTERVAL)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return entry['snapshot']
+        locked = cache.add(lock_key, True, timeout=settings.PORTFOLIO_BUILD_LOCK_TIMEOUT)
+    if not locked:
+        logger.warning(f'running get_or_set_portfolio_snapshot() ... gave up waiting for another build of: { cache_key }')
+
+    try:
+        # Another request may have finished its build between the first lookup and taking the lock
+        entry = cache.get(cache_key) if locked else None
+        if entry is not None:
+            return entry['snapshot']
+        return _build_and_set(user, build, cache_key)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+
+
+# Makes the user's cached snapshot unreachable, e.g. after a trade or a change to their tax settings
+def invalidate_portfolio(user_id):
+    logger.debug(f'running invalidate_portfolio() ... invalidating cached portfolio for user: { user_id }')
+    _bump_version(_user_version_key(user_id))
@@ -0,0 +1,35 @@
+from django.core.cache.backends.redis import RedisSerializer
+import pickle
+import zlib
+__all__ = ['PortfolioSerializer']
+
+
+# Cache serializer for the shared cache backends (see CACHES in settings.py), sized for what this app caches most:
+# portfolio snapshots. The snapshot classes already pickle as bare field-value tuples (see process_portfolio.py);
+# what remains is dominated by the repeated Decimals, symbols and timestamps of a user's sales, so larger payloads are
+# zlib-compressed. Ints are left as they are, so the Redis backend can still INCR cache versions.
+class PortfolioSerializer(RedisSerializer):
+    # Leading byte marking how the rest of a payload is encoded
+    PICKLED = b'p'
+    COMPRESSED = b'z'
+    COMPRESS_MIN_LENGTH = 1024
+    COMPRESS_LEVEL = 1
+
+    def dumps(self, obj):
+        if type(obj) is int:
+            return obj
+        data = pickle.dumps(obj, self.protocol)
+        if len(data) >= self.COMPRESS_MIN_LENGTH:
+            return self.COMPRESSED + zlib.compress(data, self.COMPRESS_LEVEL)
+        return self.PICKLED + data
+
+    def loads(self, data):
+        if isinstance(data, int):
+            return data
+        data = bytes(data)
+        if data[:1] == self.COMPRESSED:
+            return pickle.loads(zlib.decompress(data[1:]))
+        if data[:1] == self.PICKLED:
+            return pickle.loads(data[1:])
+        # Ints stored by the Redis backend come back as bytes
+        return int(data)
@@ -1,71 +1,121 @@
+from collections import namedtuple
+from dataclasses import dataclass, field
+from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
 from django.utils import timezone
 import logging
-from ..models import Listing, Transaction
+from ..models import Listing, OpenLot, Position, Transaction
 from users.models import UserProfile
 from .helpers import *
-__all__ = ['process_user_transactions', 'Portfolio']
+from .portfolio_cache import get_or_set_portfolio_snapshot
+from .realized_gains import REALIZED_FIELDS, realized_tax, realized_tax_by_symbol, realized_tax_is_stale
+from .valuation_engine import build_lot_columns, value_open_lots_vectorized
+__all__ = ['build_portfolio_snapshot', 'get_portfolio', 'process_user_transactions', 'Portfolio', 'PortfolioSnapshot', 'read_sell_transactions', 'SaleData', 'SymbolData', 'value_open_lots', 'value_portfolio']
 
 logger = logging.getLogger('django')
 
 
+# Per-symbol data for an open position, held in Portfolio.portfolio_data. Slotted, so each symbol costs a fixed
+# block of 18 references rather than a dict; item access (symbol_data['cost_basis_total']) still works, for code and
+# templates written against the dicts this replaced.
+@dataclass(slots=True)
+class SymbolData:
+    symbol: str
+    transaction_shares: Decimal = Decimal('0')
+    shares_outstanding: Decimal = Decimal('0')
+    cost_basis_per_share: Decimal = Decimal('0')
+    cost_basis_total: Decimal = Decimal('0')
+    market_value_per_share: Decimal = Decimal('0')
+    market_value_total_pre_tax: Decimal = Decimal('0')
+    gain_or_loss_pre_tax_percent: Decimal = Decimal('0')
+    STCG_unrealized: Decimal = Decimal('0')
+    LTCG_unrealized: Decimal = Decimal('0')
+    CG_total_unrealized: Decimal = Decimal('0')
+    STCG_tax_unrealized: Decimal = Decimal('0')
+    LTCG_tax_unrealized: Decimal = Decimal('0')
+    CG_tax_offset_unrealized: Decimal = Decimal('0')
+    CG_total_tax_unrealized: Decimal = Decimal('0')
+    CG_total_post_tax: Decimal = Decimal('0')
+    market_value_post_tax: Decimal = Decimal('0')
+    return_percent_post_tax: Decimal = Decimal('0')
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    # Pickles as the field values alone, in field order, rather than as a name -> value mapping
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+
 # Defines a class called portfolio, used for /index and /index_detail
+# Totals start as int 0 and become Decimal once added to; the sld_..._percent fields are "-" when nothing has been sold.
+@dataclass(slots=True, eq=False)
 class Portfolio:
-    def __init__(self):
-        # Below are portfolio totals
-        self.portfolio_data = {}
-        self.cash_initial = 0
-        self.cash = 0
-        self.portfolio_total_transaction_shares = 0
-        self.portfolio_total_shares_outstanding = 0
-        self.portfolio_cost_basis_total = 0
-        self.portfolio_cost_basis_per_share = 0
-        self.portfolio_STCG_unrealized = 0
-        self.portfolio_LTCG_unrealized = 0
-        self.portfolio_CG_unrealized = 0
-        self.portfolio_CG_total_unrealized = 0
-        self.portfolio_market_value_total_pre_tax = 0
-        self.portfolio_market_value_total_pre_tax_incl_cash = 0
-        self.portfolio_market_value_per_share = 0
-        self.portfolio_gain_or_loss_pre_tax_percent = 0
-        self.portfolio_STCG_tax_unrealized = 0
-        self.portfolio_LTCG_tax_unrealized = 0
-        self.portfolio_CG_tax_offset_unrealized = 0
-        self.portfolio_market_value_post_tax = 0
-        self.portfolio_market_value_post_tax_incl_cash = 0
-        self.portfolio_return_percent_post_tax = 0
-        self.cash_return_percent = 0
-    
-        # This metric holds the SLD transactions
-        self.sell_transactions = []
-
-        # Below are metrics for completed sales
-        self.sld_transaction_shares_total = 0
-        self.sld_transaction_cost_basis_total = 0
-        self.sld_transaction_STCG_total = 0
-        self.sld_transaction_LTCG_total = 0
-        self.sld_transaction_CG_total_realized_total = 0
-        self.sld_transaction_market_value_pre_tax_total = 0
-        self.sld_transaction_gain_or_loss_pre_tax_percent = 0
-        self.sld_transaction_STCG_tax_total = 0
-        self.sld_transaction_LTCG_tax_total = 0
-        self.sld_transaction_tax_offset_total = 0
-        self.sld_transaction_market_value_post_tax_total = 0
-        self.sld_transaction_return_percent_post_tax = 0
-
-        # Below are metrics for open portfolio+cash+sales
-        self.total_portfolio_transaction_shares = 0
-        self.total_portfolio_STCG = 0
-        self.total_portfolio_LTCG = 0
-        self.total_portfolio_CG = 0
-        self.total_portfolio_market_value_pre_tax = 0
-        self.total_portfolio_gain_or_loss_pre_tax_percent = 0
-        self.total_portfolio_STCG_tax = 0
-        self.total_portfolio_LTCG_tax = 0
-        self.total_portfolio_CG_tax_total = 0
-        self.total_portfolio_tax_offset = 0
-        self.total_portfolio_market_value_post_tax = 0
-        self.total_portfolio_market_value_post_tax_percent = 0
+    # Below are portfolio totals
+    portfolio_data: dict = field(default_factory=dict) # symbol -> SymbolData
+    cash_initial: Decimal = 0
+    cash: Decimal = 0
+    portfolio_total_transaction_shares: Decimal = 0
+    portfolio_total_shares_outstanding: Decimal = 0
+    portfolio_cost_basis_total: Decimal = 0
+    portfolio_cost_basis_per_share: Decimal = 0
+    portfolio_STCG_unrealized: Decimal = 0
+    portfolio_LTCG_unrealized: Decimal = 0
+    portfolio_CG_unrealized: Decimal = 0
+    portfolio_CG_total_unrealized: Decimal = 0
+    portfolio_market_value_total_pre_tax: Decimal = 0
+    portfolio_market_value_total_pre_tax_incl_cash: Decimal = 0
+    portfolio_market_value_per_share: Decimal = 0
+    portfolio_gain_or_loss_pre_tax_percent: Decimal = 0
+    portfolio_STCG_tax_unrealized: Decimal = 0
+    portfolio_LTCG_tax_unrealized: Decimal = 0
+    portfolio_CG_tax_offset_unrealized: Decimal = 0
+    portfolio_total_tax_unrealized: Decimal = 0
+    portfolio_market_value_post_tax: Decimal = 0
+    portfolio_market_value_post_tax_incl_cash: Decimal = 0
+    portfolio_return_percent_post_tax: Decimal = 0
+    cash_return_percent: Decimal = 0
+
+    # This metric holds the SLD transactions. Only /index_detail lists them, so only get_portfolio(include_sales=True)
+    # reads them; the totals below come from the positions.
+    sell_transactions: list = field(default_factory=list) # of SaleData
+
+    # Below are metrics for completed sales
+    sld_transaction_shares_total: Decimal = 0
+    sld_transaction_cost_basis_total: Decimal = 0
+    sld_transaction_STCG_total: Decimal = 0
+    sld_transaction_LTCG_total: Decimal = 0
+    sld_transaction_CG_total_realized_total: Decimal = 0
+    sld_transaction_market_value_pre_tax_total: Decimal = 0
+    sld_transaction_gain_or_loss_pre_tax_percent: Decimal | str = 0
+    sld_transaction_STCG_tax_total: Decimal = 0
+    sld_transaction_LTCG_tax_total: Decimal = 0
+    sld_transaction_tax_offset_total: Decimal = 0
+    sld_transaction_market_value_post_tax_total: Decimal = 0
+    sld_transaction_return_percent_post_tax: Decimal | str = 0
+
+    # Below are metrics for open portfolio+cash+sales
+    total_portfolio_transaction_shares: Decimal = 0
+    total_portfolio_STCG: Decimal = 0
+    total_portfolio_LTCG: Decimal = 0
+    total_portfolio_CG: Decimal = 0
+    total_portfolio_market_value_pre_tax: Decimal = 0
+    total_portfolio_gain_or_loss_pre_tax_percent: Decimal = 0
+    total_portfolio_STCG_tax: Decimal = 0
+    total_portfolio_LTCG_tax: Decimal = 0
+    total_portfolio_CG_tax_total: Decimal = 0
+    total_portfolio_tax_offset: Decimal = 0
+    total_portfolio_market_value_post_tax: Decimal = 0
+    total_portfolio_market_value_post_tax_percent: Decimal = 0
 
     # Adds the symbol to portfolio
     def add_symbol(self, symbol, data):
@@ -75,232 +125,413 @@ class Portfolio:
     def get_symbol_data(self, symbol):
         return self.portfolio_data.get(symbol, None)
 
+    # Pickles as the field values alone, in field order
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
 #----------------------------------------------------------------------------------------
 
+# The parts of a position and an open lot that the valuation needs. A position also carries the totals of the sales
+# of its symbol (see realized_gains.py); they default to none, for positions made up without any.
+PositionData = namedtuple('PositionData', ['symbol', 'transaction_shares', 'shares_outstanding', *REALIZED_FIELDS], defaults=[0] * 8 + [None, None])
+OpenLotData = namedtuple('OpenLotData', ['symbol', 'shares_outstanding', 'transaction_value_per_share', 'timestamp'])
+
+
+# A completed sale (SLD Transaction) as shown on /index_detail: the Transaction columns read from the DB, plus the
+# realized metrics read_sell_transactions works out. A slotted record rather than a model instance, as a user can
+# have thousands of sales and /index_detail lists all of them.
+@dataclass(slots=True, eq=False)
+class SaleData:
+    id: int
+    timestamp: datetime
+    type: str
+    symbol: str
+    transaction_shares: int
+    transaction_value_per_share: Decimal
+    transaction_value_total: Decimal
+    STCG: Decimal
+    LTCG: Decimal
+    STCG_tax: Decimal
+    LTCG_tax: Decimal
+    CG_total_realized: Decimal = None
+    cost_basis_total: Decimal = None
+    gain_or_loss_pre_tax_percent: Decimal = None
+    STCG_tax_realized: Decimal = None
+    LTCG_tax_realized: Decimal = None
+    CG_total_tax_realized: Decimal = None
+    CG_tax_offset_unrealized: Decimal = None
+    market_value_post_tax: Decimal = None
+    return_percent_post_tax: Decimal = None
+
+    # The Transaction columns, in the order above
+    COLUMNS = ('id', 'timestamp', 'type', 'symbol', 'transaction_shares', 'transaction_value_per_share', 'transaction_value_total', 'STCG', 'LTCG', 'STCG_tax', 'LTCG_tax')
+
+    @property
+    def pk(self):
+        return self.id
+
+    # Pickles as the field values alone, in field order
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+# Portfolio attributes that describe completed sales, and so are fixed until the user trades again
+SALES_FIELDS = [
+    'sld_transaction_shares_total',
+    'sld_transaction_cost_basis_total',
+    'sld_transaction_STCG_total',
+    'sld_transaction_LTCG_total',
+    'sld_transaction_CG_total_realized_total',
+    'sld_transaction_market_value_pre_tax_total',
+    'sld_transaction_gain_or_loss_pre_tax_percent',
+    'sld_transaction_STCG_tax_total',
+    'sld_transaction_LTCG_tax_total',
+    'sld_transaction_tax_offset_total',
+    'sld_transaction_market_value_post_tax_total',
+    'sld_transaction_return_percent_post_tax',
+]
+
+
+# The price-independent half of a user's portfolio: positions, open lots, totals of completed sales, cash and tax
+# settings.
+# It only changes when the user trades or edits their profile, so it is cached until then (see portfolio_cache.py),
+# while value_portfolio() applies the current prices to it on every request.
+@dataclass(slots=True, eq=False)
+class PortfolioSnapshot:
+    positions: list = field(default_factory=list) # of PositionData, ordered by symbol
+    open_lots: list = field(default_factory=list) # of OpenLotData
+    cash: Decimal = 0
+    cash_initial: Decimal = 0
+    tax_rate_STCG: Decimal = Decimal('0')
+    tax_rate_LTCG: Decimal = Decimal('0')
+    tax_offset_coefficient: int = 0
+    # Totals of completed sales, see SALES_FIELDS
+    sld_transaction_shares_total: Decimal = 0
+    sld_transaction_cost_basis_total: Decimal = 0
+    sld_transaction_STCG_total: Decimal = 0
+    sld_transaction_LTCG_total: Decimal = 0
+    sld_transaction_CG_total_realized_total: Decimal = 0
+    sld_transaction_market_value_pre_tax_total: Decimal = 0
+    sld_transaction_gain_or_loss_pre_tax_percent: Decimal | str = 0
+    sld_transaction_STCG_tax_total: Decimal = 0
+    sld_transaction_LTCG_tax_total: Decimal = 0
+    sld_transaction_tax_offset_total: Decimal = 0
+    sld_transaction_market_value_post_tax_total: Decimal = 0
+    sld_transaction_return_percent_post_tax: Decimal | str = 0
+    # The open lots again, laid out for value_open_lots_vectorized(); None to value them lot by lot
+    lot_columns: object = None # LotColumns
+
+    # True if the user holds shares, i.e. there is something to value
+    @property
+    def has_open_positions(self):
+        return bool(self.positions) and sum(position.shares_outstanding for position in self.positions) > 0
+
+    # Pickles as the field values alone, in field order
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+
 # Creates an item of the portfolio class and populates it
 def process_user_transactions(user):
-    logger.debug(f'running process_user_transactions() ...  for user { user.id } ...  function started')
-    
+    return value_portfolio(build_portfolio_snapshot(user))
+
+
+# The one way views should load a user's portfolio. The snapshot comes from the cache (see portfolio_cache.py), built
+# at most once at a time per user, and is valued at current prices. Passing the request memoizes the valued portfolio
+# for the rest of that request, so code that asks for it twice does not value it twice. With include_sales, the
+# portfolio also lists the user's sales (see read_sell_transactions()).
+def get_portfolio(user, request=None, include_sales=False):
+    portfolios = getattr(request, '_portfolios', None) if request is not None else None
+    if portfolios is not None and user.pk in portfolios and not include_sales:
+        return portfolios[user.pk]
+
+    snapshot = get_or_set_portfolio_snapshot(user, build_portfolio_snapshot)
+    portfolio = value_portfolio(snapshot)
+    # As the totals, sales are only shown alongside open positions
+    if include_sales and snapshot.has_open_positions:
+        portfolio.sell_transactions = read_sell_transactions(user, snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)
+
+    if request is not None:
+        if portfolios is None:
+            portfolios = request._portfolios = {}
+        portfolios[user.pk] = portfolio
+    return portfolio
+
+
+# Reads the user's positions and open lots from the DB and works out everything that does not depend on prices. The
+# user's sales are already added up in their positions, so the work grows with the symbols and lots they hold rather
+# than with their trade history.
+def build_portfolio_snapshot(user):
+    logger.debug(f'running build_portfolio_snapshot() ...  for user { user.id } ...  function started')
+
+    # Query the user's running positions (maintained by process_buy and process_sell) to see if user has transactions
+    positions = read_positions(Position.objects.filter(user=user))
+    snapshot = start_portfolio_snapshot(user.userprofile, positions)
+    # If user doesn't have transactions, or all positions are closed out, value_portfolio returns an empty portfolio
+    if not snapshot.has_open_positions:
+        logger.debug(f'running build_portfolio_snapshot() ... for user {user.id} ... no open positions in portfolio')
+        return snapshot
+
+    # Only the lots that still hold shares are needed; fully closed lots are already reflected in the positions above.
+    open_lots = [
+        OpenLotData(*row) for row in OpenLot.objects.filter(user=user).order_by('pk').values_list('symbol', 'shares_outstanding', 'transaction_value_per_share', 'timestamp')
+    ]
+    return complete_portfolio_snapshot(snapshot, open_lots)
+
+
+# Reads positions (a Position queryset) as PositionData, ordered by symbol
+def read_positions(positions):
+    return [PositionData(*row) for row in positions.order_by('symbol').values_list(*PositionData._fields)]
+
+
+# Starts a snapshot from the user's profile and positions (PositionData, ordered by symbol). Split from
+# build_portfolio_snapshot() along with complete_portfolio_snapshot(), so the bulk revaluation (see bulk_valuation.py)
+# can build snapshots from rows it reads for all users at once.
+def start_portfolio_snapshot(user_profile, positions):
+    snapshot = PortfolioSnapshot(positions=positions)
+
     # Initialize tax rates and whether cap loss offset is turned on
-    tax_rate_STCG = Decimal(user.userprofile.tax_rate_STCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-    tax_rate_LTCG = Decimal(user.userprofile.tax_rate_LTCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-    tax_offset_coefficient = 1 if user.userprofile.tax_loss_offsets == 'On' else 0
-    cutoff_date = timezone.now() - timezone.timedelta(days=365)
+    snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG = tax_rates(user_profile)
+    snapshot.tax_offset_coefficient = 1 if user_profile.tax_loss_offsets == 'On' else 0
+    snapshot.cash = user_profile.cash
+    snapshot.cash_initial = user_profile.cash_initial
+
+    # The positions' realized tax is reworked when the user changes their tax rates (see brokerage/signals.py). Should
+    # the rates have changed without that (e.g. through QuerySet.update()), it is worked out here for this snapshot
+    # only: building a snapshot never writes.
+    stale = [position.symbol for position in positions if realized_tax_is_stale(position, snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)]
+    if stale:
+        totals = realized_tax_by_symbol(user_profile.user_id, stale, snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)
+        snapshot.positions = [position._replace(sld_CG_tax_total=totals[position.symbol]) if position.symbol in totals else position for position in positions]
+    return snapshot
+
+
+# The user's tax rates on short- and long-term gains, as fractions rounded to the hundredth (e.g. 0.15)
+def tax_rates(user_profile):
+    return (
+        Decimal(user_profile.tax_rate_STCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+        Decimal(user_profile.tax_rate_LTCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+    )
+
+
+# Adds the open lots (OpenLotData, in pk order) and the totals of the sales recorded on the positions to a snapshot
+# from start_portfolio_snapshot()
+def complete_portfolio_snapshot(snapshot, open_lots):
+    snapshot.open_lots = open_lots
+    snapshot.lot_columns = build_lot_columns(snapshot.positions, snapshot.open_lots)
+
+    # For share SALES, as totals per symbol. The totals of a user who never sold stay at 0.
+    for position in snapshot.positions:
+        if not position.sld_transaction_shares:
+            continue
+        CG_total_realized = position.sld_STCG + position.sld_LTCG
+        snapshot.sld_transaction_shares_total += position.sld_transaction_shares
+        snapshot.sld_transaction_cost_basis_total += position.sld_transaction_value_total - CG_total_realized
+        snapshot.sld_transaction_STCG_total += position.sld_STCG
+        snapshot.sld_transaction_LTCG_total += position.sld_LTCG
+        snapshot.sld_transaction_CG_total_realized_total += CG_total_realized
+        snapshot.sld_transaction_market_value_pre_tax_total += position.sld_transaction_value_total
+
+        # See below for cals. pertaining to: snapshot.sld_transaction_gain_or_loss_pre_tax_percent
+        snapshot.sld_transaction_STCG_tax_total += position.sld_STCG_tax
+        snapshot.sld_transaction_LTCG_tax_total += position.sld_LTCG_tax
+        snapshot.sld_transaction_tax_offset_total += position.sld_tax_offset
+        snapshot.sld_transaction_market_value_post_tax_total += position.sld_transaction_value_total - position.sld_CG_tax_total
+
+    snapshot.sld_transaction_gain_or_loss_pre_tax_percent = ((snapshot.sld_transaction_market_value_pre_tax_total / snapshot.sld_transaction_cost_basis_total) - 1) if snapshot.sld_transaction_cost_basis_total else "-"
+    snapshot.sld_transaction_return_percent_post_tax = ((snapshot.sld_transaction_market_value_post_tax_total / snapshot.sld_transaction_cost_basis_total) - 1) if snapshot.sld_transaction_cost_basis_total else "-"
+
+    return snapshot
+
+
+# Reads the user's sales (SLD transactions), in id order, as SaleData with each sale's realized metrics at the given
+# tax rates (the snapshot's)
+def read_sell_transactions(user, tax_rate_STCG, tax_rate_LTCG):
+    sell_transactions = []
+    for row in Transaction.objects.filter(user=user, type='SLD').order_by('id').values_list(*SaleData.COLUMNS).iterator(chunk_size=2000):
+        transaction = SaleData(*row)
+
+        # If SLD, add the following txn metrics...
+        transaction.CG_total_realized = transaction.STCG + transaction.LTCG
+        transaction.cost_basis_total = transaction.transaction_value_total - transaction.STCG - transaction.LTCG
+        transaction.gain_or_loss_pre_tax_percent = transaction.CG_total_realized / transaction.cost_basis_total
+        transaction.STCG_tax_realized = max(transaction.STCG_tax, 0)
+        transaction.LTCG_tax_realized = max(transaction.LTCG_tax, 0)
+        transaction.CG_total_tax_realized = realized_tax(transaction.STCG, transaction.LTCG, tax_rate_STCG, tax_rate_LTCG)
+        transaction.CG_tax_offset_unrealized = max(-(transaction.STCG_tax + transaction.LTCG_tax), 0)
+        transaction.market_value_post_tax = transaction.transaction_value_total - transaction.CG_total_tax_realized
+        transaction.return_percent_post_tax = (transaction.market_value_post_tax / transaction.cost_basis_total) - 1
+
+        sell_transactions.append(transaction)
+    return sell_transactions
+
+
+# Values the open lots of a snapshot one by one, adding unrealized gains, taxes and offsets to the SymbolData in
+# portfolio.portfolio_data, consolidated on symbol
+def value_open_lots(portfolio, snapshot, cutoff_date):
+    tax_rate_STCG = snapshot.tax_rate_STCG
+    tax_rate_LTCG = snapshot.tax_rate_LTCG
+    tax_offset_coefficient = snapshot.tax_offset_coefficient
+
+    for lot in snapshot.open_lots:
+        symbol_data = portfolio.get_symbol_data(lot.symbol)
+
+        # If the lot still holds shares ...
+        if lot.shares_outstanding > 0:
+
+            # Cost basis and unrealized cap gains on the current lot
+            open_transaction_cost_basis_total = lot.shares_outstanding * lot.transaction_value_per_share
+            open_transaction_gain_or_loss_unrealized = (lot.shares_outstanding * symbol_data.market_value_per_share) - open_transaction_cost_basis_total
+
+            # If short-term, then...
+            if lot.timestamp > cutoff_date:
+                open_transaction_STCG_unrealized = open_transaction_gain_or_loss_unrealized
+                open_transaction_LTCG_unrealized = 0
+                # If a ST gain, then...
+                if open_transaction_STCG_unrealized > 0:
+                    open_transaction_STCG_tax_unrealized = open_transaction_STCG_unrealized *  tax_rate_STCG
+                    open_transaction_LTCG_tax_unrealized = 0
+                    open_transaction_CG_tax_offset_unrealized = 0
+                # If a ST loss, then...
+                else:
+                    open_transaction_STCG_tax_unrealized = 0
+                    open_transaction_LTCG_tax_unrealized = 0
+                    open_transaction_CG_tax_offset_unrealized = abs(open_transaction_STCG_unrealized *  tax_rate_STCG * tax_offset_coefficient)
+            # If LT, then...
+            else:
+                open_transaction_STCG_unrealized = 0
+                open_transaction_LTCG_unrealized = open_transaction_gain_or_loss_unrealized
+                # If a LT gain, then...
+                if open_transaction_LTCG_unrealized > 0:
+                    open_transaction_STCG_tax_unrealized = 0
+                    open_transaction_LTCG_tax_unrealized = open_transaction_LTCG_unrealized *  tax_rate_LTCG
+                    open_transaction_CG_tax_offset_unrealized = 0
+                # If a LT loss, then...
+                else:
+                    open_transaction_STCG_tax_unrealized = 0
+                    open_transaction_LTCG_tax_unrealized = 0
+                    open_transaction_CG_tax_offset_unrealized = abs(open_transaction_LTCG_unrealized *  tax_rate_LTCG * tax_offset_coefficient)
+            
+            open_transaction_CG_total_unrealized = open_transaction_STCG_unrealized + open_transaction_LTCG_unrealized  
+            open_transaction_CG_total_tax_unrealized = open_transaction_STCG_tax_unrealized + open_transaction_LTCG_tax_unrealized  
+            open_transaction_market_value_total_pre_tax =  lot.shares_outstanding * symbol_data.market_value_per_share
+            open_transaction_gain_or_loss_pre_tax_percent_unrealized = open_transaction_market_value_total_pre_tax / open_transaction_cost_basis_total
+
+            open_transaction_CG_total_post_tax_unrealized = open_transaction_CG_total_unrealized - open_transaction_CG_total_tax_unrealized
+            open_transaction_market_value_post_tax = open_transaction_market_value_total_pre_tax - open_transaction_CG_total_tax_unrealized  
+            open_transaction_return_percent_post_tax = (open_transaction_market_value_post_tax / open_transaction_cost_basis_total) - 1 
+        
+        # If the lot holds no shares (open lots are deleted once sold out, so this is only a guard) ...
+        else:
+            open_transaction_cost_basis_total = 0
+            open_transaction_STCG_unrealized = 0
+            open_transaction_LTCG_unrealized = 0
+            open_transaction_CG_total_unrealized = 0
+            open_transaction_market_value_total_pre_tax = 0
+            open_transaction_STCG_tax_unrealized = 0
+            open_transaction_LTCG_tax_unrealized = 0
+            open_transaction_CG_total_tax_unrealized = 0
+            open_transaction_CG_tax_offset_unrealized = 0
+            open_transaction_market_value_post_tax = 0
+
+        # Increment data consolidated on symbol --------------------------------------
+        
+        # Symbol-level metrics: This is symbol-level data (transaction_shares is seeded from the position above)
+        symbol_data.shares_outstanding += lot.shares_outstanding
+        symbol_data.cost_basis_total += open_transaction_cost_basis_total
+        
+        symbol_data.STCG_unrealized += open_transaction_STCG_unrealized
+        symbol_data.LTCG_unrealized += open_transaction_LTCG_unrealized
+        symbol_data.CG_total_unrealized += open_transaction_CG_total_unrealized        
+
+        symbol_data.market_value_total_pre_tax += open_transaction_market_value_total_pre_tax
+        symbol_data.STCG_tax_unrealized += open_transaction_STCG_tax_unrealized
+        symbol_data.LTCG_tax_unrealized += open_transaction_LTCG_tax_unrealized    
+        symbol_data.CG_total_tax_unrealized += open_transaction_CG_total_tax_unrealized
+        symbol_data.CG_tax_offset_unrealized += open_transaction_CG_tax_offset_unrealized
+        
+        symbol_data.market_value_post_tax += open_transaction_market_value_post_tax
+        
+        if symbol_data.shares_outstanding > 0:
+            symbol_data.cost_basis_per_share = symbol_data.cost_basis_total / symbol_data.shares_outstanding
+            symbol_data.gain_or_loss_pre_tax_percent = symbol_data.CG_total_unrealized / symbol_data.cost_basis_total 
+            symbol_data.return_percent_post_tax = (symbol_data.market_value_post_tax/symbol_data.cost_basis_total) - 1 
+
+
+# Values a portfolio snapshot at current prices. quotes maps symbol -> FMP quote; by default they are pulled from the
+# shared quote cache (or FMP, for symbols not cached). now is the time to value at (whether each lot is short- or
+# long-term), by default the current time.
+def value_portfolio(snapshot, quotes=None, now=None):
     
     # Create an instance of the Portfolio class
     portfolio = Portfolio()
-    logger.debug(f'running process_user_transactions() ...  for user { user.id } ...  object created')
-    
-    # Query transactions DB to see if user has transactions
-    transactions = Transaction.objects.filter(user=user).all()
-    
-    # If user doesn't have transactions (e.g. a new user, return an empty portfolio object)
-    if not transactions:
-        logger.debug(f'running process_user_transactions() ... for user {user.id} ... no transactions in portfolio, returning empty portfolio object ')
-        return portfolio
-    
-    # If user has transactions, but no open positions (e.g. everything is closed out), return an empty portfolio object
-    total_shares_held = 0
-    for transaction in transactions:
-        if transaction.type =='BOT':
-            total_shares_held += transaction.transaction_shares
-        else:
-            total_shares_held -= transaction.transaction_shares
-    if not total_shares_held > 0:
-        logger.debug(f'running process_user_transactions() ... for user {user.id} ... user has transactions, but all positions are closed.')
+
+    # If user doesn't have transactions (e.g. a new user), or all positions are closed out, return an empty portfolio object
+    if not snapshot.has_open_positions:
         return portfolio
 
+    cutoff_date = (now or timezone.now()) - timezone.timedelta(days=365)
 
     # Collect all unique symbols
-    unique_symbols = set(transaction.symbol for transaction in transactions)
-    print(f'running process_portfolio.py ... unique_symbols is: {unique_symbols}')
-    unique_symbols_string = ','.join(unique_symbols)
-    print(f'running process_portfolio.py ... unique_symbols_string is: {unique_symbols_string}')
-    unique_symbols_data = company_data_multiple(unique_symbols_string)
-    print(f'running process_portfolio.py ... unique_symbols_data is: {unique_symbols_data}')
+    unique_symbols = [position.symbol for position in snapshot.positions]
+    if quotes is None:
+        print(f'running process_portfolio.py ... unique_symbols is: {unique_symbols}')
+        unique_symbols_string = ','.join(unique_symbols)
+        print(f'running process_portfolio.py ... unique_symbols_string is: {unique_symbols_string}')
+        quotes = company_data_multiple(unique_symbols_string)
+        print(f'running process_portfolio.py ... unique_symbols_data is: {quotes}')
+    unique_symbols_data = quotes
 
     # Initialize portfolio data for each symbol
-    for symbol in unique_symbols:
+    for position in snapshot.positions:
+        symbol = position.symbol
         if symbol not in portfolio.portfolio_data:
             symbol_info = unique_symbols_data.get(symbol, {})
             market_value_per_share = Decimal(str(symbol_info.get('price', '0')))
-            portfolio.add_symbol(symbol, {
-                'symbol': symbol,
-                'transaction_shares': Decimal('0'),
-                'shares_outstanding': Decimal('0'),
-                'cost_basis_per_share' : Decimal('0'),
-                'cost_basis_total' : Decimal('0'),
-                'market_value_per_share': market_value_per_share,
-                'market_value_total_pre_tax': Decimal('0'),
-                'gain_or_loss_pre_tax_percent': Decimal('0'),
-                'STCG_unrealized': Decimal('0'),
-                'LTCG_unrealized': Decimal('0'),
-                'CG_total_unrealized': Decimal('0'),
-                'STCG_tax_unrealized': Decimal('0'),
-                'LTCG_tax_unrealized': Decimal('0'),
-                'CG_tax_offset_unrealized': Decimal('0'),
-                'CG_total_tax_unrealized': Decimal('0'),
-                'CG_total_post_tax': Decimal('0'),
-                'market_value_post_tax': Decimal('0'),
-                'return_percent_post_tax': Decimal('0'),
-            })
+            portfolio.add_symbol(symbol, SymbolData(
+                symbol=symbol,
+                transaction_shares=Decimal(position.transaction_shares),
+                market_value_per_share=market_value_per_share,
+            ))
 
 
         # ----------------------------------------------------------------------
     
     
-    for transaction in transactions:
-        symbol_data = portfolio.get_symbol_data(transaction.symbol)
-
-        # If the current transaction = BOT... 
-        if transaction.type == 'BOT':  
-    
-            # If the current transaction = BOT && shares outstanding > 0 ...
-            if transaction.shares_outstanding > 0:
-
-                # Cost basis and unrealized cap gains on the current transaction
-                open_transaction_cost_basis_total = transaction.shares_outstanding * transaction.transaction_value_per_share
-                open_transaction_gain_or_loss_unrealized = (transaction.shares_outstanding * symbol_data['market_value_per_share']) - open_transaction_cost_basis_total
-
-                # If short-term, then...
-                if transaction.timestamp > cutoff_date:
-                    open_transaction_STCG_unrealized = open_transaction_gain_or_loss_unrealized
-                    open_transaction_LTCG_unrealized = 0
-                    # If a ST gain, then...
-                    if open_transaction_STCG_unrealized > 0:
-                        open_transaction_STCG_tax_unrealized = open_transaction_STCG_unrealized *  tax_rate_STCG
-                        open_transaction_LTCG_tax_unrealized = 0
-                        open_transaction_CG_tax_offset_unrealized = 0
-                    # If a ST loss, then...
-                    else:
-                        open_transaction_STCG_tax_unrealized = 0
-                        open_transaction_LTCG_tax_unrealized = 0
-                        open_transaction_CG_tax_offset_unrealized = abs(open_transaction_STCG_unrealized *  tax_rate_STCG * tax_offset_coefficient)
-                # If LT, then...
-                else:
-                    open_transaction_STCG_unrealized = 0
-                    open_transaction_LTCG_unrealized = open_transaction_gain_or_loss_unrealized
-                    # If a LT gain, then...
-                    if open_transaction_LTCG_unrealized > 0:
-                        open_transaction_STCG_tax_unrealized = 0
-                        open_transaction_LTCG_tax_unrealized = open_transaction_LTCG_unrealized *  tax_rate_LTCG
-                        open_transaction_CG_tax_offset_unrealized = 0
-                    # If a LT loss, then...
-                    else:
-                        open_transaction_STCG_tax_unrealized = 0
-                        open_transaction_LTCG_tax_unrealized = 0
-                        open_transaction_CG_tax_offset_unrealized = abs(open_transaction_LTCG_unrealized *  tax_rate_LTCG * tax_offset_coefficient)
-                
-                open_transaction_CG_total_unrealized = open_transaction_STCG_unrealized + open_transaction_LTCG_unrealized  
-                open_transaction_CG_total_tax_unrealized = open_transaction_STCG_tax_unrealized + open_transaction_LTCG_tax_unrealized  
-                open_transaction_market_value_total_pre_tax =  transaction.shares_outstanding * symbol_data['market_value_per_share']
-                open_transaction_gain_or_loss_pre_tax_percent_unrealized = open_transaction_market_value_total_pre_tax / open_transaction_cost_basis_total
-
-                open_transaction_CG_total_post_tax_unrealized = open_transaction_CG_total_unrealized - open_transaction_CG_total_tax_unrealized
-                open_transaction_market_value_post_tax = open_transaction_market_value_total_pre_tax - open_transaction_CG_total_tax_unrealized  
-                open_transaction_return_percent_post_tax = (open_transaction_market_value_post_tax / open_transaction_cost_basis_total) - 1 
-            
-            # If the current transaction = BOT && shares outstanding == 0 ...
-            else:
-                open_transaction_cost_basis_total = 0
-                open_transaction_STCG_unrealized = 0
-                open_transaction_LTCG_unrealized = 0
-                open_transaction_CG_total_unrealized = 0
-                open_transaction_market_value_total_pre_tax = 0
-                open_transaction_STCG_tax_unrealized = 0
-                open_transaction_LTCG_tax_unrealized = 0
-                open_transaction_CG_total_tax_unrealized = 0
-                open_transaction_CG_tax_offset_unrealized = 0
-                open_transaction_market_value_post_tax = 0
-
-            # Increment data consolidated on symbol --------------------------------------
-            
-            # Symbol-level metrics: This is symbol-level data
-            symbol_data['transaction_shares'] += transaction.transaction_shares
-            symbol_data['shares_outstanding'] += transaction.shares_outstanding
-            symbol_data['cost_basis_total'] += open_transaction_cost_basis_total
-            
-            symbol_data['STCG_unrealized'] += open_transaction_STCG_unrealized
-            symbol_data['LTCG_unrealized'] += open_transaction_LTCG_unrealized
-            symbol_data['CG_total_unrealized'] += open_transaction_CG_total_unrealized        
-
-            symbol_data['market_value_total_pre_tax'] += open_transaction_market_value_total_pre_tax
-            symbol_data['STCG_tax_unrealized'] += open_transaction_STCG_tax_unrealized
-            symbol_data['LTCG_tax_unrealized'] += open_transaction_LTCG_tax_unrealized    
-            symbol_data['CG_total_tax_unrealized'] += open_transaction_CG_total_tax_unrealized
-            symbol_data['CG_tax_offset_unrealized'] += open_transaction_CG_tax_offset_unrealized
-            
-            symbol_data['market_value_post_tax'] += open_transaction_market_value_post_tax
-            
-            if symbol_data['shares_outstanding'] > 0:
-                symbol_data['cost_basis_per_share'] = symbol_data['cost_basis_total'] / symbol_data['shares_outstanding']
-                symbol_data['gain_or_loss_pre_tax_percent'] = symbol_data['CG_total_unrealized'] / symbol_data['cost_basis_total'] 
-                symbol_data['return_percent_post_tax'] = (symbol_data['market_value_post_tax']/symbol_data['cost_basis_total']) - 1 
-
-        
-        #-------------------------------------------------------------------------
-        
+    # Open lots: all at once where the snapshot allows (see valuation_engine.py), otherwise one by one
+    if not value_open_lots_vectorized(portfolio, snapshot, cutoff_date):
+        value_open_lots(portfolio, snapshot, cutoff_date)
 
-        # For share SALES        
-        else:
-            
-            # If SLD, add the following txn metrics...
-            transaction.CG_total_realized = transaction.STCG + transaction.LTCG
-            transaction.cost_basis_total = transaction.transaction_value_total - transaction.STCG - transaction.LTCG
-            transaction.gain_or_loss_pre_tax_percent = transaction.CG_total_realized / transaction.cost_basis_total
-            transaction.STCG_tax_realized = max(transaction.STCG_tax, 0)
-            transaction.LTCG_tax_realized = max(transaction.LTCG_tax, 0)
-            transaction.CG_total_tax_realized = max(transaction.STCG * tax_rate_STCG + transaction.LTCG * tax_rate_LTCG, 0)
-            transaction.CG_tax_offset_unrealized = max(-(transaction.STCG_tax + transaction.LTCG_tax), 0)
-            transaction.market_value_post_tax = transaction.transaction_value_total - transaction.CG_total_tax_realized
-            transaction.return_percent_post_tax = (transaction.market_value_post_tax / transaction.cost_basis_total) - 1
-
-
-            # If SLD, add the following txn metrics...
-            portfolio.sld_transaction_shares_total += transaction.transaction_shares
-            portfolio.sld_transaction_cost_basis_total += transaction.cost_basis_total 
-            portfolio.sld_transaction_STCG_total += transaction.STCG
-            portfolio.sld_transaction_LTCG_total += transaction.LTCG            
-            portfolio.sld_transaction_CG_total_realized_total += transaction.CG_total_realized      
-            portfolio.sld_transaction_market_value_pre_tax_total += transaction.transaction_value_total
-            
-            # See below for cals. pertaining to: portfolio.sld_transaction_gain_or_loss_pre_tax_percent
-            portfolio.sld_transaction_STCG_tax_total += transaction.STCG_tax_realized 
-            portfolio.sld_transaction_LTCG_tax_total += transaction.LTCG_tax_realized
-            portfolio.sld_transaction_tax_offset_total += transaction.CG_tax_offset_unrealized
-            portfolio.sld_transaction_market_value_post_tax_total += transaction.market_value_post_tax 
+    #-------------------------------------------------------------------------
 
-            portfolio.sell_transactions.append(transaction) 
-            
-    # PORTFOLIO-LEVEL METRICS: This is total portfolio data shown at bottom of index tables    
-    portfolio.sld_transaction_gain_or_loss_pre_tax_percent = ((portfolio.sld_transaction_market_value_pre_tax_total / portfolio.sld_transaction_cost_basis_total) - 1) if portfolio.sld_transaction_cost_basis_total else "-"
-    portfolio.sld_transaction_return_percent_post_tax = ((portfolio.sld_transaction_market_value_post_tax_total / portfolio.sld_transaction_cost_basis_total) - 1) if portfolio.sld_transaction_cost_basis_total else "-"
+    # Completed sales come straight from the snapshot
+    for name in SALES_FIELDS:
+        setattr(portfolio, name, getattr(snapshot, name))
     
-    portfolio.cash = user.userprofile.cash 
-    portfolio.cash_initial = user.userprofile.cash_initial
-    logger.debug(f'running /process_user_transactions(user) ...  portfolio.cash is: { portfolio.cash }')
+    portfolio.cash = snapshot.cash 
+    portfolio.cash_initial = snapshot.cash_initial
+    logger.debug(f'running value_portfolio() ...  portfolio.cash is: { portfolio.cash }')
 
     # Step 3.5: Derive total portfolio cost basis, market value, and returns, all ex cash.
     for symbol, symbol_data in portfolio.portfolio_data.items():
-        portfolio.portfolio_total_transaction_shares += symbol_data['transaction_shares']
-        portfolio.portfolio_total_shares_outstanding += symbol_data['shares_outstanding']
-        portfolio.portfolio_cost_basis_total += symbol_data['cost_basis_total']
-        portfolio.portfolio_STCG_unrealized += symbol_data['STCG_unrealized']
-        portfolio.portfolio_LTCG_unrealized += symbol_data['LTCG_unrealized']
+        portfolio.portfolio_total_transaction_shares += symbol_data.transaction_shares
+        portfolio.portfolio_total_shares_outstanding += symbol_data.shares_outstanding
+        portfolio.portfolio_cost_basis_total += symbol_data.cost_basis_total
+        portfolio.portfolio_STCG_unrealized += symbol_data.STCG_unrealized
+        portfolio.portfolio_LTCG_unrealized += symbol_data.LTCG_unrealized
         portfolio.portfolio_CG_unrealized += portfolio.portfolio_STCG_unrealized + portfolio.portfolio_LTCG_unrealized  
-        portfolio.portfolio_market_value_total_pre_tax += symbol_data['market_value_total_pre_tax']
-        portfolio.portfolio_STCG_tax_unrealized += symbol_data['STCG_tax_unrealized']
-        portfolio.portfolio_LTCG_tax_unrealized += symbol_data['LTCG_tax_unrealized']
+        portfolio.portfolio_market_value_total_pre_tax += symbol_data.market_value_total_pre_tax
+        portfolio.portfolio_STCG_tax_unrealized += symbol_data.STCG_tax_unrealized
+        portfolio.portfolio_LTCG_tax_unrealized += symbol_data.LTCG_tax_unrealized
         portfolio.portfolio_total_tax_unrealized = portfolio.portfolio_STCG_tax_unrealized + portfolio.portfolio_LTCG_tax_unrealized
-        portfolio.portfolio_CG_tax_offset_unrealized += symbol_data['CG_tax_offset_unrealized']
+        portfolio.portfolio_CG_tax_offset_unrealized += symbol_data.CG_tax_offset_unrealized
 
     portfolio.portfolio_cost_basis_per_share = portfolio.portfolio_cost_basis_total / portfolio.portfolio_total_shares_outstanding
     portfolio.portfolio_CG_total_unrealized = portfolio.portfolio_STCG_unrealized + portfolio.portfolio_LTCG_unrealized
     portfolio.portfolio_market_value_per_share = portfolio.portfolio_market_value_total_pre_tax / portfolio.portfolio_total_shares_outstanding
-    portfolio.portfolio_market_value_total_pre_tax_incl_cash = portfolio.portfolio_market_value_total_pre_tax + user.userprofile.cash
+    portfolio.portfolio_market_value_total_pre_tax_incl_cash = portfolio.portfolio_market_value_total_pre_tax + snapshot.cash
     portfolio.portfolio_gain_or_loss_pre_tax_percent = (portfolio.portfolio_market_value_total_pre_tax / portfolio.portfolio_cost_basis_total) -1
     portfolio.portfolio_market_value_post_tax = portfolio.portfolio_market_value_total_pre_tax + min((-portfolio.portfolio_total_tax_unrealized + portfolio.portfolio_CG_tax_offset_unrealized),0)
-    portfolio.portfolio_market_value_post_tax_incl_cash = portfolio.portfolio_market_value_post_tax + user.userprofile.cash
+    portfolio.portfolio_market_value_post_tax_incl_cash = portfolio.portfolio_market_value_post_tax + snapshot.cash
     portfolio.portfolio_return_percent_post_tax = (portfolio.portfolio_market_value_post_tax / portfolio.portfolio_cost_basis_total) -1
     
     # Below are calculations for total portfolio performance, incl. 
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.core.cache import cache
+import logging
+import time
+__all__ = ['get_cached_quotes', 'get_stale_quotes', 'normalize_symbols', 'quote_cache_stats', 'set_cached_quotes']
+
+logger = logging.getLogger('django')
+
+
+# Quotes pulled from the FMP API are cached per symbol in the shared cache (see CACHES in settings.py), so a
+# symbol requested by one user is served to every other user (and every gunicorn worker sharing the cache) until
+# QUOTE_CACHE_TIMEOUT elapses. Symbols FMP does not recognize are remembered for QUOTE_CACHE_NEGATIVE_TIMEOUT so
+# that repeated lookups of a bad symbol do not each cost an upstream request.
+# Expired quotes are kept for up to QUOTE_CACHE_STALE_TIMEOUT so they can be served when FMP is unavailable.
+# 'kind' separates the payloads of the different FMP endpoints (e.g. 'profile' vs. 'quote').
+QUOTE_CACHE_COUNTERS = ('hits', 'misses', 'negative_hits')
+
+
+def _quote_cache_key(kind, symbol):
+    return f'fmp_{kind}_{symbol}'
+
+
+def _quote_cache_counter_key(kind, counter):
+    return f'fmp_{kind}_cache_{counter}'
+
+
+# Increments a shared hit/miss counter. cache.add() seeds the counter so cache.incr() never hits a missing key.
+def _increment_counter(kind, counter, amount):
+    if not amount:
+        return
+    key = _quote_cache_counter_key(kind, counter)
+    try:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, amount)
+    except ValueError:
+        # The counter was evicted between add() and incr(); losing one increment is acceptable
+        logger.debug(f'running quote_cache ... counter { key } was evicted before it could be incremented')
+
+
+# Upper-cases and de-duplicates symbols, accepting either a list or the comma-separated string FMP expects
+def normalize_symbols(symbols):
+    if isinstance(symbols, str):
+        symbols = symbols.split(',')
+    normalized = []
+    for symbol in symbols:
+        symbol = (symbol or '').strip().upper()
+        if symbol and symbol not in normalized:
+            normalized.append(symbol)
+    return normalized
+
+
+# Looks up symbols in the quote cache. Returns a tuple of (hits, unknown, misses), where hits maps symbol -> cached
+# FMP data, unknown is the list of symbols in the negative cache and misses are the symbols that need an upstream call.
+# Pass count=False for internal re-checks that should not show up in the hit/miss counters.
+def get_cached_quotes(kind, symbols, count=True):
+    symbols = normalize_symbols(symbols)
+    keys = {_quote_cache_key(kind, symbol): symbol for symbol in symbols}
+    entries = cache.get_many(list(keys))
+
+    hits = {}
+    unknown = []
+    misses = []
+    fresh_after = time.time() - settings.QUOTE_CACHE_TIMEOUT
+    for key, symbol in keys.items():
+        entry = entries.get(key)
+        if entry is None or (entry['data'] is not None and entry['fetched_at'] < fresh_after):
+            misses.append(symbol)
+        elif entry['data'] is None:
+            unknown.append(symbol)
+        else:
+            hits[symbol] = entry['data']
+
+    if count:
+        _increment_counter(kind, 'hits', len(hits))
+        _increment_counter(kind, 'negative_hits', len(unknown))
+        _increment_counter(kind, 'misses', len(misses))
+    logger.debug(f'running get_cached_quotes() ... kind: { kind }, hits: { list(hits) }, unknown: { unknown }, misses: { misses }')
+    return hits, unknown, misses
+
+
+# Stores the FMP data returned for the requested symbols. Any requested symbol absent from data_by_symbol is
+# written to the negative cache.
+def set_cached_quotes(kind, requested_symbols, data_by_symbol):
+    fetched_at = time.time()
+    positive = {}
+    negative = {}
+    for symbol in normalize_symbols(requested_symbols):
+        data = data_by_symbol.get(symbol)
+        if data:
+            positive[_quote_cache_key(kind, symbol)] = {'data': data, 'fetched_at': fetched_at}
+        else:
+            negative[_quote_cache_key(kind, symbol)] = {'data': None, 'fetched_at': fetched_at}
+
+    if positive:
+        cache.set_many(positive, timeout=max(settings.QUOTE_CACHE_TIMEOUT, settings.QUOTE_CACHE_STALE_TIMEOUT))
+    if negative:
+        cache.set_many(negative, timeout=settings.QUOTE_CACHE_NEGATIVE_TIMEOUT)
+
+
+# Returns whatever quotes are cached for symbols, however old. Used as a fallback when FMP cannot be reached.
+def get_stale_quotes(kind, symbols):
+    keys = {_quote_cache_key(kind, symbol): symbol for symbol in normalize_symbols(symbols)}
+    entries = cache.get_many(list(keys))
+    return {symbol: entries[key]['data'] for key, symbol in keys.items() if key in entries and entries[key]['data'] is not None}
+
+
+# Returns the shared hit/miss counters for each kind of cached FMP payload, e.g. {'quote': {'hits': 10, ...}}
+def quote_cache_stats(kinds=('profile', 'quote')):
+    stats = {}
+    for kind in kinds:
+        keys = {_quote_cache_counter_key(kind, counter): counter for counter in QUOTE_CACHE_COUNTERS}
+        values = cache.get_many(list(keys))
+        stats[kind] = {counter: values.get(key, 0) for key, counter in keys.items()}
+    return stats
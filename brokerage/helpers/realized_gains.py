@@ -0,0 +1,84 @@
+from decimal import Decimal
+from django.db import transaction
+import logging
+from ..models import Position, Transaction
+__all__ = ['add_sale', 'realized_tax', 'realized_tax_by_symbol', 'realized_tax_is_stale', 'refresh_realized_tax', 'REALIZED_FIELDS']
+
+logger = logging.getLogger('django')
+
+
+# Each Position keeps running totals of the user's sales of its symbol (the sld_ fields), so that a portfolio's
+# realized figures come from one row per symbol rather than from every SLD transaction. add_sale() adds a sale to them
+# in the same DB transaction as the sale itself.
+# All but one of the totals are fixed once a sale is made. The exception is the tax on the sale as /index_detail
+# shows it, which is worked out at the user's current tax rates (see realized_tax()): sld_CG_tax_total is kept at the
+# rates in sld_tax_rate_STCG/LTCG, and reworked from the position's sales by refresh_realized_tax() when the user
+# changes their rates (see brokerage/signals.py).
+
+# The Position fields holding the totals, in the order PositionData carries them
+REALIZED_FIELDS = (
+    'sld_transaction_shares',
+    'sld_transaction_value_total',
+    'sld_STCG',
+    'sld_LTCG',
+    'sld_STCG_tax',
+    'sld_LTCG_tax',
+    'sld_tax_offset',
+    'sld_CG_tax_total',
+    'sld_tax_rate_STCG',
+    'sld_tax_rate_LTCG',
+)
+
+
+# The tax on a sale's gains at the given rates (fractions, e.g. 0.15), or 0 for a net loss
+def realized_tax(STCG, LTCG, tax_rate_STCG, tax_rate_LTCG):
+    return max(STCG * tax_rate_STCG + LTCG * tax_rate_LTCG, 0)
+
+
+# True if position's sld_CG_tax_total was worked out at other rates than these. Positions without sales have nothing
+# to rework.
+def realized_tax_is_stale(position, tax_rate_STCG, tax_rate_LTCG):
+    return bool(position.sld_transaction_shares) and (position.sld_tax_rate_STCG, position.sld_tax_rate_LTCG) != (tax_rate_STCG, tax_rate_LTCG)
+
+
+# Adds a sale (an SLD Transaction, with the values it is stored with) to position's totals, in memory, for the caller
+# to save. The position's realized tax must be current for the rates (see refresh_realized_tax()).
+def add_sale(position, sale, tax_rate_STCG, tax_rate_LTCG):
+    position.sld_transaction_shares += sale.transaction_shares
+    position.sld_transaction_value_total += sale.transaction_value_total
+    position.sld_STCG += sale.STCG
+    position.sld_LTCG += sale.LTCG
+    position.sld_STCG_tax += max(sale.STCG_tax, 0)
+    position.sld_LTCG_tax += max(sale.LTCG_tax, 0)
+    position.sld_tax_offset += max(-(sale.STCG_tax + sale.LTCG_tax), 0)
+    position.sld_CG_tax_total += realized_tax(sale.STCG, sale.LTCG, tax_rate_STCG, tax_rate_LTCG)
+    position.sld_tax_rate_STCG = tax_rate_STCG
+    position.sld_tax_rate_LTCG = tax_rate_LTCG
+
+
+# The tax on the user's sales of each of symbols at the given rates, worked out from the sales themselves. Only reads.
+def realized_tax_by_symbol(user_id, symbols, tax_rate_STCG, tax_rate_LTCG):
+    totals = dict.fromkeys(symbols, Decimal('0'))
+    sales = Transaction.objects.filter(user_id=user_id, type='SLD', symbol__in=list(totals)).values_list('symbol', 'STCG', 'LTCG')
+    for symbol, STCG, LTCG in sales.iterator(chunk_size=2000):
+        totals[symbol] += realized_tax(STCG, LTCG, tax_rate_STCG, tax_rate_LTCG)
+    return totals
+
+
+# Reworks sld_CG_tax_total at the given rates from the sales of those of the user's positions (Position instances, or
+# a queryset of them, e.g. with select_for_update()) that were worked out at other rates, and saves them. Only needed
+# after the user changes their tax rates, and then once per position. Returns the positions that changed.
+def refresh_realized_tax(user_id, positions, tax_rate_STCG, tax_rate_LTCG):
+    with transaction.atomic():
+        stale = {position.symbol: position for position in positions if realized_tax_is_stale(position, tax_rate_STCG, tax_rate_LTCG)}
+        if not stale:
+            return []
+
+        totals = realized_tax_by_symbol(user_id, stale, tax_rate_STCG, tax_rate_LTCG)
+        for symbol, position in stale.items():
+            position.sld_CG_tax_total = totals[symbol]
+            position.sld_tax_rate_STCG = tax_rate_STCG
+            position.sld_tax_rate_LTCG = tax_rate_LTCG
+        Position.objects.bulk_update(stale.values(), ['sld_CG_tax_total', 'sld_tax_rate_STCG', 'sld_tax_rate_LTCG'])
+    logger.debug(f'running refresh_realized_tax() ... reworked realized tax for user { user_id }, symbols: { list(stale) }')
+    return list(stale.values())
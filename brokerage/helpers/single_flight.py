@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.core.cache import cache
+import logging
+import threading
+import time
+import uuid
+__all__ = ['single_flight']
+
+logger = logging.getLogger('django')
+
+
+# Coalesces concurrent calls for the same key so that only one of them does the work.
+# 1. In-process: threads in the same worker that ask for a key already in flight wait for the leader's result.
+# 2. Cross-worker: the leader also takes a lock in the shared cache. A worker that finds the lock taken polls
+#    recheck() (typically a look at the quote cache the leader is about to fill) until it returns a result, rather
+#    than making its own upstream call. If the leader never delivers within SINGLE_FLIGHT_TIMEOUT, the waiter runs
+#    fn() itself so that a crashed worker can never block others.
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls = {}
+_calls_lock = threading.Lock()
+
+
+def _single_flight_lock_key(key):
+    return f'single_flight_{key}'
+
+
+# Waits for another worker holding the cross-worker lock, returning recheck()'s result or None if it never arrives
+def _wait_for_other_worker(key, recheck):
+    lock_key = _single_flight_lock_key(key)
+    deadline = time.monotonic() + settings.SINGLE_FLIGHT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        result = recheck()
+        if result is not None:
+            logger.debug(f'running single_flight() ... key: { key } was served by another worker')
+            return result
+        # The other worker finished (or died) without producing a result
+        if cache.get(lock_key) is None:
+            return None
+    return None
+
+
+# Runs fn() as the leader for key, holding the cross-worker lock for the duration of the call
+def _lead(key, fn, recheck):
+    lock_key = _single_flight_lock_key(key)
+    token = uuid.uuid4().hex
+    if recheck is not None and not cache.add(lock_key, token, timeout=settings.SINGLE_FLIGHT_TIMEOUT):
+        result = _wait_for_other_worker(key, recheck)
+        if result is not None:
+            return result
+        token = None
+
+    try:
+        return fn()
+    finally:
+        if token is not None and cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+
+# Returns fn()'s result, sharing a single in-flight call between all concurrent callers for the same key.
+# recheck is optional; without it only callers within this worker are coalesced.
+def single_flight(key, fn, recheck=None):
+    with _calls_lock:
+        call = _calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _calls[key] = _Call()
+
+    if not is_leader:
+        logger.debug(f'running single_flight() ... key: { key } already in flight, waiting for the result')
+        if call.done.wait(settings.SINGLE_FLIGHT_TIMEOUT):
+            if call.error is not None:
+                raise call.error
+            return call.result
+        return fn()
+
+    try:
+        call.result = _lead(key, fn, recheck)
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            _calls.pop(key, None)
+        call.done.set()
@@ -0,0 +1,326 @@
+from collections import deque, namedtuple
+import csv
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import logging
+from ..models import OpenLot, Position, Transaction
+from .lot_fills import fill_sale
+from .realized_gains import REALIZED_FIELDS, add_sale, refresh_realized_tax
+from users.models import UserProfile
+__all__ = ['import_trades', 'read_trades', 'Trade', 'TradeImportError', 'TRADE_FILE_FORMATS']
+
+logger = logging.getLogger('django')
+
+
+# Imports trade files in bulk (to seed accounts for benchmarks and load tests, or to migrate a history), rather than
+# trading one order at a time through buy_view and sell_view with an FMP call each:
+#   1. trades are read from CSV or NDJSON, with the price each was made at, and checked row by row
+#   2. each user's trades are replayed in memory: purchases open lots, and sales are filled from the lots by
+#      fill_sale() in the user's FIFO/LIFO order, exactly as process_sell fills them
+#   3. the resulting Transaction, OpenLot and Position rows and the user's cash are written with bulk inserts and
+#      updates, in one DB transaction per chunk of trades
+# Imports add to whatever the users already hold, so a file can be imported on top of an existing history.
+
+TRADE_FILE_FORMATS = ['csv', 'ndjson']
+
+# Accepted spellings of each trade field. The second names are those of the /history/export columns, so an exported
+# history can be imported into another account.
+TRADE_FIELDS = {
+    'user': ['user', 'username'],
+    'timestamp': ['timestamp'],
+    'type': ['type'],
+    'symbol': ['symbol'],
+    'shares': ['shares', 'transaction_shares'],
+    'price': ['price', 'transaction_value_per_share'],
+}
+TRADE_TYPES = {'BOT': 'BOT', 'BUY': 'BOT', 'SLD': 'SLD', 'SELL': 'SLD'}
+
+# A trade read from a file. line is its line number, for error messages.
+Trade = namedtuple('Trade', ['line', 'username', 'timestamp', 'type', 'symbol', 'shares', 'price'])
+
+
+class TradeImportError(ValueError):
+    pass
+
+
+# Returns the record's value for a trade field, under any of its accepted names
+def _field(record, name):
+    for key in TRADE_FIELDS[name]:
+        value = record.get(key)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+# Checks a record read from a trade file and returns it as a Trade. Naive timestamps are taken to be in TIME_ZONE;
+# prices are rounded to the cent, as process_buy and process_sell round FMP's.
+def _parse_trade(line, record, username=None):
+    if not isinstance(record, dict):
+        raise TradeImportError(f'line { line }: expected an object with the fields of a trade')
+    username = username or _field(record, 'user')
+    if not username:
+        raise TradeImportError(f'line { line }: no user given, in the file or with --user')
+
+    timestamp = _field(record, 'timestamp')
+    try:
+        timestamp = parse_datetime(str(timestamp))
+    except ValueError:
+        timestamp = None
+    if timestamp is None:
+        raise TradeImportError(f'line { line }: invalid timestamp { _field(record, "timestamp")!r}')
+    if timezone.is_naive(timestamp):
+        timestamp = timezone.make_aware(timestamp)
+
+    trade_type = TRADE_TYPES.get(str(_field(record, 'type')).upper())
+    if trade_type is None:
+        raise TradeImportError(f'line { line }: type must be one of { ", ".join(TRADE_TYPES) }')
+
+    symbol = str(_field(record, 'symbol') or '').upper()
+    if not symbol or len(symbol) > Transaction._meta.get_field('symbol').max_length:
+        raise TradeImportError(f'line { line }: invalid symbol')
+
+    try:
+        shares = int(_field(record, 'shares'))
+        price = Decimal(str(_field(record, 'price'))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    except (TypeError, ValueError, InvalidOperation):
+        raise TradeImportError(f'line { line }: shares must be a whole number and price a number')
+    if shares <= 0 or price <= 0:
+        raise TradeImportError(f'line { line }: shares and price must be positive')
+
+    return Trade(line, str(username), timestamp, trade_type, symbol, shares, price)
+
+
+# Yields the trades in file (an open text file), as Trades. Lines are numbered as in the file, counting a CSV header.
+def read_trades(file, file_format, username=None):
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield _parse_trade(reader.line_num, record, username)
+    elif file_format == 'ndjson':
+        for line, text in enumerate(file, start=1):
+            if not text.strip():
+                continue
+            try:
+                record = json.loads(text)
+            except ValueError:
+                raise TradeImportError(f'line { line }: invalid JSON')
+            yield _parse_trade(line, record, username)
+    else:
+        raise TradeImportError(f'unknown trade file format { file_format!r}, expected one of { ", ".join(TRADE_FILE_FORMATS) }')
+
+
+# One user's holdings during an import: their open lots per symbol (oldest first), positions and cash, loaded once from
+# the DB and then kept up to date in memory as their trades are replayed. The rows to write are collected until
+# flush(), which writes them all at once.
+class _Account:
+    def __init__(self, user):
+        self.user = user
+        self.profile = user.userprofile
+        self.lifo = self.profile.accounting_method == 'LIFO'
+        # As in process_sell
+        self.tax_rate_STCG = Decimal(self.profile.tax_rate_STCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        self.tax_rate_LTCG = Decimal(self.profile.tax_rate_LTCG / 100).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+        self.lots = {}
+        for lot in OpenLot.objects.filter(user=user).order_by('timestamp', 'pk').iterator(chunk_size=5000):
+            self.lots.setdefault(lot.symbol, deque()).append(lot)
+        self.positions = {position.symbol: position for position in Position.objects.filter(user=user)}
+        # Sales are added to the positions' realized totals at the user's current tax rates, as process_sell adds them
+        refresh_realized_tax(user.pk, self.positions.values(), self.tax_rate_STCG, self.tax_rate_LTCG)
+        self.last_timestamp = Transaction.objects.filter(user=user).aggregate(last=Max('timestamp'))['last']
+
+        self.new_transactions = []
+        self.new_lots = []
+        self.changed_lots = {}
+        self.closed_lots = []
+        self.changed_positions = {}
+
+    def _position(self, symbol):
+        position = self.positions.get(symbol)
+        if position is None:
+            position = self.positions[symbol] = Position(user=self.user, symbol=symbol)
+        self.changed_positions[symbol] = position
+        return position
+
+    def apply(self, trade):
+        # Lots are filled in the order they were bought, so each user's trades must come in time order
+        if self.last_timestamp is not None and trade.timestamp < self.last_timestamp:
+            raise TradeImportError(f'line { trade.line }: trade is older than { self.user }\'s previous trade; a user\'s trades must be in time order')
+        self.last_timestamp = trade.timestamp
+        if trade.type == 'BOT':
+            self.buy(trade)
+        else:
+            self.sell(trade)
+
+    # As process_buy, at the trade's price
+    def buy(self, trade):
+        total = trade.shares * trade.price
+        if total > self.profile.cash:
+            raise TradeImportError(f'line { trade.line }: { self.user } has insufficient cash ({ self.profile.cash }) for a purchase of { total }')
+        self.profile.cash -= total
+
+        new_transaction = Transaction(
+            user_id=self.user.pk,
+            timestamp=trade.timestamp,
+            type='BOT',
+            symbol=trade.symbol,
+            transaction_shares=trade.shares,
+            shares_outstanding=trade.shares,
+            transaction_value_per_share=trade.price,
+            transaction_value_total=total,
+        )
+        lot = OpenLot(
+            user_id=self.user.pk,
+            transaction=new_transaction,
+            symbol=trade.symbol,
+            timestamp=trade.timestamp,
+            shares_outstanding=trade.shares,
+            transaction_value_per_share=trade.price,
+        )
+        self.new_transactions.append(new_transaction)
+        self.new_lots.append(lot)
+        self.lots.setdefault(trade.symbol, deque()).append(lot)
+
+        position = self._position(trade.symbol)
+        position.transaction_shares += trade.shares
+        position.shares_outstanding += trade.shares
+
+    # As process_sell, at the trade's price and with gains short-term for lots bought in the year before the trade
+    def sell(self, trade):
+        position = self.positions.get(trade.symbol)
+        if position is None or position.shares_outstanding < trade.shares:
+            raise TradeImportError(f'line { trade.line }: { self.user } does not hold { trade.shares } shares of { trade.symbol }')
+
+        cutoff_date = trade.timestamp - timezone.timedelta(days=365)
+        lots = self.lots[trade.symbol]
+        fill = fill_sale(reversed(lots) if self.lifo else lots, trade.shares, trade.price, cutoff_date, self.tax_rate_STCG, self.tax_rate_LTCG)
+        for _ in fill.closed_lots:
+            lots.pop() if self.lifo else lots.popleft()
+
+        # Lots read from the DB (or written by an earlier chunk) are updated or deleted at the next flush(). Lots
+        # opened since the last flush() are inserted then, with their BOT transactions, as they stand at that point.
+        for lot in fill.closed_lots + ([fill.partial_lot] if fill.partial_lot else []):
+            if lot.pk is None:
+                lot.transaction.shares_outstanding = lot.shares_outstanding
+            elif lot.shares_outstanding:
+                self.changed_lots[lot.pk] = lot
+            else:
+                self.changed_lots.pop(lot.pk, None)
+                self.closed_lots.append(lot)
+
+        new_transaction = Transaction(
+            user_id=self.user.pk,
+            timestamp=trade.timestamp,
+            type='SLD',
+            symbol=trade.symbol,
+            transaction_shares=trade.shares,
+            transaction_value_per_share=trade.price,
+            transaction_value_total=(trade.shares * trade.price).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP),
+            STCG=fill.STCG,
+            LTCG=fill.LTCG,
+            STCG_tax=fill.STCG_tax,
+            LTCG_tax=fill.LTCG_tax,
+        )
+        self.new_transactions.append(new_transaction)
+        self.profile.cash += new_transaction.transaction_value_total
+
+        position = self._position(trade.symbol)
+        position.shares_outstanding -= trade.shares
+        add_sale(position, new_transaction, self.tax_rate_STCG, self.tax_rate_LTCG)
+
+    # Writes everything replayed since the last flush()
+    def flush(self):
+        # Transactions are inserted in trade order, so their ids follow the trades as they would had each gone through
+        # process_buy or process_sell (sales are filled, and the history listed, by timestamp and then id).
+        # bulk_create() sets their pks, for the open lots that refer to them; lots sold out since they were opened
+        # are never inserted.
+        Transaction.objects.bulk_create(self.new_transactions)
+        OpenLot.objects.bulk_create([lot for lot in self.new_lots if lot.shares_outstanding])
+
+        # Lots from before this chunk that were sold from, and their BOT transactions
+        Transaction.objects.bulk_update(
+            [Transaction(pk=lot.transaction_id, shares_outstanding=lot.shares_outstanding) for lot in list(self.changed_lots.values()) + self.closed_lots],
+            ['shares_outstanding'],
+        )
+        OpenLot.objects.bulk_update(self.changed_lots.values(), ['shares_outstanding'])
+        closed_lot_pks = [lot.pk for lot in self.closed_lots]
+        for start in range(0, len(closed_lot_pks), 500):
+            OpenLot.objects.filter(pk__in=closed_lot_pks[start:start + 500]).delete()
+
+        Position.objects.bulk_create(
+            self.changed_positions.values(),
+            update_conflicts=True,
+            unique_fields=['user', 'symbol'],
+            update_fields=['transaction_shares', 'shares_outstanding', *REALIZED_FIELDS],
+        )
+        # Saving the profile also invalidates the user's cached portfolio (see brokerage/signals.py); bulk_create
+        # does not send the Transaction signals that otherwise would
+        self.profile.save(update_fields=['cash'])
+
+        self.new_transactions, self.new_lots, self.closed_lots = [], [], []
+        self.changed_lots, self.changed_positions = {}, {}
+
+
+# Imports trades (an iterable of Trades, e.g. from read_trades()), chunk_size trades per DB transaction. With
+# create_users, users not yet in the DB are created with cash to trade with; otherwise, they are an error. On an
+# error, the chunk being imported is rolled back and TradeImportError raised; earlier chunks stay imported.
+# Returns counts of the trades imported and the users they were imported for.
+def import_trades(trades, chunk_size=None, create_users=False, cash=None):
+    chunk_size = chunk_size or settings.TRADE_IMPORT_CHUNK_SIZE
+    cash = Decimal(cash if cash is not None else settings.TRADE_IMPORT_USER_CASH)
+    accounts = {}
+    counts = {'trades': 0, 'users': 0, 'users_created': 0, 'chunks': 0}
+
+    chunk = []
+    for trade in trades:
+        chunk.append(trade)
+        if len(chunk) == chunk_size:
+            _import_chunk(chunk, accounts, create_users, cash, counts)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, accounts, create_users, cash, counts)
+
+    counts['users'] = len(accounts)
+    logger.info(f'running import_trades() ... imported { counts["trades"] } trades for { counts["users"] } users in { counts["chunks"] } chunks')
+    return counts
+
+
+def _import_chunk(chunk, accounts, create_users, cash, counts):
+    touched = {}
+    try:
+        with transaction.atomic():
+            for trade in chunk:
+                account = accounts.get(trade.username)
+                if account is None:
+                    account = accounts[trade.username] = _Account(_get_user(trade, create_users, cash, counts))
+                account.apply(trade)
+                touched[trade.username] = account
+            for account in touched.values():
+                account.flush()
+    except TradeImportError:
+        # The accounts' in-memory state is ahead of the rolled back DB, so they cannot be used again
+        accounts.clear()
+        raise
+    counts['trades'] += len(chunk)
+    counts['chunks'] += 1
+    logger.debug(f'running import_trades() ... imported chunk { counts["chunks"] } of { len(chunk) } trades')
+
+
+def _get_user(trade, create_users, cash, counts):
+    user = User.objects.select_related('userprofile').filter(username=trade.username).first()
+    if user is None and create_users:
+        user = User.objects.create(username=trade.username, email=f'{ trade.username }@example.com')
+        UserProfile.objects.create(user=user, cash=cash, cash_initial=cash, confirmed=True)
+        counts['users_created'] += 1
+        return User.objects.select_related('userprofile').get(pk=user.pk)
+    if user is None:
+        raise TradeImportError(f'line { trade.line }: no user { trade.username!r} (use --create-users to create users)')
+    if not hasattr(user, 'userprofile'):
+        raise TradeImportError(f'line { trade.line }: user { trade.username!r} has no profile')
+    return user
@@ -0,0 +1,185 @@
+import csv
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.conf import settings
+from django.db.models import DecimalField, ExpressionWrapper, F, FloatField, Q, Value
+from django.db.models.functions import Cast
+import json
+import logging
+from ..models import Transaction
+__all__ = ['annotate_history', 'history_page', 'iter_history_csv', 'iter_history_ndjson', 'HistoryPage', 'HISTORY_EXPORT_COLUMNS']
+
+logger = logging.getLogger('django')
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Output types of the annotations below: amounts in dollars and cents, ratios as they come
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+RATIO = DecimalField()
+RATIO_CAST = DecimalField(max_digits=20, decimal_places=10)
+CENTS = Decimal('0.01')
+
+# The annotations below that are amounts. SQLite returns computed amounts as they come (e.g. 100 rather than 100.00,
+# as it stores whole-dollar amounts as integers), so they are rounded to cents as rows are read (see _round_money()).
+MONEY_ANNOTATIONS = ['total_CG_pre_tax', 'total_CG_tax', 'STCG_post_tax', 'LTCG_post_tax', 'total_CG_post_tax']
+
+
+# numerator / denominator as a decimal. Both are divided as floats: SQLite stores whole-dollar amounts as integers
+# (and casts to a decimal keep them so), and would divide them by integer division, e.g. a $100 gain on a $1,000 sale
+# as 0.
+def _ratio(numerator, denominator):
+    return Cast(Cast(numerator, FloatField()) / Cast(denominator, FloatField()), RATIO_CAST)
+
+
+# Adds the derived columns shown on /history (and in its export) to a Transaction queryset, computed by the database
+# rather than row by row in Python. They are NULL for purchases, which have no capital gains.
+# user_profile supplies the tax rates, which are stored as percentages.
+def annotate_history(queryset, user_profile):
+    STCG_kept = Value(1 - user_profile.tax_rate_STCG / 100, output_field=RATIO)
+    LTCG_kept = Value(1 - user_profile.tax_rate_LTCG / 100, output_field=RATIO)
+    return queryset.annotate(
+        total_CG_pre_tax=ExpressionWrapper(F('STCG') + F('LTCG'), output_field=MONEY),
+        total_CG_pre_tax_percent=_ratio(F('STCG') + F('LTCG'), F('transaction_value_total')),
+        total_CG_tax=ExpressionWrapper(F('LTCG_tax') + F('STCG_tax'), output_field=MONEY),
+        STCG_post_tax=ExpressionWrapper(F('STCG') * STCG_kept, output_field=MONEY),
+        LTCG_post_tax=ExpressionWrapper(F('LTCG') * LTCG_kept, output_field=MONEY),
+        total_CG_post_tax=ExpressionWrapper(F('STCG') * STCG_kept + F('LTCG') * LTCG_kept, output_field=MONEY),
+        total_CG_post_tax_percent=_ratio(F('STCG') * STCG_kept + F('LTCG') * LTCG_kept, F('transaction_value_total')),
+    )
+
+
+# Rounds the MONEY_ANNOTATIONS of a Transaction from annotate_history() to cents, in place
+def _round_money(transaction):
+    for name in MONEY_ANNOTATIONS:
+        value = getattr(transaction, name)
+        if value is not None:
+            setattr(transaction, name, value.quantize(CENTS))
+    return transaction
+
+
+# One page of a user's history, oldest first. older_cursor and newer_cursor are the cursors for the neighbouring
+# pages, or None where there is no such page.
+@dataclass(slots=True)
+class HistoryPage:
+    transactions: list
+    older_cursor: str = None
+    newer_cursor: str = None
+
+
+# A cursor marks a position in the (timestamp, id) order as '<microseconds since the epoch>_<id>'
+def _encode_cursor(transaction):
+    return f'{ (transaction.timestamp - EPOCH) // ONE_MICROSECOND }_{ transaction.pk }'
+
+
+# Returns (timestamp, id) for a cursor, or None if it is not a valid one
+def _decode_cursor(cursor):
+    try:
+        timestamp_us, pk = (int(part) for part in cursor.split('_'))
+        return EPOCH + timedelta(microseconds=timestamp_us), pk
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def _older_than(timestamp, pk):
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+
+
+def _newer_than(timestamp, pk):
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk)
+
+
+# Returns a page of the user's transactions, oldest first (as /history has always listed them): the first page, the
+# page of transactions newer than the 'after' cursor, or the page of those older than the 'before' cursor. Pages are
+# found by seeking on the (user, timestamp, id) index (keyset pagination) rather than by OFFSET, so every page costs
+# the same however long the user's history is. An invalid cursor gives the first page.
+def history_page(user, before=None, after=None, page_size=None):
+    page_size = page_size or settings.HISTORY_PAGE_SIZE
+    transactions = annotate_history(Transaction.objects.filter(user=user), user.userprofile)
+    before, after = _decode_cursor(before), _decode_cursor(after)
+
+    if before is not None:
+        # Read downwards from the cursor, then put the page back in oldest-first order
+        rows = list(transactions.filter(_older_than(*before)).order_by('-timestamp', '-pk')[:page_size + 1])
+        has_older = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_newer = bool(rows) and Transaction.objects.filter(_newer_than(rows[-1].timestamp, rows[-1].pk), user=user).exists()
+    else:
+        if after is not None:
+            transactions = transactions.filter(_newer_than(*after))
+        rows = list(transactions.order_by('timestamp', 'pk')[:page_size + 1])
+        has_newer = len(rows) > page_size
+        rows = rows[:page_size]
+        has_older = after is not None and bool(rows) and Transaction.objects.filter(_older_than(rows[0].timestamp, rows[0].pk), user=user).exists()
+
+    # A cursor past the end of the history (e.g. from a stale link) gives the first page
+    if not rows and (before or after):
+        return history_page(user, page_size=page_size)
+
+    logger.debug(f'running history_page() ... for user { user.id } ... { len(rows) } transactions')
+    return HistoryPage(
+        transactions=[_round_money(row) for row in rows],
+        older_cursor=_encode_cursor(rows[0]) if rows and has_older else None,
+        newer_cursor=_encode_cursor(rows[-1]) if rows and has_newer else None,
+    )
+
+
+# The columns of the history export, in order: the Transaction columns shown on /history, then annotate_history()'s
+HISTORY_EXPORT_COLUMNS = [
+    'id', 'timestamp', 'type', 'symbol', 'transaction_shares', 'transaction_value_per_share', 'transaction_value_total',
+    'STCG', 'LTCG', 'total_CG_pre_tax', 'total_CG_pre_tax_percent', 'STCG_tax', 'LTCG_tax', 'total_CG_tax',
+    'STCG_post_tax', 'LTCG_post_tax', 'total_CG_post_tax', 'total_CG_post_tax_percent',
+]
+
+
+# Yields the user's whole history, oldest first, as tuples of HISTORY_EXPORT_COLUMNS with the timestamp in ISO 8601
+# and amounts in cents.
+# Rows are fetched from the DB HISTORY_EXPORT_CHUNK_SIZE at a time and never held all at once, so memory use does not
+# grow with the history.
+def _iter_history_rows(user):
+    transactions = annotate_history(Transaction.objects.filter(user=user), user.userprofile)
+    rows = transactions.order_by('timestamp', 'pk').values_list(*HISTORY_EXPORT_COLUMNS).iterator(chunk_size=settings.HISTORY_EXPORT_CHUNK_SIZE)
+    timestamp_index = HISTORY_EXPORT_COLUMNS.index('timestamp')
+    money_indexes = [HISTORY_EXPORT_COLUMNS.index(name) for name in MONEY_ANNOTATIONS]
+    for row in rows:
+        row = list(row)
+        row[timestamp_index] = row[timestamp_index].isoformat()
+        for index in money_indexes:
+            if row[index] is not None:
+                row[index] = row[index].quantize(CENTS)
+        yield tuple(row)
+
+
+# Joins the lines for rows into strings of up to HISTORY_EXPORT_CHUNK_SIZE rows, so a streamed response writes
+# chunks of a sensible size rather than a line at a time
+def _join_lines(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == settings.HISTORY_EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+# Takes the line csv.writer() writes and returns it, rather than writing it anywhere
+class _Echo:
+    def write(self, value):
+        return value
+
+
+# Yields the user's history as CSV text: a header row, then one row per transaction. Empty cells for purchases.
+def iter_history_csv(user):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(HISTORY_EXPORT_COLUMNS)
+    yield from _join_lines(writer.writerow(row) for row in _iter_history_rows(user))
+
+
+# Yields the user's history as newline-delimited JSON: one object per transaction, with Decimals as strings and
+# nulls for purchases
+def iter_history_ndjson(user):
+    encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+    yield from _join_lines(encoder.encode(dict(zip(HISTORY_EXPORT_COLUMNS, row))) + '\n' for row in _iter_history_rows(user))
@@ -0,0 +1,172 @@
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from django.conf import settings
+import logging
+__all__ = ['build_lot_columns', 'LotColumns', 'value_open_lots_vectorized', 'vectorized_valuation_available']
+
+logger = logging.getLogger('django')
+
+# NumPy is optional: without it (or with PORTFOLIO_VALUATION_ENGINE = 'decimal') every portfolio is valued lot by lot
+# in Decimal, as before.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+# Quotes with more decimal places than this are valued in Decimal
+MAX_PRICE_DECIMALS = 6
+
+# Every per-lot amount and every per-symbol sum must stay below this, so int64 arithmetic can never overflow
+INT64_LIMIT = 2 ** 62
+
+
+# The open lots of a snapshot as columns of 64-bit ints, ordered by position (in PortfolioSnapshot.positions order),
+# then by lot: the position index, shares outstanding, cost per share in cents, and the purchase time in microseconds
+# since the epoch. Kept as stdlib arrays, so a cached snapshot unpickles without NumPy, and read by NumPy without a
+# copy.
+@dataclass(slots=True, eq=False)
+class LotColumns:
+    position_index: array
+    shares: array
+    cost_cents: array
+    timestamp_us: array
+
+    def __len__(self):
+        return len(self.shares)
+
+    # Pickles as the field values alone, in field order
+    def __reduce__(self):
+        return (type(self), tuple(getattr(self, name) for name in self.__slots__))
+
+
+# True if portfolios can be valued by value_open_lots_vectorized()
+def vectorized_valuation_available():
+    return np is not None and settings.PORTFOLIO_VALUATION_ENGINE != 'decimal'
+
+
+def _timestamp_us(timestamp):
+    return (timestamp - EPOCH) // ONE_MICROSECOND
+
+
+# Lays out the open lots of a snapshot as LotColumns. Returns None if the lots cannot be represented exactly (a cost
+# with fractions of a cent, or a lot without a position), if there are too few lots for vectorizing to pay off, or if
+# vectorized valuation is unavailable; value_portfolio() then values lot by lot.
+def build_lot_columns(positions, open_lots):
+    if not vectorized_valuation_available() or not open_lots or len(open_lots) < settings.PORTFOLIO_VECTORIZE_MIN_LOTS:
+        return None
+
+    position_indexes = {position.symbol: index for index, position in enumerate(positions)}
+    rows = []
+    for lot in open_lots:
+        position_index = position_indexes.get(lot.symbol)
+        cost_cents = lot.transaction_value_per_share * 100
+        if position_index is None or cost_cents != cost_cents.to_integral_value():
+            return None
+        rows.append((position_index, lot.shares_outstanding, int(cost_cents), _timestamp_us(lot.timestamp)))
+
+    # Stable, so each position's lots keep their order
+    rows.sort(key=lambda row: row[0])
+    return LotColumns(*(array('q', column) for column in zip(*rows)))
+
+
+# Returns value as an int number of 10^-scale units, or None if that is not exact
+def _to_units(value, scale):
+    if not value.is_finite():
+        return None
+    units = value.scaleb(scale)
+    return int(units) if units == units.to_integral_value() else None
+
+
+# Values all open lots of a snapshot at once and adds the results to the SymbolData in portfolio.portfolio_data,
+# exactly as value_portfolio()'s lot-by-lot loop does. Returns False, having changed nothing, if the snapshot has no
+# LotColumns or its amounts cannot be held exactly in int64; the caller then values it lot by lot instead.
+# Every amount is an integer count of a fixed unit: shares, cents for costs, 10^-scale for prices and market values
+# (scale being the most decimal places of any quote, at least 2), and 10^-(scale + 2) once multiplied by a tax rate,
+# itself an integer count of hundredths. The per-symbol sums are therefore exact, and become the same Decimal values
+# the lot-by-lot loop arrives at.
+def value_open_lots_vectorized(portfolio, snapshot, cutoff_date):
+    columns = snapshot.lot_columns
+    if columns is None or not vectorized_valuation_available():
+        return False
+
+    symbol_data_list = [portfolio.get_symbol_data(position.symbol) for position in snapshot.positions]
+    prices = [symbol_data.market_value_per_share for symbol_data in symbol_data_list]
+    if not all(price.is_finite() for price in prices):
+        return False
+    scale = max([2] + [-price.as_tuple().exponent for price in prices])
+    rates = [_to_units(rate, 2) for rate in (snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)]
+    if scale > MAX_PRICE_DECIMALS or None in rates:
+        return False
+    rate_STCG, rate_LTCG = rates
+    price_units = [_to_units(price, scale) for price in prices]
+
+    position_index = np.frombuffer(columns.position_index, dtype=np.int64)
+    shares = np.frombuffer(columns.shares, dtype=np.int64)
+    cost_cents = np.frombuffer(columns.cost_cents, dtype=np.int64)
+    timestamp_us = np.frombuffer(columns.timestamp_us, dtype=np.int64)
+
+    # Lots never hold negative shares; if one did, the lot-by-lot loop's running ratios could differ from ratios of
+    # the final sums, so leave it to the loop
+    if shares.min() < 0:
+        return False
+    cost_factor = 10 ** (scale - 2)
+    largest_unit = max(max(abs(units) for units in price_units), int(cost_cents.max()) * cost_factor)
+    largest_rate = max(abs(rate_STCG), abs(rate_LTCG), 100)
+    if int(shares.max()) * largest_unit * largest_rate * 4 * len(shares) >= INT64_LIMIT:
+        return False
+
+    # Per lot, in 10^-scale units (lots with no shares come out as all zeros, as in the loop)
+    market_value = shares * np.array(price_units, dtype=np.int64)[position_index]
+    cost_basis = shares * cost_cents * cost_factor
+    gain = market_value - cost_basis
+    short_term = timestamp_us > _timestamp_us(cutoff_date)
+    STCG = np.where(short_term, gain, 0)
+    LTCG = gain - STCG
+
+    # Per lot, in 10^-(scale + 2) units
+    gain_taxed = gain * np.where(short_term, rate_STCG, rate_LTCG)
+    tax = np.where(gain > 0, gain_taxed, 0)
+    STCG_tax = np.where(short_term, tax, 0)
+    LTCG_tax = tax - STCG_tax
+    tax_offset = np.where(gain > 0, 0, np.abs(gain_taxed * snapshot.tax_offset_coefficient))
+    market_value_post_tax = market_value * 100 - tax
+
+    # Sums per position; lots are grouped by position, so each group is one contiguous run
+    starts = np.flatnonzero(np.concatenate(([True], position_index[1:] != position_index[:-1])))
+    sums = {
+        name: np.add.reduceat(values, starts).tolist()
+        for name, values in [
+            ('shares', shares), ('cost_basis', cost_basis), ('market_value', market_value), ('STCG', STCG), ('LTCG', LTCG),
+            ('STCG_tax', STCG_tax), ('LTCG_tax', LTCG_tax), ('tax_offset', tax_offset), ('market_value_post_tax', market_value_post_tax),
+        ]
+    }
+
+    for group, index in enumerate(position_index[starts].tolist()):
+        symbol_data = symbol_data_list[index]
+        amount = lambda name, unit_scale=scale: Decimal(sums[name][group]).scaleb(-unit_scale)
+
+        symbol_data.shares_outstanding += sums['shares'][group]
+        symbol_data.cost_basis_total += amount('cost_basis')
+        symbol_data.STCG_unrealized += amount('STCG')
+        symbol_data.LTCG_unrealized += amount('LTCG')
+        symbol_data.CG_total_unrealized += amount('STCG') + amount('LTCG')
+        symbol_data.market_value_total_pre_tax += amount('market_value')
+        symbol_data.STCG_tax_unrealized += amount('STCG_tax', scale + 2)
+        symbol_data.LTCG_tax_unrealized += amount('LTCG_tax', scale + 2)
+        symbol_data.CG_total_tax_unrealized += amount('STCG_tax', scale + 2) + amount('LTCG_tax', scale + 2)
+        symbol_data.CG_tax_offset_unrealized += amount('tax_offset', scale + 2)
+        symbol_data.market_value_post_tax += amount('market_value_post_tax', scale + 2)
+
+        if symbol_data.shares_outstanding > 0:
+            symbol_data.cost_basis_per_share = symbol_data.cost_basis_total / symbol_data.shares_outstanding
+            symbol_data.gain_or_loss_pre_tax_percent = symbol_data.CG_total_unrealized / symbol_data.cost_basis_total
+            symbol_data.return_percent_post_tax = (symbol_data.market_value_post_tax / symbol_data.cost_basis_total) - 1
+
+    logger.debug(f'running value_open_lots_vectorized() ... valued { len(shares) } open lots in { len(starts) } positions')
+    return True
@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand
+import pickle
+from ...benchmarks import BENCHMARK_SYMBOLS, benchmark_database, create_synthetic_user, deep_getsizeof, seed_trade_history, time_call
+from ...helpers import SaleData, build_portfolio_snapshot, read_sell_transactions, value_portfolio
+from ...helpers.portfolio_serializer import PortfolioSerializer
+from ...models import Transaction
+
+
+# Compares the slotted Portfolio, SymbolData, SaleData and PortfolioSnapshot classes against the layout they replaced
+# (a plain object with a __dict__ of attributes, a dict per symbol and a Transaction model instance per sale), for a
+# synthetic user: memory held, pickle size, and pickle/unpickle time. The snapshot, which is what the cache holds, is also measured under PortfolioSerializer.
+# Usage: python manage.py benchmark_portfolio_size --transactions 5000 --symbols 50
+class Command(BaseCommand):
+    help = 'Benchmarks the memory and pickle size of portfolio objects against their previous dict-based layout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=5000, help='Transactions in the synthetic trade history')
+        parser.add_argument('--symbols', type=int, default=50, help='Symbols traded (at least the 12 benchmark symbols)')
+        parser.add_argument('--repeat', type=int, default=50, help='Timed runs per measurement')
+
+    def handle(self, *args, **options):
+        symbols = list(BENCHMARK_SYMBOLS) + [f'SYM{ i:03d}' for i in range(max(options['symbols'] - len(BENCHMARK_SYMBOLS), 0))]
+        with benchmark_database():
+            user = create_synthetic_user('benchmark_user')
+            prices = seed_trade_history(user, options['transactions'], symbols=symbols)
+            snapshot = build_portfolio_snapshot(user)
+            quotes = {symbol: {'symbol': symbol, 'price': float(price)} for symbol, price in prices.items()}
+            portfolio = value_portfolio(snapshot, quotes)
+            # As /index_detail shows it
+            portfolio.sell_transactions = read_sell_transactions(user, snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)
+
+        self.stdout.write(f'{ options["transactions"] } transactions, { len(portfolio.portfolio_data) } open positions, '
+                          f'{ len(portfolio.sell_transactions) } sales, { len(snapshot.open_lots) } open lots')
+        rows = [
+            ('portfolio_data', legacy_copy(portfolio).portfolio_data, portfolio.portfolio_data),
+            ('Portfolio', legacy_copy(portfolio), portfolio),
+            ('PortfolioSnapshot', legacy_copy(snapshot), snapshot),
+        ]
+        for name, before, after in rows:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{ name }'))
+            self.report('dict-based', before, options['repeat'])
+            self.report('slotted', after, options['repeat'])
+        self.report('slotted + PortfolioSerializer', snapshot, options['repeat'], PortfolioSerializer())
+
+    def report(self, label, obj, repeat, serializer=None):
+        dumps = serializer.dumps if serializer else lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        loads = serializer.loads if serializer else pickle.loads
+        data = dumps(obj)
+        dumps_timings = time_call(lambda: dumps(obj), repeat=repeat)
+        loads_timings = time_call(lambda: loads(data), repeat=repeat)
+        self.stdout.write(
+            f'  { label:<30} memory { deep_getsizeof(obj):>10,} B   pickled { len(data):>9,} B   '
+            f'dumps p50 { dumps_timings["p50_ms"]:7.3f} ms   loads p50 { loads_timings["p50_ms"]:7.3f} ms'
+        )
+
+
+# Stand-in for the previous layout: attributes in an instance __dict__
+class LegacyObject:
+    pass
+
+
+# Copies a slotted portfolio object into the previous layout: each SymbolData turned back into a dict and each
+# SaleData into a Transaction carrying its metrics as extra attributes
+def legacy_copy(obj):
+    legacy = LegacyObject()
+    for name in obj.__slots__:
+        value = getattr(obj, name)
+        if name == 'portfolio_data':
+            value = {symbol: {field: getattr(data, field) for field in data.__slots__} for symbol, data in value.items()}
+        elif name == 'sell_transactions':
+            value = [legacy_transaction(sale) for sale in value]
+        setattr(legacy, name, value)
+    return legacy
+
+
+def legacy_transaction(sale):
+    transaction = Transaction.from_db('default', SaleData.COLUMNS, [getattr(sale, column) for column in SaleData.COLUMNS])
+    for name in sale.__slots__[len(SaleData.COLUMNS):]:
+        setattr(transaction, name, getattr(sale, name))
+    return transaction
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from ...benchmarks import benchmark_database, create_synthetic_user, seed_trade_history, time_call
+from ...models import Transaction
+
+
+# Seeds a throwaway database with a user holding a long trade history and reports the query plan and latency of each
+# Transaction access path the brokerage app uses. With --compare, the composite indexes are then dropped and the
+# same queries re-run, to show what the indexes buy us.
+# Usage: python manage.py benchmark_transaction_indexes --transactions 100000 --compare
+class Command(BaseCommand):
+    help = 'Benchmarks the Transaction query plans and latencies against a synthetic trade history.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transactions', type=int, default=100000, help='Transactions seeded for the benchmarked user')
+        parser.add_argument('--other-users', type=int, default=3, help='Additional users seeded with the same history size')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per query')
+        parser.add_argument('--compare', action='store_true', help='Re-run every query with the composite indexes dropped')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            self.stdout.write(f'Seeding { options["transactions"] } transactions for { options["other_users"] + 1 } user(s) ...')
+            user = create_synthetic_user('benchmark_user')
+            seed_trade_history(user, options['transactions'])
+            for i in range(options['other_users']):
+                seed_trade_history(create_synthetic_user(f'benchmark_user_{i}'), options['transactions'], seed=i + 1)
+            # Refresh the planner's statistics, as a long-lived production database would have them
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+            queries = self.get_queries(user)
+            results = {'with indexes': self.run_queries(queries, options['repeat'])}
+
+            if options['compare']:
+                with connection.schema_editor() as schema_editor:
+                    for index in Transaction._meta.indexes:
+                        schema_editor.remove_index(Transaction, index)
+                results['without indexes'] = self.run_queries(queries, options['repeat'])
+
+        for label, rows in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\n{ label }'))
+            for name, plan, timings in rows:
+                self.stdout.write(f'{ name }: p50 { timings["p50_ms"]:.2f} ms, p95 { timings["p95_ms"]:.2f} ms, p99 { timings["p99_ms"]:.2f} ms')
+                for line in plan:
+                    self.stdout.write(f'    { line }')
+
+    # The querysets below mirror the app's access paths (see brokerage/views.py and brokerage/helpers/)
+    def get_queries(self, user):
+        symbol = Transaction.objects.filter(user=user, type='BOT').values_list('symbol', flat=True).first()
+        return {
+            # sell_view: symbols the user has bought
+            'sell_view distinct symbols': Transaction.objects.filter(user=user, type='BOT').values_list('symbol', flat=True).distinct(),
+            # process_user_transactions: the user's sales
+            'process_user_transactions sales': Transaction.objects.filter(user=user, type='SLD').order_by('id').values_list('id', 'STCG', 'LTCG'),
+            # check_valid_shares: shares the user holds in one symbol
+            'check_valid_shares shares owned': Transaction.objects.filter(user=user, symbol=symbol, type='BOT').values('user').annotate(total_shares=Sum('shares_outstanding')).values('total_shares'),
+            # Per-symbol lots in FIFO order (first chunk read when filling a sale)
+            'lots by symbol in FIFO order': Transaction.objects.filter(user=user, symbol=symbol, type='BOT').order_by('timestamp')[:20],
+        }
+
+    def run_queries(self, queries, repeat):
+        rows = []
+        for name, queryset in queries.items():
+            plan = queryset.explain().splitlines()
+            timings = time_call(lambda: list(queryset.all()), repeat=repeat)
+            rows.append((name, plan, timings))
+        return rows
@@ -0,0 +1,143 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+import multiprocessing
+import os
+import pickle
+import tempfile
+import time
+from ...benchmarks import benchmark_database, create_synthetic_user, seed_trade_history, time_call
+from ...helpers import build_portfolio_snapshot, value_portfolio
+
+
+# Exercises a deployed cache backend the way the app uses it, without touching the real cache or any network service
+# (except the Redis server itself, when checking the redis backend). SQLiteCache and PortfolioSerializer are covered
+# by the test suite (utils/tests.py, brokerage/tests.py); this command is for checking a live backend, e.g. a Redis
+# server or a sqlite cache on the production disk, and for measuring the serializer against real data:
+#   - the basic operations, expiry, and atomic add() and incr()
+#   - add() and incr() raced from several processes, as gunicorn workers would (the cross-worker check)
+#   - a portfolio snapshot from a synthetic trade history round-tripped through the cache: its size under plain
+#     pickle vs. the configured serializer, the round-trip time, and that it values to the same portfolio
+# The sqlite backend is checked against a temporary file unless --location is given.
+# Usage: python manage.py check_cache --backend sqlite --workers 8
+class Command(BaseCommand):
+    help = 'Checks that a cache backend is shared and atomic across processes, and measures the portfolio serializer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=list(settings.CACHE_BACKENDS), default=settings.CACHE_BACKEND, help='Backend from CACHE_BACKENDS to check')
+        parser.add_argument('--location', help='Override the backend LOCATION (e.g. a Redis URL of a scratch database)')
+        parser.add_argument('--workers', type=int, default=4, help='Processes racing add() and incr()')
+        parser.add_argument('--increments', type=int, default=200, help='incr() calls per process')
+        parser.add_argument('--transactions', type=int, default=2000, help='Transactions in the synthetic trade history')
+
+    def handle(self, *args, **options):
+        params = dict(settings.CACHE_BACKENDS[options['backend']])
+        if options['location']:
+            params['LOCATION'] = options['location']
+        elif options['backend'] == 'sqlite':
+            params['LOCATION'] = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        cache = self.create_cache(params)
+        self.stdout.write(f'Checking { params["BACKEND"] } at { params["LOCATION"] }')
+        try:
+            cache.clear()
+        except ImportError as e:
+            raise CommandError(f'The { options["backend"] } backend is not installed: { e }')
+
+        failures = []
+        for name, check in [
+            ('basic operations', lambda: self.check_basic(cache)),
+            ('cross-process add() and incr()', lambda: self.check_processes(params, options['workers'], options['increments'])),
+            ('portfolio snapshot round trip', lambda: self.check_portfolio(cache, options['transactions'])),
+        ]:
+            try:
+                check()
+            except AssertionError as e:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f'FAIL { name }: { e }'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'ok   { name }'))
+        cache.clear()
+
+        if failures:
+            raise CommandError(f'{ len(failures) } check(s) failed: { ", ".join(failures) }')
+
+    @staticmethod
+    def create_cache(params):
+        params = dict(params)
+        backend = import_string(params.pop('BACKEND'))
+        return backend(params.pop('LOCATION', ''), params)
+
+    def check_basic(self, cache):
+        cache.set('check_key', {'a': 1}, timeout=60)
+        assert cache.get('check_key') == {'a': 1}, 'set() then get() returned a different value'
+        assert cache.get('check_missing', 'default') == 'default', 'get() of a missing key did not return the default'
+        cache.set_many({'check_many_1': 1, 'check_many_2': [2]}, timeout=60)
+        assert cache.get_many(['check_many_1', 'check_many_2', 'check_missing']) == {'check_many_1': 1, 'check_many_2': [2]}, 'get_many() mismatch'
+        assert not cache.add('check_key', 'other'), 'add() overwrote a live key'
+        assert cache.add('check_added', 'new', timeout=60) and cache.get('check_added') == 'new', 'add() of a new key failed'
+        cache.set('check_counter', 10, timeout=None)
+        assert cache.incr('check_counter') == 11 and cache.get('check_counter') == 11, 'incr() mismatch'
+        try:
+            cache.incr('check_missing')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('incr() of a missing key did not raise ValueError')
+        cache.delete('check_key')
+        assert cache.get('check_key') is None, 'delete() left the key in place'
+        cache.set('check_expiring', 'soon', timeout=1)
+        time.sleep(1.1)
+        assert cache.get('check_expiring') is None, 'an expired key was returned'
+        assert cache.add('check_expiring', 'again', timeout=60), 'add() did not replace an expired key'
+
+    # Each process opens its own connection to the backend, as each gunicorn worker would
+    def check_processes(self, params, workers, increments):
+        cache = self.create_cache(params)
+        cache.set('check_shared_counter', 0, timeout=None)
+        cache.delete('check_shared_lock')
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [context.Process(target=_race, args=(params, increments, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        locks_won = sum(results.get(timeout=120) for _ in processes)
+        for process in processes:
+            process.join()
+
+        # A fresh connection must see every worker's writes
+        counter = self.create_cache(params).get('check_shared_counter')
+        assert counter == workers * increments, f'counter is { counter }, expected { workers * increments } (increments were lost)'
+        assert locks_won == 1, f'{ locks_won } processes won the same add() lock'
+        self.stdout.write(f'     { workers } processes x { increments } incr(): counter { counter }, add() lock won once')
+
+    def check_portfolio(self, cache, transactions):
+        with benchmark_database():
+            user = create_synthetic_user('check_cache_user')
+            prices = seed_trade_history(user, transactions)
+            snapshot = build_portfolio_snapshot(user)
+            quotes = {symbol: {'symbol': symbol, 'price': float(price)} for symbol, price in prices.items()}
+
+            pickled_size = len(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+            serializer = getattr(cache, 'serializer', None) or getattr(getattr(cache, '_cache', None), '_serializer', None)
+            if serializer is not None:
+                serialized_size = len(serializer.dumps(snapshot))
+                self.stdout.write(f'     snapshot of { len(snapshot.positions) } positions, { len(snapshot.open_lots) } open lots: '
+                                  f'{ pickled_size:,} bytes pickled, { serialized_size:,} bytes serialized ({ serialized_size / pickled_size:.0%})')
+
+            timings = time_call(lambda: (cache.set('check_snapshot', snapshot, timeout=60), cache.get('check_snapshot')), repeat=20)
+            self.stdout.write(f'     set() + get() of the snapshot: p50 { timings["p50_ms"]:.2f} ms, p95 { timings["p95_ms"]:.2f} ms')
+
+            expected = value_portfolio(snapshot, quotes)
+            actual = value_portfolio(cache.get('check_snapshot'), quotes)
+            for name in ['portfolio_market_value_total_pre_tax', 'portfolio_market_value_post_tax_incl_cash', 'sld_transaction_cost_basis_total', 'sld_transaction_market_value_post_tax_total']:
+                assert getattr(actual, name) == getattr(expected, name), f'{ name } differs after the round trip'
+            assert actual.portfolio_data == expected.portfolio_data, 'per-symbol data differs after the round trip'
+
+
+# Run in each worker process: races for one add() lock and increments the shared counter
+def _race(params, increments, results):
+    cache = Command.create_cache(params)
+    won = cache.add('check_shared_lock', os.getpid(), timeout=60)
+    for _ in range(increments):
+        cache.incr('check_shared_counter')
+    results.put(int(won))
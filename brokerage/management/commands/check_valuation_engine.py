@@ -0,0 +1,50 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+import random
+from ...benchmarks import random_snapshot, time_call
+from ...helpers.process_portfolio import Portfolio, SymbolData, value_open_lots
+from ...helpers.valuation_engine import value_open_lots_vectorized, vectorized_valuation_available
+
+
+# Measures how much faster the vectorized valuation engine (brokerage/helpers/valuation_engine.py) values a large
+# portfolio's open lots than the lot-by-lot Decimal loop: one random portfolio (see random_snapshot()) of --lots open
+# lots, valued --repeat times by each engine, in memory. That both engines value portfolios identically is checked by
+# ValuationEngineTests in brokerage/tests.py.
+# Usage: python manage.py check_valuation_engine --lots 10000
+class Command(BaseCommand):
+    help = 'Benchmarks the vectorized portfolio valuation against the Decimal one.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lots', type=int, default=10000, help='Open lots in the benchmarked portfolio')
+        parser.add_argument('--symbols', type=int, default=50, help='Symbols in the benchmarked portfolio')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed valuations per engine')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if not vectorized_valuation_available():
+            raise CommandError('Vectorized valuation is unavailable: install numpy and leave PORTFOLIO_VALUATION_ENGINE unset (or "auto")')
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+
+        with override_settings(PORTFOLIO_VECTORIZE_MIN_LOTS=1):
+            snapshot, quotes = random_snapshot(rng, now, n_lots=options['lots'], n_symbols=options['symbols'])
+        results = {}
+        for name, value_lots in [('decimal', value_open_lots), ('vectorized', value_open_lots_vectorized)]:
+            results[name] = time_call(lambda: value_lots(new_portfolio(snapshot, quotes), snapshot, now), repeat=options['repeat'])
+            self.stdout.write(f'     { name:<10} { options["lots"] } lots, { options["symbols"] } symbols: '
+                              f'p50 { results[name]["p50_ms"]:.2f} ms, p95 { results[name]["p95_ms"]:.2f} ms')
+        self.stdout.write(f'     speedup (p50): { results["decimal"]["p50_ms"] / results["vectorized"]["p50_ms"]:.1f}x')
+
+
+# A Portfolio with the snapshot's symbols priced but no lots valued yet, as value_portfolio() sets it up
+def new_portfolio(snapshot, quotes):
+    portfolio = Portfolio()
+    for position in snapshot.positions:
+        portfolio.add_symbol(position.symbol, SymbolData(
+            symbol=position.symbol,
+            transaction_shares=Decimal(position.transaction_shares),
+            market_value_per_share=Decimal(str(quotes.get(position.symbol, {}).get('price', '0'))),
+        ))
+    return portfolio
@@ -0,0 +1,70 @@
+from django.core.management.base import BaseCommand, CommandError
+from ...benchmarks.fmp_stub import FMP_UPSTREAM_URL, FMPFaults, FMPStubServer, RecordedFMPData, RecordingFMPData, SyntheticFMPData, synthetic_symbols
+from ...helpers.fmp_client import fmp_key
+
+
+# Runs a local stand-in for FMP (see brokerage/benchmarks/fmp_stub.py) until interrupted, then prints the responses it
+# served. Serves synthetic data by default; --record DIR passes requests on to FMP (needs FMP_API_KEY) and records
+# what it returns, and --replay DIR serves a recording offline. Point the app at the stub with FMP_BASE_URL.
+# Usage: python manage.py fmp_stub --port 8089 --latency 80 --jitter 40 --error-rate 0.02
+#        python manage.py fmp_stub --record fixtures/fmp
+#        python manage.py fmp_stub --replay fixtures/fmp
+class Command(BaseCommand):
+    help = 'Runs a local FMP-compatible stub with injectable latency and errors, or records and replays FMP.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        source = parser.add_mutually_exclusive_group()
+        source.add_argument('--record', metavar='DIR', help='Pass requests on to FMP and record the responses to DIR')
+        source.add_argument('--replay', metavar='DIR', help='Serve the responses recorded in DIR')
+        parser.add_argument('--upstream', default=FMP_UPSTREAM_URL, help='FMP URL to record from')
+        parser.add_argument('--symbols', type=int, default=500, help='Generated symbols to serve besides the benchmark ones (synthetic data)')
+        parser.add_argument('--volatility', type=float, default=0.0, help='Move prices by up to this fraction per response (synthetic data)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds to delay every response')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more milliseconds of random delay')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 429/5xx error')
+        parser.add_argument('--hang-rate', type=float, default=0.0, help='Fraction of requests held for --hang-seconds')
+        parser.add_argument('--hang-seconds', type=float, default=10.0)
+
+    def handle(self, *args, **options):
+        if options['record']:
+            if not fmp_key:
+                raise CommandError('Recording needs FMP_API_KEY to be set')
+            source = RecordingFMPData(options['record'], fmp_key, upstream=options['upstream'])
+            description = f'recording { options["upstream"] } to { options["record"] }'
+        elif options['replay']:
+            try:
+                source = RecordedFMPData(options['replay'])
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot replay { options["replay"] }: { e }')
+            description = f'replaying { options["replay"] }'
+        else:
+            symbols = synthetic_symbols(options['symbols'], seed=options['seed'])
+            source = SyntheticFMPData(symbols, seed=options['seed'], volatility=options['volatility'])
+            description = f'synthetic data for { len(symbols) } symbols'
+
+        faults = FMPFaults(
+            latency_ms=options['latency'],
+            jitter_ms=options['jitter'],
+            error_rate=options['error_rate'],
+            hang_rate=options['hang_rate'],
+            hang_seconds=options['hang_seconds'],
+        )
+        try:
+            server = FMPStubServer((options['host'], options['port']), source, faults, seed=options['seed'])
+        except OSError as e:
+            raise CommandError(f'Cannot listen on { options["host"] }:{ options["port"] }: { e }')
+
+        self.stdout.write(f'FMP stub serving { description } at { server.base_url }')
+        self.stdout.write(f'Point the app at it with FMP_BASE_URL={ server.base_url }  (Ctrl-C to stop)')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        for (kind, status), count in sorted(server.counts.items()):
+            self.stdout.write(f'     { kind:<10} { status }  { count }')
@@ -0,0 +1,57 @@
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import os
+import sys
+import time
+from ...helpers.trade_import import TRADE_FILE_FORMATS, TradeImportError, import_trades, read_trades
+
+
+# Imports a CSV or NDJSON file of trades (see brokerage/helpers/trade_import.py), e.g. to seed accounts with long
+# histories for benchmarks and load tests. Each row is a trade with a timestamp, type (BOT/SLD, or buy/sell), symbol,
+# shares and the price it was made at, and the user it was made by (unless all are for --user). A user's trades must
+# be in time order. An export from /history/export can be imported as it is.
+# Usage: python manage.py import_trades trades.csv --create-users
+#        python manage.py import_trades history.ndjson --user alice
+class Command(BaseCommand):
+    help = 'Imports trades from a CSV or NDJSON file, filling sales from open lots as process_sell does.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Trade file, or '-' for standard input")
+        parser.add_argument('--format', choices=TRADE_FILE_FORMATS, help='File format (default: from the file extension)')
+        parser.add_argument('--user', help='Import every trade for this username, ignoring any user column')
+        parser.add_argument('--create-users', action='store_true', help='Create users who do not exist yet')
+        parser.add_argument('--cash', help='Starting cash of created users (default: TRADE_IMPORT_USER_CASH)')
+        parser.add_argument('--chunk-size', type=int, help='Trades per DB transaction (default: TRADE_IMPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if file_format == 'jsonl':
+            file_format = 'ndjson'
+        if file_format not in TRADE_FILE_FORMATS:
+            raise CommandError(f'Cannot tell the format of { path }, use --format { "|".join(TRADE_FILE_FORMATS) }')
+        try:
+            cash = Decimal(options['cash'] or settings.TRADE_IMPORT_USER_CASH)
+        except InvalidOperation:
+            raise CommandError(f'Invalid --cash { options["cash"] }')
+
+        start = time.perf_counter()
+        try:
+            with (open(sys.stdin.fileno(), encoding='utf-8', closefd=False) if path == '-' else open(path, encoding='utf-8', newline='')) as file:
+                counts = import_trades(
+                    read_trades(file, file_format, options['user']),
+                    chunk_size=options['chunk_size'],
+                    create_users=options['create_users'],
+                    cash=cash,
+                )
+        except OSError as e:
+            raise CommandError(f'Cannot read { path }: { e }')
+        except TradeImportError as e:
+            raise CommandError(f'Import stopped at { e } (earlier chunks of { options["chunk_size"] or settings.TRADE_IMPORT_CHUNK_SIZE } trades were imported)')
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported { counts["trades"] } trades for { counts["users"] } users ({ counts["users_created"] } created) '
+            f'in { counts["chunks"] } chunks, { elapsed:.2f} s ({ counts["trades"] / elapsed if elapsed else 0:,.0f} trades/s)'
+        ))
@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+import os
+import tempfile
+from ...benchmarks import (
+    DEFAULT_LOADTEST_MIX, FMPFaults, SyntheticFMPData, benchmark_database, compare_to_baseline, load_baseline,
+    run_load_test, save_baseline, seed_load_test_users, start_fmp_stub, synthetic_symbols,
+)
+from ...helpers import update_listings
+
+
+# Load tests the brokerage views end to end (see brokerage/benchmarks/loadtest.py), entirely offline and without
+# touching real data:
+#   - a throwaway database is seeded with --history users, one per history size given, and the listings
+#   - FMP is replaced by the local stub (brokerage/benchmarks/fmp_stub.py), with --latency/--error-rate injected
+#   - the cache is a fresh one of --cache's backend (a temporary file for sqlite), as in check_cache
+# then --requests requests are made in the --mix of routes, and throughput and p50/p95/p99 latency are reported per
+# route. Any server error (5xx), even during warmup, fails the load test, after the report and without saving a
+# baseline. --output saves the results as a baseline; --baseline compares p95 latencies with one, and fails if any
+# route is slower by more than --tolerance.
+# Usage: python manage.py loadtest --history 10,1000,10000 --requests 2000 --latency 80 --output loadtest.json
+#        python manage.py loadtest --history 10,1000,10000 --requests 2000 --latency 80 --baseline loadtest.json
+class Command(BaseCommand):
+    help = 'Load tests the brokerage views against an offline FMP stub and reports latency percentiles per route.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--history', default='10,1000,10000', help='Comma-separated trade history sizes, one synthetic user each')
+        parser.add_argument('--requests', type=int, default=1000, help='Timed requests to make')
+        parser.add_argument('--warmup', type=int, default=50, help='Untimed requests to make first')
+        parser.add_argument('--mix', help=f'Route weights as route=weight,... (default: { ",".join(f"{ r }={ w }" for r, w in DEFAULT_LOADTEST_MIX.items()) })')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--latency', type=float, default=0.0, help='Milliseconds the FMP stub delays each response')
+        parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more milliseconds of stub delay')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of FMP stub responses that are errors')
+        parser.add_argument('--cache', choices=list(settings.CACHE_BACKENDS), default=settings.CACHE_BACKEND, help='Cache backend to run with')
+        parser.add_argument('--cache-location', help='LOCATION for the cache (required for redis: use a scratch database)')
+        parser.add_argument('--output', help='Save the results to this JSON file, as a baseline')
+        parser.add_argument('--baseline', help='Compare p95 latencies with this baseline file')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown against the baseline that counts as a regression')
+
+    def handle(self, *args, **options):
+        try:
+            history_sizes = [int(size) for size in options['history'].split(',')]
+            mix = {route: float(weight) for route, weight in (item.split('=') for item in options['mix'].split(','))} if options['mix'] else None
+        except ValueError:
+            raise CommandError('--history takes numbers like 10,1000 and --mix route=weight pairs like index=20,buy=5')
+
+        cache = dict(settings.CACHE_BACKENDS[options['cache']])
+        if options['cache_location']:
+            cache['LOCATION'] = options['cache_location']
+        elif options['cache'] == 'sqlite':
+            cache['LOCATION'] = os.path.join(tempfile.mkdtemp(), 'cache.sqlite3')
+        elif options['cache'] == 'redis':
+            raise CommandError('--cache redis needs --cache-location, so the load test does not share the real cache')
+
+        faults = FMPFaults(latency_ms=options['latency'], jitter_ms=options['jitter'], error_rate=options['error_rate'])
+        stub = start_fmp_stub(SyntheticFMPData(synthetic_symbols(200, seed=options['seed']), seed=options['seed']), faults, seed=options['seed'])
+        try:
+            with benchmark_database(), override_settings(
+                FMP_BASE_URL=stub.base_url,
+                CACHES={'default': cache},
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ):
+                self.stdout.write(f'Seeding { len(history_sizes) } users with { options["history"] } trades, FMP stub at { stub.base_url }')
+                users = seed_load_test_users(history_sizes, seed=options['seed'])
+                with override_settings(FMP_MAX_RETRIES=0):
+                    if update_listings() is None:
+                        raise CommandError('Could not load the listings from the FMP stub')
+                try:
+                    result = run_load_test(users, options['requests'], mix, seed=options['seed'], warmup=options['warmup'])
+                except ValueError as e:
+                    raise CommandError(str(e))
+        finally:
+            stub.shutdown()
+            stub.server_close()
+
+        summary = self.report(result, stub)
+        server_errors = result.server_errors()
+        if server_errors:
+            raise CommandError(f'server errors (5xx) on: { ", ".join(f"{ route } x{ count }" for route, count in sorted(server_errors.items())) }')
+        if options['output']:
+            save_baseline(options['output'], summary, kind='loadtest', history=options['history'], requests=options['requests'],
+                          latency_ms=options['latency'], cache=options['cache'], seed=options['seed'])
+            self.stdout.write(f'Saved results to { options["output"] }')
+        if options['baseline']:
+            self.compare(summary, options['baseline'], options['tolerance'])
+
+    def report(self, result, stub):
+        summary = result.summary()
+        self.stdout.write(f'{ result.requests } requests in { result.elapsed:.2f} s '
+                          f'({ result.requests / sum(sum(d) for d in result.durations.values()):.1f} requests/s of request time)')
+        self.stdout.write(f'     { "route":<14}{ "requests":>9}{ "req/s":>9}{ "mean ms":>10}{ "p50 ms":>9}{ "p95 ms":>9}{ "p99 ms":>9}{ "max ms":>9}  statuses')
+        for route, timings in summary.items():
+            if not timings['runs']:
+                continue
+            statuses = ' '.join(f'{ status }x{ count }' for status, count in sorted(result.statuses[route].items()))
+            line = (f'     { route:<14}{ timings["runs"]:>9}{ timings["requests_per_second"]:>9.1f}{ timings["mean_ms"]:>10.2f}'
+                    f'{ timings["p50_ms"]:>9.2f}{ timings["p95_ms"]:>9.2f}{ timings["p99_ms"]:>9.2f}{ timings["max_ms"]:>9.2f}  { statuses }')
+            self.stdout.write(self.style.ERROR(line) if timings['errors'] else line)
+        self.stdout.write(f'     FMP stub responses: { ", ".join(f"{ kind } { status }x{ count }" for (kind, status), count in sorted(stub.counts.items())) }')
+        return summary
+
+    def compare(self, summary, path, tolerance):
+        try:
+            baseline = load_baseline(path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read the baseline { path }: { e }')
+        regressions = []
+        for route, before, after, ratio, regressed in compare_to_baseline(baseline, summary, metric='p95_ms', tolerance=tolerance, short_tolerance=tolerance):
+            line = f'     { route:<14} p95 { before:>9.2f} ms -> { after:>9.2f} ms  ({ ratio:.2f}x)'
+            self.stdout.write(self.style.ERROR(line) if regressed else line)
+            if regressed:
+                regressions.append(route)
+        if regressions:
+            raise CommandError(f'p95 latency regressed by more than { tolerance:.0%} on: { ", ".join(regressions) }')
+        self.stdout.write(self.style.SUCCESS(f'ok   no route slower than the baseline by more than { tolerance:.0%}'))
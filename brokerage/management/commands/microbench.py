@@ -0,0 +1,111 @@
+from contextlib import redirect_stdout
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+import os
+from ...benchmarks import (
+    benchmark_database, compare_to_baseline, filter_benchmarks, load_baseline, portfolio_benchmarks, save_baseline,
+    sell_benchmarks, start_fmp_stub, time_call,
+)
+
+
+# Runs the micro-benchmarks of brokerage/benchmarks/microbenchmarks.py on a throwaway database, with FMP replaced by
+# the local stub and a fresh local-memory cache, and compares them with a JSON baseline:
+#   - process_user_transactions (and its build/value halves) for histories of each of --sizes transactions
+#   - process_sell, FIFO vs. LIFO, over a stack of --depth open lots, filling each of --fills lots
+#   - the brokerage_filters template filters
+# With --baseline FILE, the results are compared with FILE's (by --metric) and the command fails if any benchmark is
+# slower by more than --tolerance; if FILE does not exist yet, the results are saved to it as the baseline. Use
+# --update-baseline to replace it, e.g. after an intended change. -k runs only benchmarks whose name contains it.
+# The fastest run (min_ms) is compared by default, and each benchmark runs for at least --min-time seconds, so that
+# the millisecond-long ones (the filters) are timed over enough runs for a busy machine not to pass for a regression.
+# Benchmarks under 10 ms in the baseline are allowed --short-tolerance rather than --tolerance (see
+# compare_to_baseline()).
+# Usage: python manage.py microbench --baseline brokerage/benchmarks/baseline.json
+#        python manage.py microbench -k process_sell --depth 20000 --repeat 50
+class Command(BaseCommand):
+    help = 'Runs micro-benchmarks of portfolio building, process_sell and the template filters against a JSON baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,1000,100000', help='Comma-separated trade history sizes for process_user_transactions')
+        parser.add_argument('--depth', type=int, default=10000, help='Open lots held when selling')
+        parser.add_argument('--fills', default='1,100', help='Comma-separated numbers of lots each sale fills')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per benchmark')
+        parser.add_argument('--warmup', type=int, default=2, help='Untimed runs per benchmark')
+        parser.add_argument('--min-time', type=float, default=0.5, help='Seconds to keep timing each benchmark for, past --repeat runs')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('-k', dest='keyword', help='Only run benchmarks whose name contains this')
+        parser.add_argument('--baseline', help='JSON baseline to compare with (created if it does not exist)')
+        parser.add_argument('--update-baseline', action='store_true', help='Save the results as the new baseline instead of comparing')
+        parser.add_argument('--metric', default='min_ms', choices=['min_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'], help='Timing compared with the baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown against the baseline that counts as a regression')
+        parser.add_argument('--short-tolerance', type=float, default=1.0, help='--tolerance for benchmarks under 10 ms in the baseline')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+            fills = [int(lots) for lots in options['fills'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes and --fills take comma-separated numbers')
+        if any(lots < 1 or lots > options['depth'] for lots in fills):
+            raise CommandError('--fills must be between 1 and --depth')
+
+        stub = start_fmp_stub(seed=options['seed'])
+        results = {}
+        try:
+            with benchmark_database(), override_settings(
+                FMP_BASE_URL=stub.base_url,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'microbench'}},
+                # Quotes stay cached for the whole run, so benchmarks time the code rather than the stub
+                QUOTE_CACHE_TIMEOUT=86400,
+            ), open(os.devnull, 'w') as devnull:
+                wanted = lambda name: not options['keyword'] or options['keyword'] in name
+                for group in [
+                    portfolio_benchmarks(sizes, seed=options['seed'], wanted=wanted),
+                    sell_benchmarks(options['depth'], fills, seed=options['seed'], wanted=wanted),
+                    filter_benchmarks(seed=options['seed'], wanted=wanted),
+                ]:
+                    for name, fn in group:
+                        # process_sell and friends print as they go
+                        with redirect_stdout(devnull):
+                            results[name] = time_call(fn, repeat=options['repeat'], warmup=options['warmup'], min_time=options['min_time'])
+                        self.report(name, results[name])
+        finally:
+            stub.shutdown()
+            stub.server_close()
+
+        if not results:
+            raise CommandError(f'No benchmark name contains { options["keyword"]!r}')
+        if options['baseline']:
+            self.check_baseline(results, options)
+
+    def report(self, name, timings):
+        self.stdout.write(f'     { name:<60} min { timings["min_ms"]:>10.3f} ms  mean { timings["mean_ms"]:>10.3f} ms  p50 { timings["p50_ms"]:>10.3f} ms  '
+                          f'p95 { timings["p95_ms"]:>10.3f} ms  max { timings["max_ms"]:>10.3f} ms')
+
+    def check_baseline(self, results, options):
+        path = options['baseline']
+        if options['update_baseline'] or not os.path.exists(path):
+            save_baseline(path, results, kind='microbench', sizes=options['sizes'], depth=options['depth'],
+                          fills=options['fills'], repeat=options['repeat'], min_time=options['min_time'], seed=options['seed'])
+            self.stdout.write(self.style.SUCCESS(f'Saved { len(results) } results to { path } as the baseline'))
+            return
+
+        try:
+            baseline = load_baseline(path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Cannot read the baseline { path }: { e }')
+        comparisons = compare_to_baseline(baseline, results, metric=options['metric'], tolerance=options['tolerance'], short_tolerance=options['short_tolerance'])
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\nAgainst { path } ({ options["metric"] }, created { baseline["meta"].get("created") }):'))
+        for name, before, after, ratio, regressed in comparisons:
+            line = f'     { name:<60} { before:>10.3f} ms -> { after:>10.3f} ms  ({ ratio:.2f}x)'
+            self.stdout.write(self.style.ERROR(line) if regressed else line)
+        missing = sorted(set(results) - {name for name, *_ in comparisons})
+        if missing:
+            self.stdout.write(f'     not in the baseline (or saved without { options["metric"] }): { ", ".join(missing) }')
+
+        regressions = [name for name, *_, regressed in comparisons if regressed]
+        if regressions:
+            raise CommandError(f'{ len(regressions) } benchmark(s) slower than the baseline by more than the tolerance: { ", ".join(regressions) }')
+        self.stdout.write(self.style.SUCCESS(f'ok   { len(comparisons) } benchmark(s) within { options["tolerance"]:.0%} of the baseline '
+                                             f'({ options["short_tolerance"]:.0%} under 10 ms)'))
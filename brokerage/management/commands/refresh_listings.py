@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...helpers import update_listings
+from utils.tasks import TaskLocked, run_task
+
+
+# Refreshes the Listing table from FMP (see update_listings). Runs off the request path, either by hand or from the
+# run_scheduler command, and takes the 'refresh_listings' task lock so that only one node refreshes at a time.
+# Usage: python manage.py refresh_listings
+class Command(BaseCommand):
+    help = 'Refreshes the listings table from FMP.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lock-timeout', type=int, default=settings.TASK_LOCK_TIMEOUT, help='Seconds before a crashed refresh releases its lock')
+
+    def handle(self, *args, **options):
+        try:
+            counts = run_task('refresh_listings', self.refresh, lock_timeout=options['lock_timeout'])
+        except TaskLocked as e:
+            self.stdout.write(self.style.WARNING(str(e)))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Listings refreshed: { counts["inserted"] } inserted, { counts["updated"] } updated, '
+            f'{ counts["unchanged"] } unchanged, { counts["removed"] } removed, { counts["skipped"] } skipped'
+        ))
+
+    # update_listings logs its own errors and returns None on failure; raising here records the failure on the task
+    def refresh(self):
+        counts = update_listings()
+        if counts is None:
+            raise CommandError('Listings refresh failed, see the log for details')
+        return counts
@@ -0,0 +1,72 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+import dataclasses
+import time
+from ...helpers.bulk_valuation import fetch_portfolio_quotes, revalue_all_portfolios
+from ...helpers.process_portfolio import Portfolio, build_portfolio_snapshot, value_portfolio
+
+
+# Revalues every user's portfolio in one pass (see brokerage/helpers/bulk_valuation.py) and prints a leaderboard of
+# total post-tax return. With --compare, every portfolio is also built the per-user way (as the views do, one user at
+# a time) at the same prices, to check that both agree and to time the difference.
+# Usage: python manage.py revalue_portfolios --processes 4 --top 20
+class Command(BaseCommand):
+    help = "Revalues all users' portfolios in one pass and prints a leaderboard."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, help='Processes to value portfolios in (default: PORTFOLIO_REVALUE_PROCESSES)')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='Only revalue this user id (repeatable)')
+        parser.add_argument('--top', type=int, default=10, help='Users to list in the leaderboard')
+        parser.add_argument('--compare', action='store_true', help='Also value each portfolio per user and check the results match')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        start = time.perf_counter()
+        quotes = fetch_portfolio_quotes(options['user_ids'])
+        quotes_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        portfolios = dict(revalue_all_portfolios(options['user_ids'], quotes=quotes, now=now, processes=options['processes']))
+        revalue_time = time.perf_counter() - start
+        self.stdout.write(f'Revalued { len(portfolios) } portfolios at { len(quotes) } quotes: '
+                          f'quotes { quotes_time:.2f} s, snapshots and valuation { revalue_time:.2f} s')
+
+        invested = [(user_id, portfolio) for user_id, portfolio in portfolios.items() if portfolio.cash_initial]
+        invested.sort(key=lambda item: item[1].total_portfolio_market_value_post_tax_percent, reverse=True)
+        usernames = dict(User.objects.filter(pk__in=[user_id for user_id, _ in invested[:options['top']]]).values_list('pk', 'username'))
+        for rank, (user_id, portfolio) in enumerate(invested[:options['top']], start=1):
+            self.stdout.write(f'{ rank:>4}. { usernames.get(user_id, user_id):<30} '
+                              f'{ portfolio.total_portfolio_market_value_post_tax_percent:>8.2%}  '
+                              f'{ portfolio.portfolio_market_value_post_tax_incl_cash:>16,.2f}')
+
+        if options['compare']:
+            self.compare(portfolios, quotes, now, revalue_time)
+
+    def compare(self, portfolios, quotes, now, revalue_time):
+        start = time.perf_counter()
+        mismatches = []
+        for user in User.objects.filter(pk__in=list(portfolios)).select_related('userprofile').order_by('pk'):
+            expected = value_portfolio(build_portfolio_snapshot(user), quotes, now)
+            difference = _difference(expected, portfolios[user.pk])
+            if difference:
+                mismatches.append(f'user { user.pk }: { difference }')
+        per_user_time = time.perf_counter() - start
+
+        self.stdout.write(f'Per-user valuation of the same portfolios: { per_user_time:.2f} s '
+                          f'({ per_user_time / revalue_time if revalue_time else 0:.1f}x the bulk revaluation)')
+        if mismatches:
+            raise CommandError(f'{ len(mismatches) } portfolio(s) differ, e.g. { mismatches[0] }')
+        self.stdout.write(self.style.SUCCESS(f'ok   all { len(portfolios) } portfolios match'))
+
+
+# Returns the name of the first Portfolio field that differs, or None
+def _difference(expected, actual):
+    sale = lambda transaction: tuple(getattr(transaction, name) for name in transaction.__slots__)
+    for field in dataclasses.fields(Portfolio):
+        expected_value, actual_value = getattr(expected, field.name), getattr(actual, field.name)
+        if field.name == 'sell_transactions':
+            expected_value, actual_value = [sale(t) for t in expected_value], [sale(t) for t in actual_value]
+        if expected_value != actual_value:
+            return field.name
+    return None
@@ -0,0 +1,89 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:58
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, Sum
+
+
+# Seeds a Position row per (user, symbol) from the existing BOT transactions
+def backfill_positions(apps, schema_editor):
+    Position = apps.get_model("brokerage", "Position")
+    Transaction = apps.get_model("brokerage", "Transaction")
+
+    totals = (
+        Transaction.objects.filter(type="BOT")
+        .values("user_id", "symbol")
+        .annotate(
+            total_transaction_shares=Sum("transaction_shares"),
+            total_shares_outstanding=Sum("shares_outstanding"),
+            total_cost_basis=Sum(
+                ExpressionWrapper(
+                    F("shares_outstanding") * F("transaction_value_per_share"),
+                    output_field=DecimalField(decimal_places=2, max_digits=12),
+                )
+            ),
+        )
+    )
+    Position.objects.bulk_create(
+        [
+            Position(
+                user_id=row["user_id"],
+                symbol=row["symbol"],
+                transaction_shares=row["total_transaction_shares"] or 0,
+                shares_outstanding=row["total_shares_outstanding"] or 0,
+                cost_basis_total=row["total_cost_basis"] or 0,
+            )
+            for row in totals
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "brokerage",
+            "0004_alter_transaction_ltcg_alter_transaction_ltcg_tax_and_more",
+        ),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Position",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("symbol", models.CharField(max_length=20)),
+                ("transaction_shares", models.IntegerField(default=0)),
+                ("shares_outstanding", models.IntegerField(default=0)),
+                (
+                    "cost_basis_total",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=12),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="position",
+            constraint=models.UniqueConstraint(
+                fields=("user", "symbol"), name="unique_position_user_symbol"
+            ),
+        ),
+        migrations.RunPython(backfill_positions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 5.0.3 on 2026-10-18 07:59
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Creates an OpenLot for every existing BOT transaction that still has shares outstanding
+def backfill_open_lots(apps, schema_editor):
+    OpenLot = apps.get_model("brokerage", "OpenLot")
+    Transaction = apps.get_model("brokerage", "Transaction")
+
+    open_transactions = Transaction.objects.filter(
+        type="BOT", shares_outstanding__gt=0
+    ).iterator(chunk_size=2000)
+    batch = []
+    for txn in open_transactions:
+        batch.append(
+            OpenLot(
+                user_id=txn.user_id,
+                transaction_id=txn.pk,
+                symbol=txn.symbol,
+                timestamp=txn.timestamp,
+                shares_outstanding=txn.shares_outstanding,
+                transaction_value_per_share=txn.transaction_value_per_share,
+            )
+        )
+        if len(batch) >= 2000:
+            OpenLot.objects.bulk_create(batch)
+            batch = []
+    OpenLot.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0005_position"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OpenLot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("symbol", models.CharField(max_length=20)),
+                ("timestamp", models.DateTimeField()),
+                ("shares_outstanding", models.IntegerField()),
+                (
+                    "transaction_value_per_share",
+                    models.DecimalField(decimal_places=2, max_digits=10),
+                ),
+                (
+                    "transaction",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="open_lot",
+                        to="brokerage.transaction",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user", "symbol", "timestamp"],
+                        name="openlot_user_symbol_ts_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(backfill_open_lots, migrations.RunPython.noop),
+    ]
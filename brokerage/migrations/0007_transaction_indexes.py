@@ -0,0 +1,28 @@
+# Generated by Django 5.0.3 on 2026-10-18 08:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0006_openlot"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "type", "symbol"], name="txn_user_type_symbol_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "symbol", "type", "timestamp"],
+                name="txn_user_symbol_type_ts_idx",
+            ),
+        ),
+    ]
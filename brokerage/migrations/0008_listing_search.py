@@ -0,0 +1,83 @@
+# Generated by Django 5.0.3 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+# FTS5 trigram index over Listing.symbol and Listing.name, used by check_valid_symbol for substring searches. It is
+# an external-content table (it stores only the index, not a copy of the rows), kept in sync with brokerage_listing
+# by triggers. The update trigger only fires when symbol or name change, so the daily price refresh does not
+# rewrite the index. Only SQLite is supported; other backends fall back to the ORM search.
+LISTING_SEARCH_SQL = [
+    """
+    CREATE VIRTUAL TABLE brokerage_listing_search USING fts5(
+        symbol, name, content='brokerage_listing', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER brokerage_listing_search_insert AFTER INSERT ON brokerage_listing BEGIN
+        INSERT INTO brokerage_listing_search(rowid, symbol, name) VALUES (new.id, new.symbol, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER brokerage_listing_search_delete AFTER DELETE ON brokerage_listing BEGIN
+        INSERT INTO brokerage_listing_search(brokerage_listing_search, rowid, symbol, name)
+        VALUES ('delete', old.id, old.symbol, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER brokerage_listing_search_update AFTER UPDATE OF symbol, name ON brokerage_listing BEGIN
+        INSERT INTO brokerage_listing_search(brokerage_listing_search, rowid, symbol, name)
+        VALUES ('delete', old.id, old.symbol, old.name);
+        INSERT INTO brokerage_listing_search(rowid, symbol, name) VALUES (new.id, new.symbol, new.name);
+    END
+    """,
+    # Index the listings already in the table
+    "INSERT INTO brokerage_listing_search(brokerage_listing_search) VALUES ('rebuild')",
+]
+
+DROP_LISTING_SEARCH_SQL = [
+    "DROP TRIGGER IF EXISTS brokerage_listing_search_insert",
+    "DROP TRIGGER IF EXISTS brokerage_listing_search_delete",
+    "DROP TRIGGER IF EXISTS brokerage_listing_search_update",
+    "DROP TABLE IF EXISTS brokerage_listing_search",
+]
+
+
+def create_listing_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    # The trigram tokenizer needs SQLite 3.34+ built with FTS5
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        options = {row[0] for row in cursor.fetchall()}
+    if "ENABLE_FTS5" not in options or schema_editor.connection.Database.sqlite_version_info < (3, 34):
+        return
+    for sql in LISTING_SEARCH_SQL:
+        schema_editor.execute(sql)
+
+
+def drop_listing_search(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for sql in DROP_LISTING_SEARCH_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0007_transaction_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="listing",
+            index=models.Index(
+                django.db.models.functions.text.Length("symbol"),
+                models.F("id"),
+                name="listing_symbol_length_idx",
+            ),
+        ),
+        migrations.RunPython(create_listing_search, drop_listing_search),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.3 on 2026-10-18 08:11
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+# Removes duplicate listings ahead of the unique constraint, keeping the most recently inserted row for each symbol
+def delete_duplicate_listings(apps, schema_editor):
+    Listing = apps.get_model("brokerage", "Listing")
+
+    duplicates = (
+        Listing.objects.filter(symbol__isnull=False)
+        .values("symbol")
+        .annotate(count=Count("id"), keep_id=Max("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        Listing.objects.filter(symbol=duplicate["symbol"]).exclude(
+            id=duplicate["keep_id"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0008_listing_search"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_listings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="listing",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("symbol__isnull", False)),
+                fields=("symbol",),
+                name="unique_listing_symbol",
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:05
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0009_listing_unique_symbol"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "timestamp", "id"], name="txn_user_ts_id_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,134 @@
+# Generated by Django 5.0.3 on 2026-10-18 09:22
+
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.db import migrations, models
+
+
+# Adds up every existing SLD transaction into its position's realized totals, with the tax on the sales at the user's
+# current tax rates, as realized_gains.add_sale() does for new sales
+def backfill_realized_totals(apps, schema_editor):
+    Position = apps.get_model("brokerage", "Position")
+    Transaction = apps.get_model("brokerage", "Transaction")
+    UserProfile = apps.get_model("users", "UserProfile")
+
+    rates = {}
+    for profile in UserProfile.objects.only("user_id", "tax_rate_STCG", "tax_rate_LTCG"):
+        rates[profile.user_id] = tuple(
+            Decimal(rate / 100).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+            for rate in (profile.tax_rate_STCG, profile.tax_rate_LTCG)
+        )
+
+    positions = {}
+    sales = Transaction.objects.filter(type="SLD").order_by("user_id", "symbol", "pk")
+    for sale in sales.iterator(chunk_size=2000):
+        key = (sale.user_id, sale.symbol)
+        position = positions.get(key)
+        if position is None:
+            position, _ = Position.objects.get_or_create(
+                user_id=sale.user_id, symbol=sale.symbol
+            )
+            position.sld_tax_rate_STCG, position.sld_tax_rate_LTCG = rates.get(
+                sale.user_id, (None, None)
+            )
+            positions[key] = position
+        position.sld_transaction_shares += sale.transaction_shares
+        position.sld_transaction_value_total += sale.transaction_value_total
+        position.sld_STCG += sale.STCG
+        position.sld_LTCG += sale.LTCG
+        position.sld_STCG_tax += max(sale.STCG_tax, 0)
+        position.sld_LTCG_tax += max(sale.LTCG_tax, 0)
+        position.sld_tax_offset += max(-(sale.STCG_tax + sale.LTCG_tax), 0)
+        if position.sld_tax_rate_STCG is not None:
+            position.sld_CG_tax_total += max(
+                sale.STCG * position.sld_tax_rate_STCG
+                + sale.LTCG * position.sld_tax_rate_LTCG,
+                0,
+            )
+
+    Position.objects.bulk_update(
+        positions.values(),
+        [
+            "sld_transaction_shares",
+            "sld_transaction_value_total",
+            "sld_STCG",
+            "sld_LTCG",
+            "sld_STCG_tax",
+            "sld_LTCG_tax",
+            "sld_tax_offset",
+            "sld_CG_tax_total",
+            "sld_tax_rate_STCG",
+            "sld_tax_rate_LTCG",
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0010_transaction_history_index"),
+        ("users", "0002_userprofile_confirmed"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="position",
+            name="cost_basis_total",
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_CG_tax_total",
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=16),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_LTCG",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_LTCG_tax",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_STCG",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_STCG_tax",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_tax_offset",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_tax_rate_LTCG",
+            field=models.DecimalField(
+                blank=True, decimal_places=2, max_digits=5, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_tax_rate_STCG",
+            field=models.DecimalField(
+                blank=True, decimal_places=2, max_digits=5, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_transaction_shares",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="position",
+            name="sld_transaction_value_total",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=14),
+        ),
+        migrations.RunPython(backfill_realized_totals, migrations.RunPython.noop),
+    ]
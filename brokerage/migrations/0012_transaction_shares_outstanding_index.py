@@ -0,0 +1,26 @@
+# Generated by Django 5.0.3 on 2026-10-18 09:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("brokerage", "0011_position_realized_totals"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="transaction",
+            name="txn_user_symbol_type_ts_idx",
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["user", "symbol", "type", "timestamp", "shares_outstanding"],
+                name="txn_user_sym_type_ts_shr_idx",
+            ),
+        ),
+    ]
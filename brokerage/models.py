@@ -1,6 +1,8 @@
 from django.conf import settings 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.functions import Length
 from django.utils import timezone
 
 
@@ -18,6 +20,17 @@ class Transaction(models.Model):
     STCG_tax = models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)
     LTCG_tax = models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)
 
+    class Meta:
+        indexes = [
+            # sell_view's DISTINCT over the symbols a user bought, and process_user_transactions' scan of a user's sales
+            models.Index(fields=['user', 'type', 'symbol'], name='txn_user_type_symbol_idx'),
+            # Per-symbol lot scans in timestamp order, and check_valid_shares' sum of shares_outstanding, which the
+            # trailing shares_outstanding lets the DB read from the index alone
+            models.Index(fields=['user', 'symbol', 'type', 'timestamp', 'shares_outstanding'], name='txn_user_sym_type_ts_shr_idx'),
+            # history_page's keyset pagination over a user's transactions in (timestamp, id) order
+            models.Index(fields=['user', 'timestamp', 'id'], name='txn_user_ts_id_idx'),
+        ]
+
     def __str__(self):
         return f'Txn #{self.pk}: {self.type} {self.transaction_shares} of {self.symbol}'
 
@@ -31,6 +44,68 @@ class Listing(models.Model):
     exchange_short = models.CharField(blank=True, max_length=20, null=True)
     listing_type= models.CharField(blank=True, max_length=20, null=True)
 
+    class Meta:
+        indexes = [
+            # Lets short symbol searches walk listings shortest-symbol-first and stop at the first few matches.
+            # Longer searches go through the brokerage_listing_search full-text index (see migration 0008).
+            models.Index(Length('symbol'), F('id'), name='listing_symbol_length_idx'),
+        ]
+        constraints = [
+            # update_listings diffs FMP's listings against this table by symbol. Listings without a symbol are
+            # exempt; the condition also lets SQLite add the index without rebuilding the table (and dropping the
+            # search index triggers from migration 0008).
+            models.UniqueConstraint(fields=['symbol'], condition=Q(symbol__isnull=False), name='unique_listing_symbol'),
+        ]
+
     def __str__(self):
         return f'{self.name} ({self.symbol})'
 
+
+
+# Running per-symbol totals of a user's holdings and of their sales. Updated by process_buy and process_sell in the
+# same DB transaction as the trade itself, so that building a portfolio reads one row per symbol instead of replaying
+# the user's full trade history or reading every sale (see helpers/realized_gains.py for the sld_ totals).
+class Position(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    symbol = models.CharField(max_length=20)
+    transaction_shares = models.IntegerField(default=0) # Total shares ever bought
+    shares_outstanding = models.IntegerField(default=0) # Shares bought and not yet sold
+    sld_transaction_shares = models.IntegerField(default=0) # Total shares sold
+    sld_transaction_value_total = models.DecimalField(decimal_places=2, default=0, max_digits=14) # Proceeds of the sales
+    sld_STCG = models.DecimalField(decimal_places=2, default=0, max_digits=14)
+    sld_LTCG = models.DecimalField(decimal_places=2, default=0, max_digits=14)
+    sld_STCG_tax = models.DecimalField(decimal_places=2, default=0, max_digits=14) # Sales' STCG_tax, where positive
+    sld_LTCG_tax = models.DecimalField(decimal_places=2, default=0, max_digits=14) # Sales' LTCG_tax, where positive
+    sld_tax_offset = models.DecimalField(decimal_places=2, default=0, max_digits=14) # Sales' net tax, where negative
+    sld_CG_tax_total = models.DecimalField(decimal_places=4, default=0, max_digits=16) # Sales' tax at the rates below
+    sld_tax_rate_STCG = models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True) # As a fraction
+    sld_tax_rate_LTCG = models.DecimalField(blank=True, decimal_places=2, max_digits=5, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'symbol'], name='unique_position_user_symbol'),
+        ]
+
+    def __str__(self):
+        return f'Position: {self.user_id} holds {self.shares_outstanding} of {self.symbol}'
+
+
+
+# A BOT transaction that still has shares left to sell. Created by process_buy and deleted by process_sell once all of
+# its shares are sold, so a sale only ever scans lots that can actually fill it. Mirrors the transaction's
+# shares_outstanding, which process_sell keeps in sync.
+class OpenLot(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    transaction = models.OneToOneField(Transaction, on_delete=models.CASCADE, related_name='open_lot')
+    symbol = models.CharField(max_length=20)
+    timestamp = models.DateTimeField()
+    shares_outstanding = models.IntegerField()
+    transaction_value_per_share = models.DecimalField(decimal_places=2, max_digits=10)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'symbol', 'timestamp'], name='openlot_user_symbol_ts_idx'),
+        ]
+
+    def __str__(self):
+        return f'Open lot of txn #{self.transaction_id}: {self.shares_outstanding} of {self.symbol}'
@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+import logging
+from .helpers.portfolio_cache import invalidate_portfolio
+from .helpers.process_portfolio import tax_rates
+from .helpers.realized_gains import refresh_realized_tax
+from .models import Position, Transaction
+from users.models import UserProfile
+
+logger = logging.getLogger('django')
+
+
+# Central invalidation of cached portfolio snapshots (see helpers/portfolio_cache.py). Connected in
+# BrokerageConfig.ready(). Invalidation waits until the change is committed, so a snapshot built from the old data in
+# the meantime is cached under the superseded version rather than the new one. Price changes need no invalidation, as
+# snapshots are valued at current prices on every request.
+
+# A trade changes the user's holdings, cash and gains
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+def invalidate_portfolio_on_transaction(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_portfolio(instance.user_id))
+
+
+# The accounting method, tax rates and tax loss offsets all feed into the portfolio's gains and taxes
+@receiver(post_save, sender=UserProfile)
+def invalidate_portfolio_on_profile(sender, instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_portfolio(instance.user_id))
+
+
+# The positions keep the tax on the user's sales at the user's tax rates (see helpers/realized_gains.py), so it is
+# reworked, in the DB transaction that saves new rates, before the portfolio is next built. Saves that cannot change
+# the rates (e.g. of cash after a trade) only read the positions whose tax is at other rates, which are usually none.
+@receiver(post_save, sender=UserProfile)
+def refresh_realized_tax_on_profile(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and not {'tax_rate_STCG', 'tax_rate_LTCG'} & set(update_fields)):
+        return
+    tax_rate_STCG, tax_rate_LTCG = tax_rates(instance)
+    positions = Position.objects.select_for_update().filter(user_id=instance.user_id, sld_transaction_shares__gt=0).exclude(sld_tax_rate_STCG=tax_rate_STCG, sld_tax_rate_LTCG=tax_rate_LTCG)
+    refresh_realized_tax(instance.user_id, positions, tax_rate_STCG, tax_rate_LTCG)
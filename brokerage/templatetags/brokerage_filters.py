@@ -47,9 +47,12 @@ def filter_usd(value):
         return f'(${-value:,.2f})'
 
 
-# Custom jinja filter: x.xx% or (x.xx%)
+# Custom jinja filter: x.xx% or (x.xx%), or "-" for a value that is not a number (e.g. the sales' percentages
+# of a portfolio without sales)
 @register.filter(name='filter_percentage')
 def filter_percentage(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal)):
+        return '-'
     # Threshold for considering a value effectively zero
     threshold = 0.005  # Adjust this value as necessary
     if -threshold < value < threshold:
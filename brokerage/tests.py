@@ -0,0 +1,683 @@
+from collections import Counter
+from decimal import Decimal
+from django.apps import apps
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import dataclasses
+import csv
+import importlib
+import io
+import json
+import pickle
+import random
+import requests
+import threading
+import time
+from unittest import mock, skipUnless
+from .benchmarks import LoadTestResult, compare_to_baseline, create_synthetic_user, random_snapshot, seed_trade_history, time_call
+from .helpers import build_portfolio_snapshot, fmp_client, helpers, read_sell_transactions, value_portfolio
+from .helpers.portfolio_cache import _snapshot_cache_key, get_or_set_portfolio_snapshot
+from .helpers.portfolio_serializer import PortfolioSerializer
+from .helpers.process_portfolio import Portfolio, SymbolData
+from .helpers.quote_cache import set_cached_quotes
+from .helpers.realized_gains import REALIZED_FIELDS
+from .helpers.single_flight import _single_flight_lock_key
+from .helpers.trade_import import Trade, import_trades, read_trades
+from .helpers.transaction_history import history_page
+from .helpers.valuation_engine import vectorized_valuation_available
+from .models import OpenLot, Position, Transaction
+from .templatetags.brokerage_filters import filter_percentage
+from users.models import UserProfile
+
+
+# Tests never reach FMP: every test that needs prices or profiles patches the fetch functions or fills the quote cache.
+
+
+@override_settings(SINGLE_FLIGHT_TIMEOUT=5, SINGLE_FLIGHT_POLL_INTERVAL=0.01)
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    # Another worker holds the lock for a symbol and finds FMP does not know it: the waiter takes the negative cache
+    # entry as the answer, rather than polling until the lock expires and then calling FMP itself
+    def test_waiter_accepts_negative_cache_entry(self):
+        cache.add(_single_flight_lock_key('profile_NOPE'), 'other-worker', timeout=60)
+        timer = threading.Timer(0.1, lambda: set_cached_quotes('profile', ['NOPE'], {}))
+        timer.start()
+        try:
+            with mock.patch.object(helpers, '_fetch_company_data') as fetch:
+                self.assertIsNone(helpers.company_data('NOPE'))
+            fetch.assert_not_called()
+        finally:
+            timer.cancel()
+
+    # Likewise for a profile another worker fetched
+    def test_waiter_accepts_cached_profile(self):
+        cache.add(_single_flight_lock_key('profile_AAPL'), 'other-worker', timeout=60)
+        timer = threading.Timer(0.1, lambda: set_cached_quotes('profile', ['AAPL'], {'AAPL': {'symbol': 'AAPL', 'price': 150.0}}))
+        timer.start()
+        try:
+            with mock.patch.object(helpers, '_fetch_company_data') as fetch:
+                self.assertEqual(helpers.company_data('AAPL'), {'symbol': 'AAPL', 'price': 150.0})
+            fetch.assert_not_called()
+        finally:
+            timer.cancel()
+
+    def test_leader_fetches_and_returns_profile(self):
+        with mock.patch.object(helpers, '_fetch_company_data', return_value={'symbol': 'MSFT', 'price': 300.0}) as fetch:
+            self.assertEqual(helpers.company_data('MSFT'), {'symbol': 'MSFT', 'price': 300.0})
+        fetch.assert_called_once_with('MSFT')
+
+
+@override_settings(FMP_MAX_RETRIES=2, FMP_BACKOFF_BASE=0, FMP_BACKOFF_MAX=0)
+class FMPClientTests(TestCase):
+    def setUp(self):
+        self.breaker = fmp_client.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        patcher = mock.patch.object(fmp_client, 'breaker', self.breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # Opens the circuit as if reset_timeout had already passed, so the next request is the half-open trial
+    def half_open(self):
+        self.breaker.failures = self.breaker.failure_threshold
+        self.breaker.opened_at = time.monotonic() - self.breaker.reset_timeout - 1
+        self.assertEqual(self.breaker.state, 'half-open')
+
+    def fmp_get(self, side_effect):
+        session = mock.Mock()
+        session.get.side_effect = side_effect
+        with mock.patch.object(fmp_client, 'get_session', return_value=session):
+            return fmp_client.fmp_get('quote/AAPL'), session
+
+    def response(self, status_code):
+        return mock.Mock(status_code=status_code)
+
+    # Errors other than connection errors and timeouts are not retried, and the failed trial releases the half-open
+    # circuit, so that another trial is let through once reset_timeout passes again
+    def test_non_retryable_error_on_trial_is_recorded(self):
+        for error in [requests.TooManyRedirects(), requests.exceptions.InvalidURL(), requests.exceptions.ContentDecodingError()]:
+            with self.subTest(error=type(error).__name__):
+                self.half_open()
+                session = mock.Mock()
+                session.get.side_effect = error
+                with mock.patch.object(fmp_client, 'get_session', return_value=session):
+                    with self.assertRaises(fmp_client.FMPUnavailable):
+                        fmp_client.fmp_get('quote/AAPL')
+                self.assertEqual(session.get.call_count, 1)
+                self.assertFalse(self.breaker.trial_in_flight)
+                self.assertEqual(self.breaker.state, 'open')
+
+                self.half_open()
+                self.assertTrue(self.breaker.allow_request())
+                self.breaker.record_success()
+
+    # Likewise for exceptions that do not come from requests at all
+    def test_unexpected_error_on_trial_is_recorded(self):
+        self.half_open()
+        with self.assertRaises(RuntimeError):
+            self.fmp_get(RuntimeError('boom'))
+        self.assertFalse(self.breaker.trial_in_flight)
+
+    def test_truncated_response_is_retried(self):
+        response, session = self.fmp_get([requests.exceptions.ChunkedEncodingError(), self.response(200)])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.get.call_count, 2)
+        self.assertEqual(self.breaker.failures, 0)
+
+    def test_successful_trial_closes_circuit(self):
+        self.half_open()
+        response, session = self.fmp_get([self.response(503), self.response(404)])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertFalse(self.breaker.trial_in_flight)
+
+    def test_exhausted_retries_open_circuit(self):
+        for _ in range(self.breaker.failure_threshold):
+            with self.assertRaises(fmp_client.FMPUnavailable):
+                self.fmp_get(requests.ConnectionError())
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(fmp_client.FMPUnavailable):
+            self.fmp_get(AssertionError('the circuit is open, so no request should be made'))
+
+
+class PositionRealizedTotalsTests(TestCase):
+    def setUp(self):
+        self.user = create_synthetic_user('realized')
+        seed_trade_history(self.user, 300, symbols=['AAPL', 'MSFT', 'NVDA'], sell_ratio=0.4)
+
+    # The snapshot's sale totals, as they were added up from every sale before positions kept them
+    def assert_totals_match_sales(self, snapshot):
+        sales = read_sell_transactions(self.user, snapshot.tax_rate_STCG, snapshot.tax_rate_LTCG)
+        self.assertTrue(sales)
+        self.assertEqual(snapshot.sld_transaction_shares_total, sum(t.transaction_shares for t in sales))
+        self.assertEqual(snapshot.sld_transaction_cost_basis_total, sum(t.cost_basis_total for t in sales))
+        self.assertEqual(snapshot.sld_transaction_STCG_total, sum(t.STCG for t in sales))
+        self.assertEqual(snapshot.sld_transaction_LTCG_total, sum(t.LTCG for t in sales))
+        self.assertEqual(snapshot.sld_transaction_market_value_pre_tax_total, sum(t.transaction_value_total for t in sales))
+        self.assertEqual(snapshot.sld_transaction_STCG_tax_total, sum(t.STCG_tax_realized for t in sales))
+        self.assertEqual(snapshot.sld_transaction_LTCG_tax_total, sum(t.LTCG_tax_realized for t in sales))
+        self.assertEqual(snapshot.sld_transaction_tax_offset_total, sum(t.CG_tax_offset_unrealized for t in sales))
+        self.assertEqual(snapshot.sld_transaction_market_value_post_tax_total, sum(t.market_value_post_tax for t in sales))
+
+    def test_snapshot_totals_match_sales(self):
+        self.assert_totals_match_sales(build_portfolio_snapshot(self.user))
+
+    def sold_position_rates(self):
+        return set(Position.objects.filter(user=self.user, sld_transaction_shares__gt=0).values_list('sld_tax_rate_STCG', 'sld_tax_rate_LTCG'))
+
+    # Building a snapshot only reads
+    def build_read_only_snapshot(self):
+        with CaptureQueriesContext(connection) as queries:
+            snapshot = build_portfolio_snapshot(self.user)
+        self.assertEqual([query['sql'] for query in queries if not query['sql'].lstrip().upper().startswith('SELECT') or 'FOR UPDATE' in query['sql'].upper()], [])
+        return snapshot
+
+    # Saving new tax rates reworks the realized tax at them, and the positions remember them
+    def test_tax_rate_change_reworks_realized_tax(self):
+        build_portfolio_snapshot(self.user)
+        self.user.userprofile.tax_rate_STCG = Decimal('22.00')
+        self.user.userprofile.tax_rate_LTCG = Decimal('12.00')
+        self.user.userprofile.save()
+
+        self.assertEqual(self.sold_position_rates(), {(Decimal('0.22'), Decimal('0.12'))})
+        self.assert_totals_match_sales(self.build_read_only_snapshot())
+
+    # Rates changed without saving the profile are applied to the snapshot, without writing to the positions
+    def test_snapshot_works_out_stale_realized_tax(self):
+        UserProfile.objects.filter(user=self.user).update(tax_rate_STCG=Decimal('22.00'), tax_rate_LTCG=Decimal('12.00'))
+        self.user.userprofile.refresh_from_db()
+        self.assert_totals_match_sales(self.build_read_only_snapshot())
+        self.assertEqual(self.sold_position_rates(), {(Decimal('0.15'), Decimal('0.30'))})
+
+    def test_process_sell_adds_sale_to_position(self):
+        with mock.patch.object(helpers, 'company_data', return_value={'symbol': 'AAPL', 'price': 250.0}):
+            helpers.process_sell('AAPL', Position.objects.get(user=self.user, symbol='AAPL').shares_outstanding // 2, self.user)
+        self.assert_totals_match_sales(build_portfolio_snapshot(self.user))
+
+    # Migration 0011 adds up existing sales to the same totals as positions keep from then on
+    def test_backfill_matches_running_totals(self):
+        values = lambda: list(Position.objects.filter(user=self.user).order_by('symbol').values_list('symbol', *REALIZED_FIELDS))
+        expected = values()
+        Position.objects.filter(user=self.user).update(**{field: 0 for field in REALIZED_FIELDS[:-2]}, sld_tax_rate_STCG=None, sld_tax_rate_LTCG=None)
+        importlib.import_module('brokerage.migrations.0011_position_realized_totals').backfill_realized_totals(apps, None)
+        self.assertEqual(values(), expected)
+
+
+class PortfolioSerializerTests(TestCase):
+    def setUp(self):
+        self.serializer = PortfolioSerializer()
+
+    # Ints stay ints, so the Redis backend can INCR cache versions, and come back as ints when Redis returns bytes
+    def test_ints_pass_through(self):
+        self.assertEqual(self.serializer.dumps(42), 42)
+        self.assertEqual(self.serializer.loads(42), 42)
+        self.assertEqual(self.serializer.loads(b'42'), 42)
+
+    def test_small_values_are_not_compressed(self):
+        data = self.serializer.dumps({'a': 1})
+        self.assertEqual(data[:1], PortfolioSerializer.PICKLED)
+        self.assertEqual(self.serializer.loads(data), {'a': 1})
+
+    # A snapshot from a synthetic history comes back compressed, smaller than plain pickle and valuing to the same
+    # portfolio
+    def test_snapshot_round_trip(self):
+        user = create_synthetic_user('serializer')
+        prices = seed_trade_history(user, 500)
+        snapshot = build_portfolio_snapshot(user)
+        quotes = {symbol: {'symbol': symbol, 'price': float(price)} for symbol, price in prices.items()}
+
+        data = self.serializer.dumps(snapshot)
+        self.assertEqual(data[:1], PortfolioSerializer.COMPRESSED)
+        self.assertLess(len(data), len(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)))
+        actual = self.serializer.loads(memoryview(data))
+
+        self.assertEqual(pickle.dumps(actual), pickle.dumps(snapshot))
+        expected_portfolio, actual_portfolio = value_portfolio(snapshot, quotes), value_portfolio(actual, quotes)
+        self.assertEqual(actual_portfolio.portfolio_data, expected_portfolio.portfolio_data)
+        self.assertEqual(actual_portfolio.portfolio_market_value_post_tax_incl_cash, expected_portfolio.portfolio_market_value_post_tax_incl_cash)
+
+
+class PortfolioCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_synthetic_user('cached')
+        seed_trade_history(self.user, 50, symbols=['AAPL'])
+
+    def get_snapshot(self):
+        return get_or_set_portfolio_snapshot(self.user, build_portfolio_snapshot)
+
+    def test_snapshot_is_cached(self):
+        self.get_snapshot()
+        with mock.patch('brokerage.tests.build_portfolio_snapshot') as build:
+            self.get_snapshot()
+        build.assert_not_called()
+
+    # A trade makes the cached snapshot unreachable once it commits
+    def test_trade_invalidates_snapshot(self):
+        key = _snapshot_cache_key(self.user.pk)
+        shares = self.get_snapshot().sld_transaction_shares_total
+        with mock.patch.object(helpers, 'company_data', return_value={'symbol': 'AAPL', 'price': 200.0}):
+            with self.captureOnCommitCallbacks(execute=True):
+                helpers.process_sell('AAPL', 1, self.user)
+        self.assertNotEqual(_snapshot_cache_key(self.user.pk), key)
+        self.assertEqual(self.get_snapshot().sld_transaction_shares_total, shares + 1)
+
+    def test_profile_change_invalidates_snapshot(self):
+        key = _snapshot_cache_key(self.user.pk)
+        self.get_snapshot()
+        self.user.userprofile.tax_loss_offsets = 'Off'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.userprofile.save()
+        self.assertNotEqual(_snapshot_cache_key(self.user.pk), key)
+        self.assertEqual(self.get_snapshot().tax_offset_coefficient, 0)
+
+
+class IndexDetailViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_synthetic_user('detail')
+        self.client.force_login(self.user)
+
+    def get(self, prices):
+        quotes = {symbol: {'symbol': symbol, 'price': float(price)} for symbol, price in prices.items()}
+        with mock.patch('brokerage.helpers.process_portfolio.company_data_multiple', return_value=quotes):
+            return self.client.get('/index-detail/', secure=True)
+
+    # The sales' percentages are "-" while there are no sales
+    def test_open_positions_without_sales(self):
+        response = self.get(seed_trade_history(self.user, 20, symbols=['AAPL', 'MSFT'], sell_ratio=0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['portfolio'].sld_transaction_gain_or_loss_pre_tax_percent, '-')
+
+    def test_open_positions_with_sales(self):
+        response = self.get(seed_trade_history(self.user, 100, symbols=['AAPL', 'MSFT']))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['portfolio'].sell_transactions)
+
+    def test_filter_percentage(self):
+        self.assertEqual(filter_percentage(Decimal('0.1234')), '12.34%')
+        self.assertEqual(filter_percentage(-0.5), '(50.00%)')
+        self.assertEqual(filter_percentage(0.001), '0.00%')
+        for value in ['-', None, '']:
+            self.assertEqual(filter_percentage(value), '-')
+
+
+# The vectorized valuation engine must value portfolios exactly as the lot-by-lot Decimal loop does: every SymbolData
+# field and every Portfolio total equal, not merely close. Checked on random snapshots (see random_snapshot()) from a
+# fixed seed; the check_valuation_engine command benchmarks the two engines.
+@skipUnless(vectorized_valuation_available(), 'numpy is not installed')
+@override_settings(PORTFOLIO_VECTORIZE_MIN_LOTS=1)
+class ValuationEngineTests(TestCase):
+    SEED = 0
+    CASES = 40
+
+    def value_with(self, snapshot, quotes, now, vectorized):
+        snapshot = dataclasses.replace(snapshot, lot_columns=snapshot.lot_columns if vectorized else None)
+        return value_portfolio(snapshot, quotes, now)
+
+    def assert_valued_identically(self, snapshot, quotes, now):
+        self.assertIsNotNone(snapshot.lot_columns)
+        expected = self.value_with(snapshot, quotes, now, vectorized=False)
+        actual = self.value_with(snapshot, quotes, now, vectorized=True)
+        for symbol, expected_data in expected.portfolio_data.items():
+            for field in dataclasses.fields(SymbolData):
+                self.assertEqual(getattr(actual.portfolio_data[symbol], field.name), getattr(expected_data, field.name), f'{ symbol }.{ field.name }')
+        for field in dataclasses.fields(Portfolio):
+            if field.name not in ['portfolio_data', 'sell_transactions']:
+                self.assertEqual(getattr(actual, field.name), getattr(expected, field.name), field.name)
+
+    def test_random_portfolios(self):
+        rng = random.Random(self.SEED)
+        now = timezone.now()
+        for case in range(self.CASES):
+            with self.subTest(case=case):
+                snapshot, quotes = random_snapshot(rng, now, n_lots=rng.randint(1, 300), n_symbols=rng.randint(1, 12))
+                self.assert_valued_identically(snapshot, quotes, now)
+
+
+# Buys shares of symbol at price (a string) through process_buy, as buy_view does once the order is validated. With a
+# timestamp, the purchase is then dated to it.
+def buy(user, symbol, shares, price, timestamp=None):
+    total = shares * Decimal(price)
+    transaction = helpers.process_buy(symbol, shares, user, {'success': True, 'data': {'transaction_value_total': total, 'transaction_value_per_share': Decimal(price)}})
+    if timestamp is not None:
+        Transaction.objects.filter(pk=transaction.pk).update(timestamp=timestamp)
+        OpenLot.objects.filter(transaction=transaction).update(timestamp=timestamp)
+    return Transaction.objects.get(pk=transaction.pk)
+
+
+# Sells shares of symbol at price (a float, as FMP quotes it) through process_sell. With a timestamp, the sale is made
+# as of then (lots bought in the year before it are short-term) and dated to it.
+def sell(user, symbol, shares, price, timestamp=None):
+    with mock.patch.object(helpers, 'company_data', return_value={'symbol': symbol, 'price': price}):
+        if timestamp is None:
+            helpers.process_sell(symbol, shares, user)
+        else:
+            with mock.patch('django.utils.timezone.now', return_value=timestamp):
+                helpers.process_sell(symbol, shares, user)
+    sale = Transaction.objects.filter(user=user, type='SLD').latest('pk')
+    if timestamp is not None:
+        Transaction.objects.filter(pk=sale.pk).update(timestamp=timestamp)
+        sale.timestamp = timestamp
+    return sale
+
+
+# process_sell counts the gain on every lot a sale fills, not only on the lot it leaves partly sold
+class ProcessSellGainsTests(TestCase):
+    def setUp(self):
+        self.user = create_synthetic_user('seller', cash=Decimal('100000.00'))
+
+    # A long-term lot of 10 at $100, then short-term lots of 10 at $120 and 10 at $150; 25 shares sold at $200
+    def sell_across_lots(self, accounting_method):
+        self.user.userprofile.accounting_method = accounting_method
+        self.user.userprofile.save()
+        two_years_ago = timezone.now() - timezone.timedelta(days=730)
+        lots = [buy(self.user, 'AAPL', 10, '100.00', timestamp=two_years_ago), buy(self.user, 'AAPL', 10, '120.00'), buy(self.user, 'AAPL', 10, '150.00')]
+        sale = sell(self.user, 'AAPL', 25, 200.0)
+        shares_outstanding = [Transaction.objects.get(pk=lot.pk).shares_outstanding for lot in lots]
+        return sale, shares_outstanding
+
+    def test_fifo_sale_across_lots(self):
+        sale, shares_outstanding = self.sell_across_lots('FIFO')
+        self.assertEqual((sale.STCG, sale.LTCG), (Decimal('1050.00'), Decimal('1000.00')))
+        self.assertEqual((sale.STCG_tax, sale.LTCG_tax), (Decimal('157.50'), Decimal('300.00')))
+        self.assertEqual(shares_outstanding, [0, 0, 5])
+        self.assertEqual(list(OpenLot.objects.filter(user=self.user).values_list('shares_outstanding', flat=True)), [5])
+
+    def test_lifo_sale_across_lots(self):
+        sale, shares_outstanding = self.sell_across_lots('LIFO')
+        self.assertEqual((sale.STCG, sale.LTCG), (Decimal('1300.00'), Decimal('500.00')))
+        self.assertEqual((sale.STCG_tax, sale.LTCG_tax), (Decimal('195.00'), Decimal('150.00')))
+        self.assertEqual(shares_outstanding, [5, 0, 0])
+
+
+class TradeImportOrderTests(TestCase):
+    # Purchases that stay open are inserted along with the sales and sold-out purchases around them, so ids follow
+    # the order of the trades
+    def test_transactions_are_inserted_in_trade_order(self):
+        create_synthetic_user('importer')
+        start = timezone.now() - timezone.timedelta(days=100)
+        trades = [
+            Trade(line, 'importer', start + timezone.timedelta(days=line), type, symbol, shares, Decimal(price))
+            for line, (type, symbol, shares, price) in enumerate([
+                ('BOT', 'AAPL', 10, '100.00'),
+                ('BOT', 'MSFT', 5, '300.00'),
+                ('SLD', 'AAPL', 10, '110.00'),
+                ('BOT', 'AAPL', 4, '105.00'),
+                ('SLD', 'MSFT', 2, '310.00'),
+                ('BOT', 'NVDA', 1, '800.00'),
+            ], start=1)
+        ]
+        import_trades(trades)
+        imported = list(Transaction.objects.order_by('pk').values_list('timestamp', 'type', 'symbol'))
+        self.assertEqual(imported, [(trade.timestamp, trade.type, trade.symbol) for trade in trades])
+        self.assertEqual(list(OpenLot.objects.order_by('pk').values_list('symbol', 'shares_outstanding')), [('MSFT', 3), ('AAPL', 4), ('NVDA', 1)])
+
+
+class LoadTestResultTests(TestCase):
+    # Server errors are counted whether or not the request was timed; redirects and client errors are not errors
+    def test_server_errors(self):
+        result = LoadTestResult(
+            durations={'index': [0.01] * 3, 'buy': [0.01] * 2},
+            statuses={'index': Counter({200: 2, 500: 1}), 'buy': Counter({302: 1, 400: 1})},
+            warmup_errors=Counter({'buy': 2}),
+        )
+        self.assertEqual(result.server_errors(), {'index': 1, 'buy': 2})
+        self.assertEqual(LoadTestResult(statuses={'index': Counter({200: 3})}).server_errors(), {})
+
+
+# The rows process_buy and process_sell keep in step with each other
+class BuySellBookkeepingTests(TestCase):
+    def setUp(self):
+        self.user = create_synthetic_user('bookkeeper', cash=Decimal('100000.00'))
+
+    def position(self, symbol='AAPL'):
+        return Position.objects.filter(user=self.user, symbol=symbol).values_list('transaction_shares', 'shares_outstanding').get()
+
+    # Each BOT transaction's shares_outstanding matches its open lot, and there is a lot for every one with shares left
+    def assert_lots_match_transactions(self):
+        lots = dict(OpenLot.objects.filter(user=self.user).values_list('transaction_id', 'shares_outstanding'))
+        open_transactions = dict(Transaction.objects.filter(user=self.user, type='BOT', shares_outstanding__gt=0).values_list('pk', 'shares_outstanding'))
+        self.assertEqual(lots, open_transactions)
+
+    def test_buy_opens_lot_and_adds_to_position(self):
+        purchase = buy(self.user, 'AAPL', 10, '150.25')
+        lot = OpenLot.objects.get(transaction=purchase)
+        self.assertEqual((lot.symbol, lot.shares_outstanding, lot.transaction_value_per_share, lot.timestamp), ('AAPL', 10, Decimal('150.25'), purchase.timestamp))
+        buy(self.user, 'AAPL', 5, '140.00')
+        self.assertEqual(self.position(), (15, 15))
+        self.user.userprofile.refresh_from_db()
+        self.assertEqual(self.user.userprofile.cash, Decimal('100000.00') - Decimal('1502.50') - Decimal('700.00'))
+
+    # A sale deletes the lots it sells out, shrinks the one it partly sells, and writes the same shares_outstanding to
+    # their BOT transactions
+    def test_sell_updates_lots_transactions_and_position(self):
+        purchases = [buy(self.user, 'AAPL', shares, '100.00') for shares in [3, 4, 5, 6]]
+        buy(self.user, 'MSFT', 2, '300.00')
+        sell(self.user, 'AAPL', 9, 110.0)
+
+        self.assertEqual([Transaction.objects.get(pk=purchase.pk).shares_outstanding for purchase in purchases], [0, 0, 3, 6])
+        self.assertEqual(list(OpenLot.objects.filter(user=self.user, symbol='AAPL').order_by('pk').values_list('transaction_id', 'shares_outstanding')), [(purchases[2].pk, 3), (purchases[3].pk, 6)])
+        self.assert_lots_match_transactions()
+        self.assertEqual(self.position(), (18, 9))
+        self.assertEqual(self.position('MSFT'), (2, 2))
+        self.user.userprofile.refresh_from_db()
+        self.assertEqual(self.user.userprofile.cash, Decimal('100000.00') - Decimal('1800.00') - Decimal('600.00') + Decimal('990.00'))
+
+    def test_selling_out_closes_every_lot(self):
+        for shares in [3, 4]:
+            buy(self.user, 'AAPL', shares, '100.00')
+        sell(self.user, 'AAPL', 7, 90.0)
+        self.assertFalse(OpenLot.objects.filter(user=self.user).exists())
+        self.assertEqual(self.position(), (7, 0))
+        self.assert_lots_match_transactions()
+
+    # An order larger than the lots can fill is rolled back whole
+    def test_oversized_sale_changes_nothing(self):
+        buy(self.user, 'AAPL', 3, '100.00')
+        with self.assertRaises(Exception):
+            sell(self.user, 'AAPL', 4, 110.0)
+        self.assertEqual(list(OpenLot.objects.filter(user=self.user).values_list('shares_outstanding', flat=True)), [3])
+        self.assertFalse(Transaction.objects.filter(user=self.user, type='SLD').exists())
+        self.assertEqual(self.position(), (3, 3))
+
+
+# import_trades replays trades exactly as process_buy and process_sell would have made them
+class TradeImportReplayTests(TestCase):
+    TRANSACTION_FIELDS = ['timestamp', 'type', 'symbol', 'transaction_shares', 'shares_outstanding', 'transaction_value_per_share', 'transaction_value_total', 'STCG', 'LTCG', 'STCG_tax', 'LTCG_tax']
+
+    # Random trades 15 days apart (so sales fill both short- and long-term lots), as (timestamp, type, symbol, shares, price)
+    def random_trades(self, count=80, seed=0):
+        rng = random.Random(seed)
+        start = timezone.now() - timezone.timedelta(days=15 * count)
+        prices = {'AAPL': Decimal('170.00'), 'MSFT': Decimal('410.00'), 'KO': Decimal('60.00')}
+        held = dict.fromkeys(prices, 0)
+        trades = []
+        for index in range(count):
+            symbol = rng.choice(list(prices))
+            prices[symbol] = max(Decimal('1.00'), (prices[symbol] * Decimal(str(1 + rng.uniform(-0.05, 0.05)))).quantize(Decimal('0.01')))
+            if held[symbol] and rng.random() < 0.4:
+                shares = rng.randint(1, held[symbol] if rng.random() < 0.2 else max(1, held[symbol] // 4))
+                held[symbol] -= shares
+                trades.append((start + timezone.timedelta(days=15 * index), 'SLD', symbol, shares, prices[symbol]))
+            else:
+                shares = rng.randint(1, 20)
+                held[symbol] += shares
+                trades.append((start + timezone.timedelta(days=15 * index), 'BOT', symbol, shares, prices[symbol]))
+        return trades
+
+    def rows(self, user):
+        return {
+            'transactions': list(Transaction.objects.filter(user=user).order_by('pk').values_list(*self.TRANSACTION_FIELDS)),
+            # With the purchase each lot was opened by, which must be the lot's own
+            'open_lots': list(OpenLot.objects.filter(user=user).order_by('pk').values_list(
+                'symbol', 'timestamp', 'shares_outstanding', 'transaction_value_per_share',
+                'transaction__type', 'transaction__symbol', 'transaction__timestamp', 'transaction__shares_outstanding', 'transaction__transaction_value_per_share',
+            )),
+            'positions': list(Position.objects.filter(user=user).order_by('symbol').values_list('symbol', 'transaction_shares', 'shares_outstanding', *REALIZED_FIELDS)),
+            'cash': UserProfile.objects.get(user=user).cash,
+        }
+
+    def assert_import_matches_live(self, accounting_method, chunk_size):
+        trades = self.random_trades()
+        live, imported = (create_synthetic_user(name, accounting_method=accounting_method) for name in ['live', 'imported'])
+        for timestamp, type, symbol, shares, price in trades:
+            if type == 'BOT':
+                buy(live, symbol, shares, str(price), timestamp=timestamp)
+            else:
+                sell(live, symbol, shares, float(price), timestamp=timestamp)
+        import_trades([Trade(line, 'imported', *trade) for line, trade in enumerate(trades, start=1)], chunk_size=chunk_size)
+
+        expected, actual = self.rows(live), self.rows(imported)
+        self.assertTrue(any(row[7] for row in expected['transactions'] if row[1] == 'SLD'), 'no short-term gains were realized')
+        self.assertTrue(any(row[8] for row in expected['transactions'] if row[1] == 'SLD'), 'no long-term gains were realized')
+        self.assertEqual(actual, expected)
+
+    def test_fifo(self):
+        self.assert_import_matches_live('FIFO', chunk_size=1000)
+
+    # Chunks small enough that sales fill lots written by earlier chunks
+    def test_lifo_in_small_chunks(self):
+        self.assert_import_matches_live('LIFO', chunk_size=7)
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.user = create_synthetic_user('historian')
+        start = timezone.now() - timezone.timedelta(days=30)
+        # 23 purchases, three at a time at the same instant, so pages must break ties by id
+        Transaction.objects.bulk_create([
+            Transaction(user=self.user, timestamp=start + timezone.timedelta(hours=index // 3), type='BOT', symbol='AAPL', transaction_shares=index + 1,
+                        shares_outstanding=index + 1, transaction_value_per_share=Decimal('100.00'), transaction_value_total=Decimal(100 * (index + 1)))
+            for index in range(23)
+        ])
+        self.oldest_first = list(Transaction.objects.filter(user=self.user).order_by('timestamp', 'pk').values_list('pk', flat=True))
+
+    def pks(self, page):
+        return [transaction.pk for transaction in page.transactions]
+
+    # Walking newer pages and then back through older ones visits every transaction once, in order
+    def test_cursors_walk_the_whole_history(self):
+        pages = [history_page(self.user, page_size=5)]
+        self.assertIsNone(pages[0].older_cursor)
+        while pages[-1].newer_cursor:
+            pages.append(history_page(self.user, after=pages[-1].newer_cursor, page_size=5))
+        self.assertEqual([len(page.transactions) for page in pages], [5, 5, 5, 5, 3])
+        self.assertEqual([pk for page in pages for pk in self.pks(page)], self.oldest_first)
+
+        back = [pages[-1]]
+        while back[-1].older_cursor:
+            back.append(history_page(self.user, before=back[-1].older_cursor, page_size=5))
+        self.assertEqual([self.pks(page) for page in back], [self.pks(page) for page in reversed(pages)])
+        self.assertIsNone(back[-1].older_cursor)
+
+    # /history lists the oldest transactions first, as it did before it was paginated
+    @override_settings(HISTORY_PAGE_SIZE=5)
+    def test_view_lists_oldest_first(self):
+        self.client.force_login(self.user)
+        response = self.client.get('/history/', secure=True)
+        self.assertEqual([transaction.pk for transaction in response.context['history']], self.oldest_first[:5])
+        response = self.client.get(f'/history/?after={ response.context["page"].newer_cursor }', secure=True)
+        self.assertEqual([transaction.pk for transaction in response.context['history']], self.oldest_first[5:10])
+
+    def test_invalid_or_stale_cursor_gives_first_page(self):
+        first = self.pks(history_page(self.user, page_size=5))
+        for cursor in ['nonsense', '12_x', '1_1', '99999999999999999999_1']:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.pks(history_page(self.user, before=cursor, page_size=5)), first)
+
+    def test_pages_are_per_user(self):
+        other = create_synthetic_user('other')
+        seed_trade_history(other, 10)
+        self.assertEqual(self.pks(history_page(self.user, page_size=100)), self.oldest_first)
+
+    # A sale of whole-dollar amounts: a $100 short-term gain on $1,000 of proceeds, untaxed. SQLite stores these as
+    # integers, which must not be divided as such.
+    def add_whole_dollar_sale(self):
+        UserProfile.objects.filter(user=self.user).update(tax_rate_STCG=0)
+        self.user.userprofile.refresh_from_db()
+        return Transaction.objects.create(user=self.user, type='SLD', symbol='AAPL', transaction_shares=10, transaction_value_per_share=Decimal('100'),
+                                          transaction_value_total=Decimal('1000'), STCG=Decimal('100'), LTCG=Decimal('0'), STCG_tax=Decimal('0'), LTCG_tax=Decimal('0'))
+
+    def test_whole_dollar_sale(self):
+        sale = self.add_whole_dollar_sale()
+        row = history_page(self.user, page_size=100).transactions[-1]
+        self.assertEqual(row.pk, sale.pk)
+        self.assertEqual(row.total_CG_pre_tax_percent, Decimal('0.1'))
+        self.assertEqual(row.total_CG_post_tax_percent, Decimal('0.1'))
+        self.assertEqual([str(getattr(row, name)) for name in ['total_CG_pre_tax', 'total_CG_tax', 'STCG_post_tax', 'total_CG_post_tax']], ['100.00', '0.00', '100.00', '100.00'])
+
+    def export(self, export_format):
+        self.client.force_login(self.user)
+        response = self.client.get(f'/history/export/?format={ export_format }', secure=True)
+        return response, b''.join(response.streaming_content).decode() if response.streaming else None
+
+    # The whole-dollar sale's row of an export, as strings
+    def assert_exported_sale(self, row):
+        self.assertEqual(Decimal(row['total_CG_pre_tax_percent']), Decimal('0.1'))
+        self.assertEqual(Decimal(row['total_CG_post_tax_percent']), Decimal('0.1'))
+        self.assertEqual([row[name] for name in ['transaction_value_total', 'STCG', 'total_CG_pre_tax', 'total_CG_tax', 'STCG_post_tax', 'total_CG_post_tax']],
+                         ['1000.00', '100.00', '100.00', '0.00', '100.00', '100.00'])
+
+    def test_csv_export(self):
+        sale = self.add_whole_dollar_sale()
+        response, content = self.export('csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(content)))
+        self.assertEqual([int(row['id']) for row in rows], self.oldest_first + [sale.pk])
+        self.assertEqual((rows[0]['type'], rows[0]['transaction_shares'], rows[0]['transaction_value_total'], rows[0]['total_CG_pre_tax_percent']), ('BOT', '1', '100.00', ''))
+        self.assert_exported_sale(rows[-1])
+
+    def test_ndjson_export(self):
+        sale = self.add_whole_dollar_sale()
+        response, content = self.export('ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['id'] for row in rows], self.oldest_first + [sale.pk])
+        self.assertEqual((rows[-2]['transaction_value_total'], rows[-2]['total_CG_pre_tax_percent']), ('2300.00', None))
+        self.assert_exported_sale(rows[-1])
+
+    def test_unknown_export_format(self):
+        response, _ = self.export('xml')
+        self.assertEqual(response.status_code, 400)
+
+    # An exported history imports into another account as the same trades
+    def test_export_imports_as_the_same_trades(self):
+        seed_trade_history(self.user, 60, symbols=['AAPL', 'KO'])
+        _, content = self.export('csv')
+        create_synthetic_user('copy')
+        import_trades(read_trades(io.StringIO(content), 'csv', username='copy'))
+        fields = ['timestamp', 'type', 'symbol', 'transaction_shares', 'transaction_value_per_share']
+        copied = lambda username: list(Transaction.objects.filter(user__username=username).order_by('timestamp', 'pk').values_list(*fields))
+        self.assertEqual(copied('copy'), copied('historian'))
+
+
+# check_valid_shares' sum of the shares a user holds in a symbol is read from txn_user_sym_type_ts_shr_idx alone
+@skipUnless(connection.vendor == 'sqlite', 'checks an SQLite query plan')
+class TransactionIndexTests(TestCase):
+    def test_shares_owned_sum_is_covered(self):
+        user = create_synthetic_user('indexed')
+        queryset = Transaction.objects.filter(user=user, symbol='AAPL', type='BOT').values('user').annotate(total_shares=Sum('shares_outstanding')).values('total_shares')
+        self.assertIn('USING COVERING INDEX txn_user_sym_type_ts_shr_idx', queryset.explain())
+
+
+class BaselineComparisonTests(TestCase):
+    def compare(self, before, after):
+        return compare_to_baseline({'results': {'bench': {'min_ms': before}}}, {'bench': {'min_ms': after}}, metric='min_ms')[0][-1]
+
+    # Short benchmarks are allowed to double before counting as slower; longer ones, a quarter
+    def test_tolerance(self):
+        self.assertFalse(self.compare(1.0, 1.9))
+        self.assertTrue(self.compare(1.0, 2.65))
+        self.assertFalse(self.compare(100.0, 120.0))
+        self.assertTrue(self.compare(100.0, 130.0))
+        self.assertFalse(self.compare(0.01, 0.04))
+
+    def test_time_call_runs_for_min_time(self):
+        timings = time_call(lambda: time.sleep(0.001), repeat=2, warmup=0, min_time=0.02)
+        self.assertGreaterEqual(timings['runs'], 10)
+        self.assertLessEqual(timings['min_ms'], timings['p50_ms'])
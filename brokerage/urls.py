@@ -12,6 +12,7 @@ urlpatterns = [
     path('check-shares/', views.check_valid_shares_view, name='check_valid_shares'),
     path('check-symbol/', views.check_valid_symbol_view, name='check_valid_symbol'),
     path('history/', views.history_view, name='history'),
+    path('history/export/', views.history_export_view, name='history_export'),
     path('quote/', views.quote_view, name='quote'),
     path('sell/', views.sell_view, name='sell'),
 ]
\ No newline at end of file
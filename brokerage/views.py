@@ -7,9 +7,10 @@ from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
 from django.db.models import Q, F, Func, Sum, Value
 from django.db.models.functions import Length
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
+from django.utils import timezone
 from django.views.decorators.http import require_http_methods
 from .forms import *
 from .helpers import *
@@ -34,13 +35,9 @@ def index_view(request):
     
     # Retrieve the user object for the logged-in user
     user = request.user
-    cache_key = f'portfolio_{user.pk}'  # Unique key for each user
-    portfolio = cache.get(cache_key)
-
-    if not portfolio:
-        portfolio = process_user_transactions(user)
-        cache.set(cache_key, portfolio, timeout=300)  # Cache the data for 5 minutes (300 seconds)
-        logger.debug(f'running / ... for user {user} ... portfolio.cash is: { portfolio.cash }')
+    # Always load the portfolio through get_portfolio, which handles caching (see helpers/process_portfolio.py)
+    portfolio = get_portfolio(user, request)
+    logger.debug(f'running / ... for user {user} ... portfolio.cash is: { portfolio.cash }')
     
 
     """
@@ -68,16 +65,9 @@ def index_detail_view(request):
 
     # Retrieve the user object for the logged-in user
     user = request.user
-    cache_key = f'portfolio_{user.pk}'  # Unique key for each user
-    portfolio = cache.get(cache_key)
-
-    if not portfolio:
-        portfolio = process_user_transactions(user)
-        cache.set(cache_key, portfolio, timeout=300)  # Cache the data for 5 minutes (300 seconds)
-        logger.debug(f'running / ... for user {user} ... portfolio.cash is: { portfolio.cash }')
-
-    # Call the function to create the portfolio object for the user
-    portfolio = process_user_transactions(user)
+    # Always load the portfolio through get_portfolio, which handles caching (see helpers/process_portfolio.py). This
+    # page also lists every sale.
+    portfolio = get_portfolio(user, request, include_sales=True)
     logger.debug(f'running / ... for user {user} ... portfolio.cash is: { portfolio.cash }')
 
     # Render the index page with the user and portfolio context
@@ -98,8 +88,6 @@ def buy_view(request):
 
     # Retrieve the user object for the logged-in user
     user = request.user
-    cache_key = f'portfolio_{user.pk}'  # Unique key for each user
-    portfolio = cache.get(cache_key)
 
     # Display the BuyForm
     form = BuyForm(request.POST or None) # This will handle both POST and initial GET
@@ -137,10 +125,7 @@ def buy_view(request):
             # If symbol + shares are valid, proceed with processing the share purchase
             new_transaction = process_buy(symbol=symbol, shares=shares, user=user, check_valid_shares_result=check_valid_shares_result)
             
-            # Refresh the portfolio to account for the purchase
-            portfolio = process_user_transactions(user)
-            cache.set(cache_key, portfolio, timeout=300)  # Cache the data for 5 minutes (300 seconds)
-            logger.debug(f'running brokerage app, buy_view ... for user {user} ... portfolio.cash is: { portfolio.cash }')
+            # The cached portfolio is invalidated by the new transaction (see brokerage/signals.py)
             
             # Flash success message and redirect to index
             logger.debug(f'running brokerage app, buy_view ... successfully processed new_transaction: { new_transaction }.')
@@ -207,23 +192,15 @@ def history_view(request):
 
     # Retrieve the user object for the logged-in user
     user = request.user
-    history = user.transaction_set.all()
-
-    # Some additional calculations needed to for history:
-    for transaction in history:
-        if transaction.type == 'SLD':
-            transaction.total_CG_pre_tax = transaction.STCG + transaction.LTCG
-            transaction.total_CG_pre_tax_percent = transaction.total_CG_pre_tax / transaction.transaction_value_total
-            transaction.total_CG_tax = transaction.LTCG_tax + transaction.STCG_tax
-            transaction.STCG_post_tax = transaction.STCG * (1 - user.userprofile.tax_rate_STCG)
-            transaction.LTCG_post_tax = transaction.LTCG * (1 - user.userprofile.tax_rate_LTCG)
-            transaction.total_CG_post_tax = transaction.STCG_post_tax + transaction.LTCG_post_tax 
-            transaction.total_CG_post_tax_percent = transaction.total_CG_post_tax /  transaction.transaction_value_total
+
+    # One page of the history, oldest first; the post-tax columns are computed in the query (see transaction_history.py)
+    page = history_page(user, before=request.GET.get('before'), after=request.GET.get('after'))
 
     # Render the index page with the user and portfolio context
     context = {
         'user': user,
-        'history': history,
+        'history': page.transactions,
+        'page': page,
     }
     
     # Render page, passing user and portfolio objects
@@ -231,6 +208,31 @@ def history_view(request):
 
 #--------------------------------------------------------------------------------
 
+# The formats /history/export streams the user's whole history in: content type, file extension, row generator
+HISTORY_EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv', iter_history_csv),
+    'ndjson': ('application/x-ndjson', 'ndjson', iter_history_ndjson),
+}
+
+
+@login_required(login_url='users:login')
+@require_http_methods(['GET'])
+def history_export_view(request):
+    logger.debug('running brokerage app, history_export_view ... view started')
+
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in HISTORY_EXPORT_FORMATS:
+        return HttpResponse(f'Unknown export format, expected one of: { ", ".join(HISTORY_EXPORT_FORMATS) }', status=400, content_type='text/plain')
+    content_type, extension, iter_rows = HISTORY_EXPORT_FORMATS[export_format]
+
+    # Streamed as it is read from the DB, so even a very long history is never held in memory
+    user = request.user
+    response = StreamingHttpResponse(iter_rows(user), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="history_{ user.username }_{ timezone.now():%Y-%m-%d}.{ extension }"'
+    return response
+
+#--------------------------------------------------------------------------------
+
 @require_http_methods('GET')
 def quote_view(request):
     logger.debug('running brokerage app, quote_view ... view started')
@@ -284,8 +286,6 @@ def sell_view(request):
 
     # Retrieve the user object and portfolio for the logged-in user
     user = request.user
-    cache_key = f'portfolio_{user.pk}'  # Unique key for each user
-    portfolio = cache.get(cache_key)
     logger.debug(f'running sell_view ... user is { user }')
     
     # Retrieve the list of shares owned
@@ -323,10 +323,7 @@ def sell_view(request):
             new_transaction = process_sell(symbol=symbol, shares=shares, user=user)
             logger.debug(f'running sell_view ... user is: { user }, new transaction processed successfully: { new_transaction }')
             
-            # Refresh the portfolio to account for the purchase
-            portfolio = process_user_transactions(user)
-            cache.set(cache_key, portfolio, timeout=300)  # Cache the data for 5 minutes (300 seconds)
-            logger.debug(f'running brokerage app, sell_view ... for user {user} ... portfolio.cash is: { portfolio.cash }')
+            # The cached portfolio is invalidated by the new transaction (see brokerage/signals.py)
             
             # Flash the success message and redirect to index.
             logger.debug(f'running brokerage app, sell_view ... for user {user} ... processed share sale and refreshed user portfolio. Redirecting to index.')
@@ -1,5 +1,6 @@
 # Provides ability to authenticate username+pw, log a user in, log a user out.
 import base64
+from brokerage.helpers import invalidate_portfolio
 from django import forms
 from django.conf import settings
 from django.contrib import messages
@@ -371,8 +372,7 @@ def logout_view(request):
     logger.debug('running users app, logout_view ... view started')
 
     user = request.user
-    cache_key = f'portfolio_{user.pk}'
-    cache.delete(cache_key)  # Clear cache for this user
+    invalidate_portfolio(user.pk)  # Clear cache for this user
 
     # logout is a function built into django.
     logout(request)
@@ -0,0 +1,192 @@
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.cache.backends.redis import RedisSerializer
+from django.utils.module_loading import import_string
+import os
+import sqlite3
+import threading
+import time
+
+
+# Cache backend storing entries in a SQLite file of their own, so that every gunicorn worker (and the scheduler, and
+# management commands) on the host shares one cache without running a cache server. Selected with
+# CACHE_BACKEND=sqlite (see settings.py).
+# add() and incr() are atomic across processes, which the portfolio build locks and cache versions rely on. Values go
+# through the same serializer interface as Django's RedisCache (OPTIONS['serializer'], default: pickle, with ints kept
+# as ints). Expired entries are skipped on read and purged every CULL_EVERY writes, along with the entries nearest to
+# expiry if the cache holds more than MAX_ENTRIES.
+class SQLiteCache(BaseCache):
+    CULL_EVERY = 100
+    # SQLite's default limit on variables in one statement is 999
+    MAX_VARIABLES = 900
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = str(location)
+        self._serializer_option = params.get('OPTIONS', {}).get('serializer')
+        self._serializer = None
+        self._local = threading.local()
+        self._writes = 0
+
+    # The serializer is resolved on first use, as it may import models that are not loaded when settings are read
+    @property
+    def serializer(self):
+        if self._serializer is None:
+            serializer = self._serializer_option
+            if isinstance(serializer, str):
+                serializer = import_string(serializer)
+            if callable(serializer):
+                serializer = serializer()
+            self._serializer = serializer or RedisSerializer()
+        return self._serializer
+
+    # One connection per thread, opened in autocommit mode; reopened in a forked child rather than shared with the parent
+    @property
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self._path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL) WITHOUT ROWID'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    # Returns the expiry time to store for a timeout (as a Unix timestamp), or None for an entry that never expires
+    def _expires(self, timeout):
+        return self.get_backend_timeout(timeout)
+
+    def _dumps(self, value):
+        return self.serializer.dumps(value)
+
+    def _loads(self, value):
+        return value if type(value) is int else self.serializer.loads(value)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._connection.execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+        ).fetchone()
+        return default if row is None else self._loads(row[0])
+
+    def get_many(self, keys, version=None):
+        keys_by_cache_key = {self.make_and_validate_key(key, version=version): key for key in keys}
+        cache_keys = list(keys_by_cache_key)
+        now = time.time()
+        result = {}
+        for start in range(0, len(cache_keys), self.MAX_VARIABLES):
+            chunk = cache_keys[start:start + self.MAX_VARIABLES]
+            rows = self._connection.execute(
+                f'SELECT key, value FROM cache WHERE key IN ({ ",".join("?" * len(chunk)) }) AND (expires IS NULL OR expires > ?)',
+                (*chunk, now),
+            )
+            for cache_key, value in rows:
+                result[keys_by_cache_key[cache_key]] = self._loads(value)
+        return result
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._connection.execute(
+            'SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+        ).fetchone() is not None
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self._connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', (key, self._dumps(value), self._expires(timeout))
+        )
+        self._wrote()
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self._expires(timeout)
+        rows = [(self.make_and_validate_key(key, version=version), self._dumps(value), expires) for key, value in data.items()]
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', rows)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        self._wrote(len(rows))
+        return []
+
+    # Writes the value only if the key is missing or expired, in a single statement
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection.execute(
+            'INSERT INTO cache (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires '
+            'WHERE cache.expires IS NOT NULL AND cache.expires <= ?',
+            (key, self._dumps(value), self._expires(timeout), time.time()),
+        )
+        self._wrote()
+        return cursor.rowcount == 1
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self._connection.execute(
+            'UPDATE cache SET expires = ? WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (self._expires(timeout), key, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    # Reads and updates the value in one write transaction, so concurrent increments are never lost
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        connection = self._connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time.time())
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Key '{ key }' not found.")
+            value = self._loads(row[0]) + delta
+            connection.execute('UPDATE cache SET value = ? WHERE key = ?', (self._dumps(value), key))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._connection.execute('DELETE FROM cache WHERE key = ?', (key,)).rowcount > 0
+
+    def delete_many(self, keys, version=None):
+        cache_keys = [self.make_and_validate_key(key, version=version) for key in keys]
+        for start in range(0, len(cache_keys), self.MAX_VARIABLES):
+            chunk = cache_keys[start:start + self.MAX_VARIABLES]
+            self._connection.execute(f'DELETE FROM cache WHERE key IN ({ ",".join("?" * len(chunk)) })', chunk)
+
+    def clear(self):
+        self._connection.execute('DELETE FROM cache')
+
+    def close(self, **kwargs):
+        # Connections are kept for the life of the thread, like a Redis connection pool
+        pass
+
+    def _wrote(self, count=1):
+        self._writes += count
+        if self._writes >= self.CULL_EVERY:
+            self._writes = 0
+            self._cull()
+
+    # Purges expired entries, then, if the cache is still over MAX_ENTRIES, 1/CULL_FREQUENCY of the entries
+    # (those nearest to expiry first)
+    def _cull(self):
+        connection = self._connection
+        connection.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+        count = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if count > self._max_entries:
+            cull_count = count // self._cull_frequency if self._cull_frequency else count
+            connection.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?)', (cull_count,)
+            )
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+import logging
+import signal
+import sys
+import time
+from ...tasks import task_is_due
+
+logger = logging.getLogger('django')
+
+
+# Long-running process that runs the management commands in SCHEDULED_TASKS whenever they are due. Each command takes
+# its own task lock (see utils/tasks.py), so the scheduler can run on every node and a task still only runs once.
+# Meant to run under supervisord next to gunicorn, e.g.:
+#   [program:scheduler]
+#   command=python manage.py run_scheduler
+#   directory=/app
+#   autorestart=true
+#   stopwaitsecs=60
+# Usage: python manage.py run_scheduler [--once]
+class Command(BaseCommand):
+    help = 'Runs the scheduled background tasks (see SCHEDULED_TASKS in settings.py).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run whatever is due once and exit, e.g. from cron')
+
+    def handle(self, *args, **options):
+        # Turn supervisord's SIGTERM into SystemExit, so a task in progress releases its lock on the way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        logger.debug(f'running run_scheduler ... scheduling: { settings.SCHEDULED_TASKS }')
+
+        while True:
+            self.run_due_tasks()
+            if options['once']:
+                return
+            time.sleep(settings.SCHEDULER_POLL_INTERVAL)
+
+    def run_due_tasks(self):
+        for name, interval in settings.SCHEDULED_TASKS.items():
+            # The scheduler outlives any single DB connection, so drop connections that have gone stale
+            close_old_connections()
+            try:
+                if task_is_due(name, interval):
+                    self.stdout.write(f'Running scheduled task: { name }')
+                    call_command(name, stdout=self.stdout, stderr=self.stderr)
+            except Exception as e:
+                # Failures are recorded on the task by run_task; keep the scheduler alive for the other tasks
+                logger.error(f'running run_scheduler ... task { name } failed: { e }')
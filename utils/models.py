@@ -1,3 +1,18 @@
 from django.db import models
 
 # Create your models here.
+
+
+# Bookkeeping for a periodic background task (see utils/tasks.py). The row doubles as a lock shared by every node
+# using the database: a process claims the task by moving locked_until into the future with a conditional UPDATE.
+class ScheduledTask(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    locked_by = models.CharField(blank=True, max_length=255)
+    last_started = models.DateTimeField(blank=True, null=True)
+    last_success = models.DateTimeField(blank=True, null=True)
+    last_failure = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f'Task {self.name}: last succeeded {self.last_success}'
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+import logging
+import os
+import socket
+from .models import ScheduledTask
+__all__ = ['TaskLocked', 'run_task', 'task_is_due', 'task_status']
+
+logger = logging.getLogger('django')
+
+
+# Raised by run_task when another process (on this or any other node) is already running the task
+class TaskLocked(Exception):
+    pass
+
+
+def _get_task(name):
+    try:
+        return ScheduledTask.objects.get_or_create(name=name)[0]
+    except IntegrityError:
+        # Another process created the row at the same moment
+        return ScheduledTask.objects.get(name=name)
+
+
+# Runs fn() as the background task 'name' and returns its result, recording when it started and last succeeded or
+# failed. The task's row is claimed with a conditional UPDATE, so only one process across all nodes sharing the
+# database runs the task at a time; if a holder dies, its claim lapses after lock_timeout seconds.
+def run_task(name, fn, lock_timeout=None):
+    lock_timeout = lock_timeout or settings.TASK_LOCK_TIMEOUT
+    owner = f'{ socket.gethostname() }:{ os.getpid() }'
+    _get_task(name)
+
+    now = timezone.now()
+    claimed = ScheduledTask.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lte=now), name=name
+    ).update(locked_until=now + timezone.timedelta(seconds=lock_timeout), locked_by=owner, last_started=now)
+    if not claimed:
+        raise TaskLocked(f'Task { name } is already running on { ScheduledTask.objects.get(name=name).locked_by }')
+    logger.debug(f'running run_task() ... task { name } claimed by { owner }')
+
+    # Release the claim however the task ends (including on SIGTERM, see run_scheduler), but only if it is still ours
+    release = ScheduledTask.objects.filter(name=name, locked_by=owner)
+    try:
+        result = fn()
+    except Exception as e:
+        release.update(locked_until=None, last_failure=timezone.now(), last_error=str(e)[:2000])
+        logger.error(f'running run_task() ... task { name } failed: { e }')
+        raise
+    except BaseException:
+        release.update(locked_until=None)
+        raise
+    release.update(locked_until=None, last_success=timezone.now(), last_error='')
+    logger.debug(f'running run_task() ... task { name } succeeded')
+    return result
+
+
+# Returns True if the task has not succeeded within the last 'interval' seconds and has not been attempted within the
+# last SCHEDULER_RETRY_INTERVAL seconds (so a failing task is retried, but not in a tight loop)
+def task_is_due(name, interval):
+    task = ScheduledTask.objects.filter(name=name).first()
+    if task is None:
+        return True
+    now = timezone.now()
+    if task.last_success and task.last_success > now - timezone.timedelta(seconds=interval):
+        return False
+    return not task.last_started or task.last_started <= now - timezone.timedelta(seconds=settings.SCHEDULER_RETRY_INTERVAL)
+
+
+# Returns {task name: {'last_success': ..., 'last_failure': ..., 'running': ...}} for the readiness check
+def task_status():
+    now = timezone.now()
+    return {
+        task.name: {
+            'last_success': task.last_success.isoformat() if task.last_success else None,
+            'last_failure': task.last_failure.isoformat() if task.last_failure else None,
+            'running': bool(task.locked_until and task.locked_until > now),
+        }
+        for task in ScheduledTask.objects.order_by('name')
+    }
@@ -1,3 +1,112 @@
 from django.test import TestCase
+import multiprocessing
+import os
+import tempfile
+import time
+from unittest import mock
+from .cache import SQLiteCache
 
-# Create your tests here.
+
+# A fresh SQLiteCache in a temporary file, as settings.py configures it (with the portfolio serializer)
+def create_sqlite_cache(path, **options):
+    return SQLiteCache(path, {'OPTIONS': {'serializer': 'brokerage.helpers.portfolio_serializer.PortfolioSerializer', **options}})
+
+
+# Run in each worker process: races for one add() lock and increments the shared counter
+def _race(path, increments, results):
+    cache = create_sqlite_cache(path)
+    won = cache.add('lock', os.getpid(), timeout=60)
+    for _ in range(increments):
+        cache.incr('counter')
+    results.put(int(won))
+
+
+class SQLiteCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite3')
+        self.cache = create_sqlite_cache(self.path)
+
+    def test_basic_operations(self):
+        self.cache.set('key', {'a': 1}, timeout=60)
+        self.assertEqual(self.cache.get('key'), {'a': 1})
+        self.assertEqual(self.cache.get('missing', 'default'), 'default')
+        self.cache.set_many({'many_1': 1, 'many_2': [2]}, timeout=60)
+        self.assertEqual(self.cache.get_many(['many_1', 'many_2', 'missing']), {'many_1': 1, 'many_2': [2]})
+        self.assertTrue(self.cache.has_key('many_2'))
+
+    def test_add_only_writes_missing_keys(self):
+        self.cache.set('key', 'value', timeout=60)
+        self.assertFalse(self.cache.add('key', 'other'))
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.assertTrue(self.cache.add('new', 'value', timeout=60))
+        self.assertEqual(self.cache.get('new'), 'value')
+
+    def test_incr(self):
+        self.cache.set('counter', 10, timeout=None)
+        self.assertEqual(self.cache.incr('counter'), 11)
+        self.assertEqual(self.cache.incr('counter', 5), 16)
+        self.assertEqual(self.cache.get('counter'), 16)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+
+    def test_delete_and_clear(self):
+        self.cache.set_many({'a': 1, 'b': 2, 'c': 3}, timeout=60)
+        self.assertTrue(self.cache.delete('a'))
+        self.assertFalse(self.cache.delete('a'))
+        self.cache.delete_many(['b'])
+        self.assertEqual(self.cache.get_many(['a', 'b', 'c']), {'c': 3})
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('c'))
+
+    # Expired entries are neither returned nor incremented, and add() replaces them
+    def test_expiry(self):
+        now = time.time()
+        self.cache.set('expiring', 'soon', timeout=10)
+        self.cache.set('counter', 1, timeout=10)
+        self.cache.set('forever', 'kept', timeout=None)
+        with mock.patch('time.time', return_value=now + 11):
+            self.assertIsNone(self.cache.get('expiring'))
+            self.assertFalse(self.cache.has_key('expiring'))
+            self.assertFalse(self.cache.touch('expiring'))
+            with self.assertRaises(ValueError):
+                self.cache.incr('counter')
+            self.assertTrue(self.cache.add('expiring', 'again', timeout=60))
+            self.assertEqual(self.cache.get('expiring'), 'again')
+            self.assertEqual(self.cache.get('forever'), 'kept')
+
+    def test_touch_extends_expiry(self):
+        now = time.time()
+        self.cache.set('key', 'value', timeout=10)
+        self.assertTrue(self.cache.touch('key', timeout=100))
+        with mock.patch('time.time', return_value=now + 50):
+            self.assertEqual(self.cache.get('key'), 'value')
+
+    # Past MAX_ENTRIES, the entries nearest to expiry are culled first
+    def test_cull(self):
+        cache = create_sqlite_cache(self.path, MAX_ENTRIES=10, CULL_FREQUENCY=2)
+        cache.CULL_EVERY = 1
+        cache.set('forever', 'kept', timeout=None)
+        for i in range(20):
+            cache.set(f'key_{i}', i, timeout=1000 + i)
+        self.assertEqual(cache.get('forever'), 'kept')
+        self.assertEqual(cache.get('key_19'), 19)
+        self.assertIsNone(cache.get('key_0'))
+
+    # Every process opens its own connection, as each gunicorn worker would; none of their increments are lost and
+    # only one of them wins an add() lock
+    def test_add_and_incr_are_atomic_across_processes(self):
+        workers, increments = 4, 50
+        self.cache.set('counter', 0, timeout=None)
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [context.Process(target=_race, args=(self.path, increments, results)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        locks_won = sum(results.get(timeout=60) for _ in processes)
+        for process in processes:
+            process.join()
+
+        self.assertEqual(create_sqlite_cache(self.path).get('counter'), workers * increments)
+        self.assertEqual(locks_won, 1)
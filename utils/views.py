@@ -4,6 +4,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 import json
 import logging
+from .tasks import task_status
 
 
 # View manages logging of CSP violations. See settings.py for CSP settings
@@ -37,6 +38,8 @@ def readiness_check_view(request):
         # For example: check_database_connection()
         logger.info("Readiness check passed")
         response_data = {'status': 'ready'}
+        # Added to expose when each background task (e.g. refresh_listings) last succeeded
+        response_data['tasks'] = task_status()
     except Exception as e:
         logger.error(f"Readiness check failed: {e}")
         return HttpResponse('Service Unavailable', status=503)